@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Бенчмарк імпорту замовлень (views/scripts/orders_pars.py) без доступу до Google.
+
+Генерує синтетичні аркуші ефірів у форматі, який очікує
+process_orders_sheet_data (~26 колонок: продукти, клони, клієнт, ціни,
+додаткова операція, знижка, статуси, ТТН...), і проганяє парсер проти
+окремої локальної бази PostgreSQL у трьох режимах:
+
+- cold        - порожні таблиці замовлень, клієнтів і продуктів;
+- incremental - повторний імпорт, де змінено частину рядків і вставлено рядок
+                на початок одного аркуша (зсув індексів);
+- forced      - примусова обробка всіх рядків (force_process=True).
+
+Для кожного режиму виводиться: рядків/с, запитів до БД на рядок, пік пам'яті
+Python (tracemalloc) і піковий RSS процесу.
+
+УВАГА: бенчмарк очищає таблиці замовлень, клієнтів і продуктів у базі
+BENCH_DB_NAME. Він відмовляється працювати з базою DB_NAME і з базою,
+в імені якої немає "bench" (якщо не вказано --allow-any-db).
+
+Приклад:
+    BENCH_DB_NAME=bsstorage_bench python benchmarks/orders_pars_bench.py --sheets 5 --rows 400
+"""
+
+import os
+import sys
+import json
+import time
+import importlib
+import random
+import argparse
+import resource
+import tracemalloc
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+BENCH_DB_NAME = os.getenv("BENCH_DB_NAME", "bsstorage_bench")
+
+# Таблиці, які очищаються перед холодним прогоном
+BENCH_ORDER_TABLES = ("order_details", "orders", "clients", "products")
+# Довідники, які db.create_initial_data() заповнює з явними id
+BENCH_SEEDED_TABLES = (
+    "genders", "statuses", "conditions", "brands", "types", "subtypes", "colors", "countries",
+    "order_statuses", "payment_statuses", "delivery_methods", "delivery_statuses", "payment_methods",
+)
+
+LAST_NAMES = ["Шевченко", "Коваленко", "Бондаренко", "Ткаченко", "Кравченко", "Олійник",
+              "Мельник", "Поліщук", "Савченко", "Руденко", "Мороз", "Лисенко"]
+FIRST_NAMES = ["Олена", "Ірина", "Наталія", "Оксана", "Тетяна", "Марія",
+               "Андрій", "Сергій", "Юлія", "Світлана", "Катерина", "Віктор"]
+TOPICS = ["Взуття", "Одяг", "Аксесуари", "Розпродаж", "Новинки"]
+
+
+def check_bench_database(allow_any_db):
+    """Захист від запуску на робочій базі."""
+    production_db = os.getenv("DB_NAME")
+    if BENCH_DB_NAME == production_db:
+        sys.exit(f"BENCH_DB_NAME ({BENCH_DB_NAME}) збігається з DB_NAME - відмова, бенчмарк очищає таблиці")
+    if "bench" not in BENCH_DB_NAME.lower() and not allow_any_db:
+        sys.exit(f"Ім'я бази {BENCH_DB_NAME} не містить 'bench'; вкажіть --allow-any-db, якщо це тестова база")
+
+
+# -------------------------------------------------------
+#   Генерація синтетичних аркушів
+# -------------------------------------------------------
+class SyntheticSheetGenerator:
+    """Генератор рядків аркуша ефіру з реалістичним розподілом значень."""
+
+    def __init__(self, seed, clients, products):
+        self.random = random.Random(seed)
+        self.clients = [
+            f"{self.random.choice(LAST_NAMES)} {self.random.choice(FIRST_NAMES)} {i}"
+            for i in range(clients)
+        ]
+        self.products = [f"{self.random.choice('ABCDEFGHK')}{10000 + i}" for i in range(products)]
+
+    def row(self, order_statuses, payment_statuses, delivery_methods, delivery_statuses):
+        rnd = self.random
+        products = rnd.sample(self.products, rnd.choice((1, 1, 1, 2, 3)))
+        clones = ""
+        if rnd.random() < 0.1:
+            clones = f"{rnd.choice(self.products)}-K({products[0]})"
+        payment_status = rnd.choice(payment_statuses)
+        delivery_status = rnd.choice(delivery_statuses) if payment_status == "оплачено" else ""
+
+        row = [""] * 26
+        row[0] = ", ".join(products)
+        row[1] = clones
+        row[2] = rnd.choice(self.clients)
+        row[10] = "; ".join(str(rnd.randrange(150, 3000, 10)) for _ in products)
+        row[11] = rnd.choice(("", "", "", "+50", "-30", "+120"))
+        row[12] = rnd.choice(("", "", "", "10%", "100", "5%"))
+        row[14] = rnd.choice(order_statuses)
+        row[15] = payment_status
+        row[16] = rnd.choice(delivery_methods)
+        row[17] = rnd.choice(("", "", "передзвонити", "розмір уточнити"))
+        row[21] = delivery_status
+        row[22] = str(rnd.randrange(10 ** 13, 10 ** 14)) if delivery_status else ""
+        row[25] = rnd.choice(("", "", "", "1"))
+        return row
+
+    def sheets(self, count, rows_per_sheet, maps):
+        result = []
+        for i in range(count):
+            sheet_name = f"{1 + i % 28:02d}.{1 + i // 28 % 12:02d}.2024 ({self.random.choice(TOPICS)})"
+            rows = [self.row(*maps) for _ in range(rows_per_sheet)]
+            result.append((sheet_name, rows))
+        return result
+
+    def mutate(self, sheets, changed_fraction, maps):
+        """Змінює частину рядків і вставляє рядок на початок першого аркуша."""
+        payment_statuses = maps[1]
+        changed = 0
+        for _, rows in sheets:
+            for row in rows:
+                if self.random.random() < changed_fraction:
+                    row[15] = self.random.choice(payment_statuses)
+                    row[17] = f"змінено {self.random.randrange(1000)}"
+                    changed += 1
+        if sheets:
+            sheets[0][1].insert(0, self.row(*maps))
+        return changed
+
+
+# -------------------------------------------------------
+#   Підготовка бази
+# -------------------------------------------------------
+def prepare_database(orders_pars):
+    """Створює схему моделей і довідники, очищає таблиці замовлень."""
+    import db
+
+    # db.init_db() створює лише зареєстровані в Base.metadata таблиці, а модулі
+    # парсера моделей не імпортують: реєструємо їх явно (без прив'язки імені)
+    importlib.import_module("models")
+
+    if db.engine.dialect.name != "postgresql":
+        sys.exit(f"Немає підключення до PostgreSQL ({BENCH_DB_NAME}); бенчмарк не працює з SQLite")
+    db.init_db()
+    db.create_initial_data()
+
+    conn = orders_pars.connect_to_db()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("TRUNCATE {} RESTART IDENTITY CASCADE".format(", ".join(BENCH_ORDER_TABLES)))
+            # Таблиці відстеження створюються самим парсером
+            cur.execute("DROP TABLE IF EXISTS row_hashes, processing_progress")
+            # Довідники вставлені з явними id - підтягуємо послідовності
+            for table in BENCH_SEEDED_TABLES:
+                cur.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {table}"
+                )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def run_phase(orders_pars, name, sheets, force_process):
+    # Скидає кеші, час етапів і облік запитів (query_stats)
+    orders_pars.prepare_import_run()
+    orders_pars.parsing_status["processed_sheets"] = 0
+    rows_total = sum(len(rows) for _, rows in sheets)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    errors = 0
+    for sheet_name, rows in sheets:
+        errors += len(orders_pars.process_orders_sheet_data(
+            rows, sheet_name, force_process, prune_stale_rows=True) or [])
+    elapsed = time.perf_counter() - started
+    _, python_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    query_report = orders_pars.query_stats.report(top_n=10)
+    queries = query_report["totals"]["calls"]
+    return {
+        "phase": name,
+        "rows": rows_total,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(rows_total / elapsed, 1) if elapsed else None,
+        "queries": queries,
+        "queries_per_row": round(queries / rows_total, 2) if rows_total else None,
+        "commits": query_report["totals"]["commits"],
+        "round_trips": query_report["totals"]["round_trips"],
+        "python_peak_mb": round(python_peak / 1024 / 1024, 1),
+        # ru_maxrss у Linux - у кілобайтах, монотонний для процесу
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "errors": errors,
+        "stages": orders_pars.stage_timer.report()["totals"],
+        "top_queries": query_report["top"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк імпорту замовлень на синтетичних аркушах")
+    parser.add_argument("--sheets", type=int, default=5, help="кількість аркушів")
+    parser.add_argument("--rows", type=int, default=400, help="рядків на аркуш")
+    parser.add_argument("--clients", type=int, default=800, help="кількість різних клієнтів")
+    parser.add_argument("--products", type=int, default=3000, help="кількість різних номерів продуктів")
+    parser.add_argument("--changed-fraction", type=float, default=0.05, help="частка змінених рядків для incremental")
+    parser.add_argument("--phases", default="cold,incremental,forced", help="режими через кому")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", help="зберегти результати у JSON-файл")
+    parser.add_argument("--allow-any-db", action="store_true", help="дозволити базу без 'bench' в імені")
+    args = parser.parse_args()
+
+    check_bench_database(args.allow_any_db)
+    # Модулі проекту читають параметри БД з оточення під час імпорту
+    os.environ["DB_NAME"] = BENCH_DB_NAME
+    for key in ("HOST", "PORT", "USER", "PASSWORD"):
+        if os.getenv(f"BENCH_DB_{key}"):
+            os.environ[f"DB_{key}"] = os.environ[f"BENCH_DB_{key}"]
+
+    from views.scripts import orders_pars
+
+    prepare_database(orders_pars)
+
+    maps = (
+        list(orders_pars.ORDER_STATUS_MAP),
+        list(orders_pars.PAYMENT_STATUS_MAP),
+        list(orders_pars.DELIVERY_METHOD_MAP),
+        list(orders_pars.DELIVERY_STATUS_MAP),
+    )
+    generator = SyntheticSheetGenerator(args.seed, args.clients, args.products)
+    sheets = generator.sheets(args.sheets, args.rows, maps)
+
+    results = []
+    for phase in [p.strip() for p in args.phases.split(",") if p.strip()]:
+        if phase == "cold":
+            result = run_phase(orders_pars, phase, sheets, False)
+        elif phase == "incremental":
+            changed = generator.mutate(sheets, args.changed_fraction, maps)
+            result = run_phase(orders_pars, phase, sheets, False)
+            result["changed_rows"] = changed + 1
+        elif phase == "forced":
+            result = run_phase(orders_pars, phase, sheets, True)
+        else:
+            sys.exit(f"Невідомий режим: {phase}")
+        results.append(result)
+        print(f"{phase:>12}: {result['rows']} рядків за {result['seconds']:.2f} с, "
+              f"{result['rows_per_second']} рядків/с, {result['queries_per_row']} запитів/рядок, "
+              f"{result['commits']} комітів, "
+              f"пам'ять Python {result['python_peak_mb']} МБ, RSS {result['peak_rss_mb']} МБ, "
+              f"помилок {result['errors']}")
+
+    orders_pars.db_pool.close_all()
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+        print(f"Результати збережено у {args.json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -250,7 +250,7 @@ class OrderDetails(Base):
 
  id = Column(Integer, primary_key=True)
  order_id = Column(Integer, ForeignKey('orders.id'), nullable=False)
- product_id = Column(Integer, ForeignKey('products.id'), nullable=False)
+ product_id = Column(Integer, ForeignKey('products.id'), nullable=False, index=True)
  quantity = Column(Integer, nullable=False)
  price = Column(Numeric(12, 2))
  discount_type = Column(String(50))
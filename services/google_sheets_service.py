@@ -1,13 +1,21 @@
 import os
+import json
+import hashlib
 import logging
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 from dotenv import load_dotenv
 import time
 
+from services.rate_limiter import sheets_rate_limiter, is_quota_error
+from services.sheet_snapshot_service import sheet_snapshot_service
+
 # Налаштування логування
 logger = logging.getLogger('google_sheets_service')
 
+# Метадані файлів Google Drive (час останньої зміни документа)
+DRIVE_FILES_API_URL = "https://www.googleapis.com/drive/v3/files"
+
 class GoogleSheetsService:
     """
     Сервіс для роботи з Google Sheets API.
@@ -16,6 +24,7 @@ class GoogleSheetsService:
     - Підключення до Google Sheets API
     - Отримання даних з таблиць замовлень і товарів
     - Управління кешем підключення для зменшення використання API
+    - Обмеження частоти запитів (усі виклики API проходять через call())
     """
     
     def __init__(self):
@@ -42,8 +51,185 @@ class GoogleSheetsService:
         self.orders_document_name = os.getenv("GOOGLE_SHEETS_DOCUMENT_NAME_ORDERS", "Замовлення")
         self.products_document_name = os.getenv("GOOGLE_SHEETS_DOCUMENT_NAME_PRODUCTS", "Товари")
         
+        self.rate_limiter = sheets_rate_limiter
+        self.snapshots = sheet_snapshot_service
+        
+        # Обмеження одного пакетного запиту values_batch_get: кількість діапазонів
+        # і орієнтовна кількість комірок (за розміром сітки аркуша)
+        self.batch_max_ranges = int(os.getenv("GOOGLE_SHEETS_BATCH_MAX_RANGES", "20"))
+        self.batch_max_cells = int(os.getenv("GOOGLE_SHEETS_BATCH_MAX_CELLS", "500000"))
+        
+        # Діапазон-"зонд" для перевірки змін аркуша: усі колонки, які читає парсер
+        # замовлень (статуси, оплата, доставка і ТТН - у колонках O-W)
+        self.probe_range = os.getenv("ORDERS_SHEET_PROBE_RANGE", "A:Z")
+        self.probe_batch_ranges = int(os.getenv("GOOGLE_SHEETS_PROBE_BATCH_RANGES", "100"))
+        
         logger.info(f"GoogleSheetsService ініціалізовано. JSON-ключ: {self.json_key_file}")
     
+    def call(self, func, *args, max_retries=8, **kwargs):
+        """
+        Виконує виклик Google Sheets API через спільний обмежувач частоти.
+        При перевищенні квоти виклик повторюється (до max_retries разів)
+        після адаптивного охолодження.
+        
+        Returns:
+            Результат func(*args, **kwargs).
+        """
+        return self.rate_limiter.call(func, *args, max_retries=max_retries, **kwargs)
+    
+    @staticmethod
+    def _quote_sheet_title(title):
+        """Назва аркуша у форматі A1-нотації ('Назва' з подвоєними апострофами)."""
+        return "'" + title.replace("'", "''") + "'"
+    
+    @staticmethod
+    def _fill_gaps(values):
+        """Доповнює рядки порожніми значеннями до однакової довжини, як get_all_values()."""
+        if not values:
+            return []
+        width = max(len(row) for row in values)
+        return [row + [""] * (width - len(row)) if len(row) < width else row for row in values]
+    
+    def chunk_worksheets(self, worksheets):
+        """
+        Розбиває аркуші на групи для пакетних запитів: аркуші одного документа,
+        не більше batch_max_ranges діапазонів і batch_max_cells комірок у групі.
+        Аркуш, більший за ліміт комірок, потрапляє в окрему групу.
+        
+        Yields:
+            list: аркуші однієї групи (у вихідному порядку)
+        """
+        chunk = []
+        chunk_cells = 0
+        chunk_spreadsheet_id = None
+        for worksheet in worksheets:
+            cells = worksheet.row_count * worksheet.col_count
+            spreadsheet_id = worksheet.spreadsheet.id
+            if chunk and (spreadsheet_id != chunk_spreadsheet_id
+                          or len(chunk) >= self.batch_max_ranges
+                          or chunk_cells + cells > self.batch_max_cells):
+                yield chunk
+                chunk = []
+                chunk_cells = 0
+            chunk.append(worksheet)
+            chunk_cells += cells
+            chunk_spreadsheet_id = spreadsheet_id
+        if chunk:
+            yield chunk
+    
+    def fetch_all_values(self, worksheets, max_retries=8, revisions=None):
+        """
+        Отримує значення багатьох аркушів пакетними запитами values_batch_get
+        (один запит і одна одиниця квоти на групу аркушів замість запиту на аркуш).
+        
+        Якщо відома ревізія документа (revisions), аркуші з локальним знімком
+        тієї ж ревізії беруться зі знімка без запиту до API, а завантажені
+        аркуші зберігаються в сховище знімків.
+        
+        Args:
+            worksheets: аркуші gspread (можуть належати різним документам)
+            max_retries: кількість повторів запиту при перевищенні квоти
+            revisions: {назва аркуша: ревізія документа (modifiedTime)} або None
+            
+        Returns:
+            dict: {назва аркуша: рядки}, рядки у тому ж форматі, що й get_all_values()
+        """
+        revisions = revisions or {}
+        result = {}
+        to_fetch = []
+        for worksheet in worksheets:
+            revision = revisions.get(worksheet.title)
+            values = None
+            if revision is not None:
+                values = self.snapshots.get(worksheet.spreadsheet.id, worksheet.id, revision)
+            if values is None:
+                to_fetch.append(worksheet)
+            else:
+                result[worksheet.title] = values
+        if len(to_fetch) < len(worksheets):
+            logger.info(f"Зі знімків отримано {len(worksheets) - len(to_fetch)} незмінених аркушів")
+        
+        for chunk in self.chunk_worksheets(to_fetch):
+            spreadsheet = chunk[0].spreadsheet
+            ranges = [self._quote_sheet_title(ws.title) for ws in chunk]
+            response = self.call(spreadsheet.values_batch_get, ranges, max_retries=max_retries)
+            value_ranges = response.get("valueRanges", [])
+            if len(value_ranges) != len(chunk):
+                raise ValueError(f"values_batch_get повернув {len(value_ranges)} діапазонів замість {len(chunk)}")
+            for worksheet, value_range in zip(chunk, value_ranges):
+                values = self._fill_gaps(value_range.get("values", []))
+                result[worksheet.title] = values
+                self.snapshots.put(worksheet.spreadsheet.id, worksheet.id,
+                                   revisions.get(worksheet.title), values, worksheet.title)
+            logger.info(f"Пакетно отримано {len(chunk)} аркушів одним запитом")
+        return result
+    
+    def get_modified_time(self, spreadsheet):
+        """
+        Час останньої зміни документа в Google Drive (modifiedTime, RFC 3339).
+        
+        Returns:
+            str: час зміни або None, якщо отримати його не вдалося
+        """
+        try:
+            if hasattr(spreadsheet, "get_lastUpdateTime"):
+                return self.call(spreadsheet.get_lastUpdateTime)
+            response = self.call(
+                spreadsheet.client.request, "get", f"{DRIVE_FILES_API_URL}/{spreadsheet.id}",
+                params={"fields": "modifiedTime", "supportsAllDrives": True}
+            )
+            return response.json().get("modifiedTime")
+        except Exception as e:
+            logger.warning(f"Не вдалося отримати час зміни документа {spreadsheet.id}: {e}")
+            return None
+    
+    @staticmethod
+    def probe_digest(values):
+        """MD5-дайджест значень діапазону-зонда."""
+        return hashlib.md5(json.dumps(values, ensure_ascii=False).encode("utf-8")).hexdigest()
+    
+    def get_sheet_fingerprints(self, worksheets, with_probe=True):
+        """
+        Дешеві "відбитки" аркушів для пропуску незмінених аркушів без завантаження:
+        modifiedTime документа (один запит до Drive на документ) і дайджест
+        діапазону-зонда probe_range кожного аркуша (пакетні запити values_batch_get).
+        
+        Args:
+            with_probe: False - без діапазонів-зондів (probe_digest = None)
+        
+        Returns:
+            dict: {назва аркуша: {"modified_time": str | None, "probe_digest": str | None}}
+        """
+        by_spreadsheet = {}
+        for worksheet in worksheets:
+            by_spreadsheet.setdefault(worksheet.spreadsheet.id, []).append(worksheet)
+        
+        fingerprints = {}
+        for spreadsheet_worksheets in by_spreadsheet.values():
+            spreadsheet = spreadsheet_worksheets[0].spreadsheet
+            modified_time = self.get_modified_time(spreadsheet)
+            if not with_probe:
+                for worksheet in spreadsheet_worksheets:
+                    fingerprints[worksheet.title] = {"modified_time": modified_time, "probe_digest": None}
+                continue
+            for start in range(0, len(spreadsheet_worksheets), self.probe_batch_ranges):
+                chunk = spreadsheet_worksheets[start:start + self.probe_batch_ranges]
+                ranges = [f"{self._quote_sheet_title(ws.title)}!{self.probe_range}" for ws in chunk]
+                try:
+                    response = self.call(spreadsheet.values_batch_get, ranges)
+                    value_ranges = response.get("valueRanges", [])
+                except Exception as e:
+                    logger.warning(f"Не вдалося отримати діапазони-зонди {len(chunk)} аркушів: {e}")
+                    value_ranges = []
+                if len(value_ranges) != len(chunk):
+                    value_ranges = [None] * len(chunk)
+                for worksheet, value_range in zip(chunk, value_ranges):
+                    fingerprints[worksheet.title] = {
+                        "modified_time": modified_time,
+                        "probe_digest": self.probe_digest(value_range.get("values", [])) if value_range is not None else None,
+                    }
+        return fingerprints
+    
     def _authenticate(self):
         """
         Автентифікується в Google Sheets API.
@@ -103,7 +289,7 @@ class GoogleSheetsService:
         
         try:
             # Пробуємо отримати список доступних документів
-            _ = self.client.list_spreadsheet_files()
+            _ = self.call(self.client.list_spreadsheet_files)
             return True
         except Exception as e:
             logger.error(f"Google Sheets API не доступне: {str(e)}")
@@ -121,71 +307,43 @@ class GoogleSheetsService:
             logger.error("Не вдалося автентифікуватися для отримання аркушів замовлень")
             return None
         
-        # Параметри для повторних спроб при перевищенні квоти
-        retry_count = 0
-        max_retries = 5
-        backoff_time = 1  # Початкова затримка в секундах
-        max_backoff_time = 60  # Максимальна затримка в секундах
-        
-        while retry_count <= max_retries:
+        try:
+            # Відкриваємо документ з замовленнями (або використовуємо кеш)
+            if self.orders_spreadsheet is None:
+                logger.info(f"Відкриваємо документ замовлень: {self.orders_document_name}")
+                self.orders_spreadsheet = self.call(self.client.open, self.orders_document_name)
+            
+            # Отримуємо всі аркуші та відфільтровуємо службові
+            all_sheets = self.call(self.orders_spreadsheet.worksheets)
+            worksheets = [ws for ws in all_sheets if ws.title.strip() != "Клієнти"]
+            
+            # Сортуємо аркуші за датою (якщо можливо)
             try:
-                # Відкриваємо документ з замовленнями (або використовуємо кеш)
-                if self.orders_spreadsheet is None:
-                    logger.info(f"Відкриваємо документ замовлень: {self.orders_document_name}")
-                    self.orders_spreadsheet = self.client.open(self.orders_document_name)
-                
-                # Отримуємо всі аркуші та відфільтровуємо службові
-                all_sheets = self.orders_spreadsheet.worksheets()
-                worksheets = [ws for ws in all_sheets if ws.title.strip() != "Клієнти"]
-                
-                # Сортуємо аркуші за датою (якщо можливо)
-                try:
-                    from views.scripts.orders_pars import sort_worksheets_by_date
-                    worksheets = sort_worksheets_by_date(worksheets)
-                except (ImportError, AttributeError) as e:
-                    logger.warning(f"Не вдалося імпортувати функцію сортування: {e}")
-                    # Сортуємо за назвою аркуша як запасний варіант
-                    worksheets.sort(key=lambda ws: ws.title)
-                
-                # Ігнорувати певні аркуші
-                ignore_sheets = ["New", "Temporary"]
-                filtered_worksheets = [ws for ws in worksheets if ws.title.strip() not in ignore_sheets]
-                
-                logger.info(f"Отримано {len(filtered_worksheets)} аркушів замовлень з {len(all_sheets)} загальних")
-                return filtered_worksheets
-                
-            except gspread.exceptions.APIError as api_error:
-                error_str = str(api_error)
-                retry_count += 1
-                
-                # Перевірка на перевищення квоти
-                if "Quota exceeded" in error_str or "Rate Limit Exceeded" in error_str or "RESOURCE_EXHAUSTED" in error_str:
-                    wait_time = min(backoff_time * 2 ** (retry_count - 1), max_backoff_time)
-                    import random
-                    jitter = random.uniform(0.8, 1.2)  # Додаємо невелику рандомізацію
-                    wait_time = wait_time * jitter
-                    
-                    logger.warning(f"Перевищено квоту API при отриманні аркушів замовлень. Спроба {retry_count}/{max_retries}. Очікування {wait_time:.1f} секунд")
-                    
-                    # Чекаємо перед наступною спробою
-                    time.sleep(wait_time)
-                    
-                    # Скидаємо кеш документа для наступної спроби
-                    self.orders_spreadsheet = None
-                    
-                    # Якщо це остання спроба, повертаємо помилку
-                    if retry_count >= max_retries:
-                        logger.error(f"Вичерпано всі спроби отримання аркушів замовлень через перевищення квоти")
-                        return None
-                else:
-                    # Інші помилки API
-                    logger.error(f"Помилка API при отриманні аркушів замовлень: {api_error}")
-                    self.orders_spreadsheet = None  # Скидаємо кеш
-                    return None
-            except Exception as e:
-                logger.error(f"Помилка при отриманні аркушів замовлень: {str(e)}")
-                self.orders_spreadsheet = None  # Скидаємо кеш
-                return None
+                from views.scripts.orders_pars import sort_worksheets_by_date
+                worksheets = sort_worksheets_by_date(worksheets)
+            except (ImportError, AttributeError) as e:
+                logger.warning(f"Не вдалося імпортувати функцію сортування: {e}")
+                # Сортуємо за назвою аркуша як запасний варіант
+                worksheets.sort(key=lambda ws: ws.title)
+            
+            # Ігнорувати певні аркуші
+            ignore_sheets = ["New", "Temporary"]
+            filtered_worksheets = [ws for ws in worksheets if ws.title.strip() not in ignore_sheets]
+            
+            logger.info(f"Отримано {len(filtered_worksheets)} аркушів замовлень з {len(all_sheets)} загальних")
+            return filtered_worksheets
+            
+        except gspread.exceptions.APIError as api_error:
+            if is_quota_error(api_error):
+                logger.error(f"Вичерпано всі спроби отримання аркушів замовлень через перевищення квоти")
+            else:
+                logger.error(f"Помилка API при отриманні аркушів замовлень: {api_error}")
+            self.orders_spreadsheet = None  # Скидаємо кеш
+            return None
+        except Exception as e:
+            logger.error(f"Помилка при отриманні аркушів замовлень: {str(e)}")
+            self.orders_spreadsheet = None  # Скидаємо кеш
+            return None
     
     def get_products_worksheets(self):
         """
@@ -199,57 +357,29 @@ class GoogleSheetsService:
             logger.error("Не вдалося автентифікуватися для отримання аркушів товарів")
             return None
         
-        # Параметри для повторних спроб при перевищенні квоти
-        retry_count = 0
-        max_retries = 5
-        backoff_time = 1  # Початкова затримка в секундах
-        max_backoff_time = 60  # Максимальна затримка в секундах
-        
-        while retry_count <= max_retries:
-            try:
-                # Відкриваємо документ з товарами (або використовуємо кеш)
-                if self.products_spreadsheet is None:
-                    logger.info(f"Відкриваємо документ товарів: {self.products_document_name}")
-                    self.products_spreadsheet = self.client.open(self.products_document_name)
-                
-                # Отримуємо всі аркуші
-                worksheets = self.products_spreadsheet.worksheets()
-                
-                logger.info(f"Отримано {len(worksheets)} аркушів товарів")
-                return worksheets
-                
-            except gspread.exceptions.APIError as api_error:
-                error_str = str(api_error)
-                retry_count += 1
-                
-                # Перевірка на перевищення квоти
-                if "Quota exceeded" in error_str or "Rate Limit Exceeded" in error_str or "RESOURCE_EXHAUSTED" in error_str:
-                    wait_time = min(backoff_time * 2 ** (retry_count - 1), max_backoff_time)
-                    import random
-                    jitter = random.uniform(0.8, 1.2)  # Додаємо невелику рандомізацію
-                    wait_time = wait_time * jitter
-                    
-                    logger.warning(f"Перевищено квоту API при отриманні аркушів товарів. Спроба {retry_count}/{max_retries}. Очікування {wait_time:.1f} секунд")
-                    
-                    # Чекаємо перед наступною спробою
-                    time.sleep(wait_time)
-                    
-                    # Скидаємо кеш документа для наступної спроби
-                    self.products_spreadsheet = None
-                    
-                    # Якщо це остання спроба, повертаємо помилку
-                    if retry_count >= max_retries:
-                        logger.error(f"Вичерпано всі спроби отримання аркушів товарів через перевищення квоти")
-                        return None
-                else:
-                    # Інші помилки API
-                    logger.error(f"Помилка API при отриманні аркушів товарів: {api_error}")
-                    self.products_spreadsheet = None  # Скидаємо кеш
-                    return None
-            except Exception as e:
-                logger.error(f"Помилка при отриманні аркушів товарів: {str(e)}")
-                self.products_spreadsheet = None  # Скидаємо кеш
-                return None
+        try:
+            # Відкриваємо документ з товарами (або використовуємо кеш)
+            if self.products_spreadsheet is None:
+                logger.info(f"Відкриваємо документ товарів: {self.products_document_name}")
+                self.products_spreadsheet = self.call(self.client.open, self.products_document_name)
+            
+            # Отримуємо всі аркуші
+            worksheets = self.call(self.products_spreadsheet.worksheets)
+            
+            logger.info(f"Отримано {len(worksheets)} аркушів товарів")
+            return worksheets
+            
+        except gspread.exceptions.APIError as api_error:
+            if is_quota_error(api_error):
+                logger.error(f"Вичерпано всі спроби отримання аркушів товарів через перевищення квоти")
+            else:
+                logger.error(f"Помилка API при отриманні аркушів товарів: {api_error}")
+            self.products_spreadsheet = None  # Скидаємо кеш
+            return None
+        except Exception as e:
+            logger.error(f"Помилка при отриманні аркушів товарів: {str(e)}")
+            self.products_spreadsheet = None  # Скидаємо кеш
+            return None
 
 # Створюємо глобальний екземпляр сервісу
 google_sheets_service = GoogleSheetsService() 
\ No newline at end of file
@@ -0,0 +1,210 @@
+import os
+import time
+import random
+import logging
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Налаштування логування
+logger = logging.getLogger('sheets_rate_limiter')
+
+# Квота читань Google Sheets API на хвилину (для одного користувача сервісного акаунта)
+GOOGLE_SHEETS_READS_PER_MINUTE = int(os.getenv("GOOGLE_SHEETS_READS_PER_MINUTE", "60"))
+
+# Ознаки помилки перевищення квоти в тексті відповіді API
+QUOTA_ERROR_MARKERS = ("Quota exceeded", "Rate Limit Exceeded", "RESOURCE_EXHAUSTED")
+
+
+def is_quota_error(error):
+    """Перевіряє, чи є помилка відповіддю 429 / перевищенням квоти API."""
+    response = getattr(error, "response", None)
+    if getattr(response, "status_code", None) == 429:
+        return True
+    error_str = str(error)
+    return any(marker in error_str for marker in QUOTA_ERROR_MARKERS)
+
+
+def retry_after_seconds(error):
+    """Значення заголовка Retry-After відповіді (секунди) або None."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        value = headers.get("Retry-After")
+        return float(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucketRateLimiter:
+    """
+    Адаптивний обмежувач частоти запитів (token bucket).
+
+    Кожен запит до API забирає один токен; токени відновлюються зі
+    швидкістю, що відповідає хвилинній квоті. Запити притримуються до
+    того, як API поверне 429, а не після.
+
+    Швидкість адаптується (AIMD): кожна відповідь 429 удвічі зменшує
+    швидкість і блокує запити на час охолодження, серія успішних
+    запитів поступово повертає її до базової.
+
+    Args:
+        requests_per_minute: квота запитів на хвилину
+        burst: розмір "відра" - скільки запитів можна зробити поспіль
+        min_rate_fraction: нижня межа швидкості як частка від базової
+        recovery_successes: скільки успішних запитів потрібно для кроку відновлення
+        recovery_step: крок відновлення швидкості як частка від базової
+        max_cooldown: максимальне охолодження після 429, сек
+    """
+
+    def __init__(self, requests_per_minute=60, burst=None, min_rate_fraction=0.1,
+                 recovery_successes=10, recovery_step=0.1, max_cooldown=60.0):
+        self.min_rate_fraction = min_rate_fraction
+        self.recovery_successes = recovery_successes
+        self.recovery_step = recovery_step
+        self.max_cooldown = max_cooldown
+
+        self._lock = threading.Lock()
+        self._burst = burst
+        self._set_quota(requests_per_minute)
+        self._blocked_until = 0.0
+        self._successes = 0
+        self._consecutive_throttles = 0
+        self._stats = {
+            "requests": 0,
+            "throttle_events": 0,
+            "waits": 0,
+            "throttled_seconds": 0.0,
+        }
+
+    def _set_quota(self, requests_per_minute):
+        self.requests_per_minute = max(1, int(requests_per_minute))
+        self.base_rate = self.requests_per_minute / 60.0
+        self.rate = self.base_rate
+        self.capacity = float(self._burst or max(1, self.requests_per_minute // 6))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def configure(self, requests_per_minute):
+        """Змінює квоту (наприклад, після збільшення квоти проекту)."""
+        with self._lock:
+            self._set_quota(requests_per_minute)
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        if elapsed > 0:
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated = now
+
+    def acquire(self):
+        """
+        Блокує потік, доки не з'явиться токен для запиту.
+
+        Returns:
+            float: скільки секунд запит був притриманий
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait_time = max(0.0, self._blocked_until - now)
+                if wait_time == 0.0:
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        self._stats["requests"] += 1
+                        if waited:
+                            self._stats["waits"] += 1
+                            self._stats["throttled_seconds"] += waited
+                        return waited
+                    wait_time = (1.0 - self._tokens) / self.rate
+            time.sleep(wait_time)
+            waited += wait_time
+
+    def on_success(self):
+        """Успішна відповідь: поступово повертає швидкість до базової."""
+        with self._lock:
+            self._consecutive_throttles = 0
+            if self.rate >= self.base_rate:
+                return
+            self._successes += 1
+            if self._successes >= self.recovery_successes:
+                self._successes = 0
+                self.rate = min(self.base_rate, self.rate + self.base_rate * self.recovery_step)
+
+    def on_throttled(self, retry_after=None):
+        """
+        Відповідь 429: зменшує швидкість удвічі, спорожнює відро і блокує
+        запити на час охолодження (Retry-After або експоненціально зростаючий).
+
+        Returns:
+            float: тривалість охолодження, сек
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._stats["throttle_events"] += 1
+            self._consecutive_throttles += 1
+            self._successes = 0
+            self.rate = max(self.base_rate * self.min_rate_fraction, self.rate / 2.0)
+            self._tokens = 0.0
+            self._updated = now
+            if retry_after is None:
+                cooldown = min(self.max_cooldown, 2.0 ** self._consecutive_throttles)
+                cooldown *= random.uniform(0.8, 1.2)  # Рандомізація для уникнення синхронізації запитів
+            else:
+                cooldown = min(self.max_cooldown, retry_after)
+            self._blocked_until = max(self._blocked_until, now + cooldown)
+            return cooldown
+
+    def stats(self):
+        """
+        Статистика обмежувача.
+
+        Returns:
+            dict: кількість запитів, відповідей 429, очікувань, сумарний час
+            очікування (throttled_seconds) і поточна швидкість (запитів/хв)
+        """
+        with self._lock:
+            result = dict(self._stats)
+            result["throttled_seconds"] = round(result["throttled_seconds"], 3)
+            result["current_rate_per_minute"] = round(self.rate * 60.0, 2)
+            result["requests_per_minute"] = self.requests_per_minute
+        return result
+
+    def reset_stats(self):
+        with self._lock:
+            for key in self._stats:
+                self._stats[key] = 0.0 if key == "throttled_seconds" else 0
+
+    def call(self, func, *args, max_retries=8, **kwargs):
+        """
+        Викликає func(*args, **kwargs) через обмежувач, повторюючи виклик
+        при перевищенні квоти (не більше max_retries разів). Інші помилки
+        прокидаються без повторів.
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_quota_error(e):
+                    raise
+                if attempt >= max_retries:
+                    # Остання відмова теж потрапляє у статистику і сповільнює наступні виклики
+                    self.on_throttled(retry_after_seconds(e))
+                    logger.error(f"Перевищено квоту API, вичерпано {max_retries} повторів")
+                    raise
+                attempt += 1
+                cooldown = self.on_throttled(retry_after_seconds(e))
+                logger.warning(f"Перевищено квоту API, спроба {attempt}/{max_retries}, "
+                               f"охолодження {cooldown:.1f} сек, швидкість {self.rate * 60.0:.1f} запитів/хв")
+                continue
+            self.on_success()
+            return result
+
+
+# Спільний обмежувач для всіх викликів Google Sheets API у процесі
+sheets_rate_limiter = TokenBucketRateLimiter(GOOGLE_SHEETS_READS_PER_MINUTE)
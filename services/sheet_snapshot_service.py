@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Налаштування логування
+logger = logging.getLogger('sheet_snapshot_service')
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Каталог і розмір локального сховища знімків аркушів
+SHEET_SNAPSHOT_DIR = os.getenv("SHEET_SNAPSHOT_DIR", os.path.join(PROJECT_ROOT, "cache"))
+SHEET_SNAPSHOT_MAX_MB = float(os.getenv("SHEET_SNAPSHOT_MAX_MB", "200"))
+# Дозволити використання знімка будь-якої ревізії, якщо завантажити аркуш не вдалося (офлайн-імпорт)
+SHEET_SNAPSHOT_OFFLINE = os.getenv("SHEET_SNAPSHOT_OFFLINE", "0") == "1"
+
+
+class SheetSnapshotService:
+    """
+    Локальне сховище знімків значень аркушів Google Sheets.
+
+    Знімок - стиснений (zlib) JSON зі значеннями аркуша у форматі get_all_values(),
+    ключ - (ID документа, ID аркуша, ревізія документа). Для кожного аркуша
+    зберігається лише останній знімок. Загальний розмір сховища обмежений:
+    при перевищенні видаляються знімки, до яких давно не зверталися (LRU).
+
+    Args:
+        directory: каталог для файлу SQLite
+        max_bytes: максимальний сумарний розмір стиснених знімків
+    """
+
+    def __init__(self, directory=SHEET_SNAPSHOT_DIR, max_bytes=int(SHEET_SNAPSHOT_MAX_MB * 1024 * 1024)):
+        self.path = os.path.join(directory, "sheet_snapshots.sqlite3")
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0, "bytes_read": 0}
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        if not self._initialized:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS snapshots (
+                    spreadsheet_id TEXT NOT NULL,
+                    worksheet_id INTEGER NOT NULL,
+                    revision TEXT NOT NULL,
+                    title TEXT,
+                    data BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    PRIMARY KEY (spreadsheet_id, worksheet_id)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_snapshots_last_access ON snapshots (last_access)")
+            conn.commit()
+            self._initialized = True
+        return conn
+
+    def get(self, spreadsheet_id, worksheet_id, revision=None):
+        """
+        Повертає значення аркуша зі знімка.
+
+        Args:
+            revision: ревізія документа; None - знімок будь-якої ревізії (офлайн-режим)
+
+        Returns:
+            list: рядки аркуша або None, якщо відповідного знімка немає
+        """
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                conn = self._connect()
+                try:
+                    if revision is None:
+                        row = conn.execute(
+                            "SELECT data FROM snapshots WHERE spreadsheet_id = ? AND worksheet_id = ?",
+                            (spreadsheet_id, worksheet_id)
+                        ).fetchone()
+                    else:
+                        row = conn.execute(
+                            "SELECT data FROM snapshots WHERE spreadsheet_id = ? AND worksheet_id = ? AND revision = ?",
+                            (spreadsheet_id, worksheet_id, revision)
+                        ).fetchone()
+                    if row is None:
+                        self._stats["misses"] += 1
+                        return None
+                    conn.execute(
+                        "UPDATE snapshots SET last_access = ? WHERE spreadsheet_id = ? AND worksheet_id = ?",
+                        (time.time(), spreadsheet_id, worksheet_id)
+                    )
+                    conn.commit()
+                finally:
+                    conn.close()
+                values = json.loads(zlib.decompress(row[0]).decode("utf-8"))
+            except (sqlite3.Error, OSError, zlib.error, ValueError) as e:
+                logger.warning(f"Помилка читання знімка аркуша {spreadsheet_id}/{worksheet_id}: {e}")
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            self._stats["bytes_read"] += len(row[0])
+            return values
+
+    def put(self, spreadsheet_id, worksheet_id, revision, values, title=None):
+        """Зберігає (замінює) знімок аркуша і за потреби звільняє місце (LRU)."""
+        if revision is None:
+            return
+        data = zlib.compress(json.dumps(values, ensure_ascii=False).encode("utf-8"))
+        if len(data) > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                conn = self._connect()
+                try:
+                    conn.execute("""
+                        INSERT OR REPLACE INTO snapshots
+                            (spreadsheet_id, worksheet_id, revision, title, data, size, created_at, last_access)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """, (spreadsheet_id, worksheet_id, revision, title, data, len(data), now, now))
+                    self._stats["stored"] += 1
+                    self._evict(conn)
+                    conn.commit()
+                finally:
+                    conn.close()
+            except (sqlite3.Error, OSError) as e:
+                logger.warning(f"Помилка збереження знімка аркуша {title or worksheet_id}: {e}")
+
+    def _evict(self, conn):
+        """Видаляє найдавніше використані знімки, поки розмір сховища перевищує ліміт."""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM snapshots").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for spreadsheet_id, worksheet_id, size in conn.execute(
+            "SELECT spreadsheet_id, worksheet_id, size FROM snapshots ORDER BY last_access"
+        ).fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute(
+                "DELETE FROM snapshots WHERE spreadsheet_id = ? AND worksheet_id = ?",
+                (spreadsheet_id, worksheet_id)
+            )
+            total -= size
+            self._stats["evicted"] += 1
+
+    def stats(self):
+        """
+        Статистика сховища.
+
+        Returns:
+            dict: влучання/промахи, збережені та витіснені знімки, прочитані байти
+        """
+        with self._lock:
+            return dict(self._stats)
+
+    def reset_stats(self):
+        with self._lock:
+            for key in self._stats:
+                self._stats[key] = 0
+
+
+# Створюємо глобальний екземпляр сховища
+sheet_snapshot_service = SheetSnapshotService()
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Спільний обмежений пул з'єднань з PostgreSQL для скриптів парсингу.
+
+Скрипти парсингу відкривали нове з'єднання (TCP + автентифікація) на кожен
+рядок аркуша. Пул тримає кілька відкритих з'єднань і видає їх повторно:
+- checkout()/checkin() - явне отримання та повернення з'єднання;
+- conn.close() для з'єднання з пулу повертає його в пул, а не закриває,
+  тому старий код з `conn.close()` працює без змін;
+- перевірка "здоров'я" з'єднання перед видачею (закриті/обірвані замінюються);
+- stats() - статистика використання пулу.
+"""
+
+import threading
+import time
+import logging
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+from psycopg2 import pool as pg_pool
+
+logger = logging.getLogger(__name__)
+
+# Стан з'єднання відносно пулу
+POOL_STATE_CHECKED_OUT = "checked_out"
+POOL_STATE_IDLE = "idle"
+
+
+class PooledConnection(psycopg2.extensions.connection):
+    """
+    З'єднання psycopg2, яке при close() повертається у свій пул.
+
+    Поза пулом (або коли пул сам закриває з'єднання) поводиться як звичайне.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool_manager = None
+        self._pool_state = None
+        self._pool_last_used = time.monotonic()
+
+    def close(self):
+        if self._pool_state == POOL_STATE_CHECKED_OUT and self._pool_manager is not None:
+            self._pool_manager.checkin(self)
+        elif self._pool_state == POOL_STATE_IDLE:
+            # З'єднання вже повернуто в пул (повторний close()) - нічого не робимо
+            return
+        else:
+            super().close()
+
+    def _close_physically(self):
+        """Справжнє закриття з'єднання (використовується лише пулом)."""
+        self._pool_state = None
+        self._pool_manager = None
+        if not self.closed:
+            super().close()
+
+
+class PooledConnectionManager:
+    """
+    Обмежений потокобезпечний пул з'єднань з семантикою checkout/checkin.
+
+    Args:
+        minconn: кількість з'єднань, що тримаються відкритими
+        maxconn: максимальна кількість одночасно виданих з'єднань
+        checkout_timeout: скільки секунд чекати вільне з'єднання
+        healthcheck_interval: після скількох секунд простою перевіряти з'єднання запитом
+        connect_kwargs: параметри для psycopg2.connect
+    """
+
+    def __init__(self, minconn=1, maxconn=8, checkout_timeout=30.0,
+                 healthcheck_interval=30.0, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.checkout_timeout = checkout_timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.connect_kwargs = connect_kwargs
+
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._stats = {
+            "checkouts": 0,
+            "checkins": 0,
+            "connections_created": 0,
+            "connections_discarded": 0,
+            "healthcheck_failures": 0,
+            "checkout_waits": 0,
+            "checkout_wait_seconds": 0.0,
+            "checkout_timeouts": 0,
+            "in_use": 0,
+        }
+
+    def configure(self, **connect_kwargs):
+        """
+        Змінює параметри підключення. Відкриті з'єднання закриваються,
+        нові будуть створені з новими параметрами.
+        """
+        self.close_all()
+        self.connect_kwargs.update(connect_kwargs)
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                kwargs = dict(self.connect_kwargs)
+                kwargs.setdefault("connection_factory", PooledConnection)
+                self._pool = pg_pool.ThreadedConnectionPool(self.minconn, self.maxconn, **kwargs)
+            return self._pool
+
+    def _discard(self, pool, conn):
+        conn._close_physically()
+        try:
+            pool.putconn(conn, close=True)
+        except pg_pool.PoolError:
+            pass
+        with self._lock:
+            self._stats["connections_discarded"] += 1
+
+    def _is_healthy(self, conn):
+        if conn.closed:
+            return False
+        if time.monotonic() - conn._pool_last_used < self.healthcheck_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            with self._lock:
+                self._stats["healthcheck_failures"] += 1
+            return False
+
+    def checkout(self, isolation_level=None, readonly=False, autocommit=False):
+        """
+        Видає з'єднання з пулу.
+
+        Args:
+            isolation_level: рівень ізоляції psycopg2.extensions.ISOLATION_LEVEL_*
+            readonly: якщо True, сесія лише для читання
+            autocommit: режим автокоміту
+
+        Returns:
+            З'єднання або None, якщо підключитися не вдалося.
+        """
+        started = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self._stats["checkout_waits"] += 1
+            if not self._slots.acquire(timeout=self.checkout_timeout):
+                with self._lock:
+                    self._stats["checkout_timeouts"] += 1
+                logger.error(f"Пул з'єднань вичерпано: немає вільного з'єднання за {self.checkout_timeout} сек")
+                return None
+            with self._lock:
+                self._stats["checkout_wait_seconds"] += time.monotonic() - started
+
+        try:
+            pool = self._get_pool()
+            conn = None
+            # Кількість спроб обмежена розміром пулу: кожна невдала перевірка
+            # прибирає одне "мертве" з'єднання
+            for _ in range(self.maxconn + 1):
+                conn = pool.getconn()
+                if conn._pool_state is None:
+                    with self._lock:
+                        self._stats["connections_created"] += 1
+                if self._is_healthy(conn):
+                    break
+                logger.warning("З'єднання з пулу непрацездатне, створюємо нове")
+                self._discard(pool, conn)
+                conn = None
+            if conn is None:
+                raise psycopg2.OperationalError("Не вдалося отримати робоче з'єднання з пулу")
+
+            if isolation_level is not None:
+                conn.set_isolation_level(isolation_level)
+            if readonly or autocommit:
+                conn.set_session(readonly=readonly or None, autocommit=autocommit or None)
+            conn._pool_manager = self
+            conn._pool_state = POOL_STATE_CHECKED_OUT
+            with self._lock:
+                self._stats["checkouts"] += 1
+                self._stats["in_use"] += 1
+            return conn
+        except psycopg2.Error as e:
+            self._slots.release()
+            logger.error(f"Помилка отримання з'єднання з пулу: {e}")
+            return None
+
+    def checkin(self, conn):
+        """Повертає з'єднання в пул, скидаючи незавершену транзакцію та параметри сесії."""
+        if conn._pool_state != POOL_STATE_CHECKED_OUT:
+            return
+        with self._lock:
+            pool = self._pool
+        conn._pool_state = POOL_STATE_IDLE
+        conn._pool_manager = None
+        try:
+            if pool is None:
+                # Пул закрито, поки з'єднання було видане
+                conn._close_physically()
+            elif conn.closed:
+                self._discard(pool, conn)
+            else:
+                try:
+                    # reset() відкочує транзакцію і повертає параметри сесії до типових
+                    conn.reset()
+                    conn._pool_last_used = time.monotonic()
+                    pool.putconn(conn)
+                except psycopg2.Error:
+                    self._discard(pool, conn)
+        finally:
+            with self._lock:
+                self._stats["checkins"] += 1
+                self._stats["in_use"] -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, isolation_level=None, readonly=False, autocommit=False):
+        """Контекстний менеджер: видає з'єднання і гарантовано повертає його в пул."""
+        conn = self.checkout(isolation_level, readonly, autocommit)
+        try:
+            yield conn
+        finally:
+            if conn is not None:
+                conn.close()
+
+    def stats(self):
+        """
+        Повертає статистику пулу.
+
+        Returns:
+            dict: лічильники видач/повернень, створених і відкинутих з'єднань,
+            очікувань вільного з'єднання, а також поточну кількість зайнятих і вільних.
+        """
+        with self._lock:
+            result = dict(self._stats)
+            result["idle"] = len(self._pool._pool) if self._pool is not None else 0
+        result["maxconn"] = self.maxconn
+        return result
+
+    def close_all(self):
+        """Закриває всі вільні з'єднання пулу (наприклад, при завершенні програми)."""
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool is None:
+            return
+        for conn in list(pool._pool):
+            conn._close_physically()
+        try:
+            pool.closeall()
+        except pg_pool.PoolError:
+            pass
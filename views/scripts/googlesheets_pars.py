@@ -1,16 +1,32 @@
 import os
+import io
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import psycopg2
+from psycopg2 import sql
 import logging
 import time
+import argparse
 import re
 import subprocess
 import sys
-from datetime import datetime
+from datetime import datetime, date
 import pycountry
 from dotenv import load_dotenv
 
+try:
+    from services.rate_limiter import sheets_rate_limiter
+    from services.google_sheets_service import google_sheets_service
+except ImportError:  # запуск як окремого скрипта: додаємо корінь проекту в шлях
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    from services.rate_limiter import sheets_rate_limiter
+    from services.google_sheets_service import google_sheets_service
+
+try:
+    from .query_stats import query_stats, InstrumentedConnection
+except ImportError:  # запуск як окремого скрипта
+    from query_stats import query_stats, InstrumentedConnection
+
 load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
@@ -27,6 +43,17 @@ SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 GOOGLE_SHEETS_CREDENTIALS_FILE = os.path.join(SCRIPT_DIR, GOOGLE_SHEETS_JSON_KEY)
 SPREADSHEET_NAME = os.getenv("GOOGLE_SHEETS_DOCUMENT_NAME")
 
+# Об'єднання/перейменування товарів після імпорту:
+# all - усі товари, touched - лише групи номерів, нових, оновлених або видалених у цьому імпорті
+PRODUCTS_MERGE_SCOPE = os.getenv("PRODUCTS_MERGE_SCOPE", "all")
+
+# Видалення товарів, відсутніх у таблицях: розмір пакета (коміт після кожного)
+PRODUCTS_DELETE_BATCH = int(os.getenv("PRODUCTS_DELETE_BATCH", "5000"))
+# PRODUCTS_DELETE_DRY_RUN=1 (або --dry-run-delete) - лише звіт, без видалення товарів і merge/rename
+PRODUCTS_DELETE_DRY_RUN = os.getenv("PRODUCTS_DELETE_DRY_RUN", "0") == "1"
+# Скільки номерів показувати у звіті
+PRODUCTS_DELETE_SAMPLE = 20
+
 
 def get_google_sheet_client():
    """Повертає авторизований клієнт Google Sheets."""
@@ -49,7 +76,8 @@ def connect_to_db():
            port=DB_PORT,
            database=DB_NAME,
            user=DB_USER,
-           password=DB_PASSWORD
+           password=DB_PASSWORD,
+           connection_factory=InstrumentedConnection
        )
    except psycopg2.Error as e:
        logger.error(f"Помилка підключення до бази даних: {e}")
@@ -439,6 +467,21 @@ def migrate_add_quantity_column(conn):
            logger.debug("Колонка 'quantity' уже існує, пропускаємо.")
 
 
+# Індекс для перевірок "чи використовується товар у замовленнях"
+# (ім'я збігається з index=True у моделі OrderDetails)
+ORDER_DETAILS_PRODUCT_INDEX = "ix_order_details_product_id"
+
+# Суфікс у дужках у кінці номера: "ABC123 (2)", "ABC123(old)"
+OLD_SUFFIX_SQL = r"\(\s*[^)]+\s*\)\s*$"
+
+
+def migrate_add_order_details_product_index(conn):
+   with conn.cursor() as cur:
+       cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON order_details (product_id)").format(
+           sql.Identifier(ORDER_DETAILS_PRODUCT_INDEX)))
+       conn.commit()
+
+
 def remove_old_suffix_duplicates(conn):
    """
    Тепер видаляємо записи, де productnumber відповідає шаблону:
@@ -446,49 +489,40 @@ def remove_old_suffix_duplicates(conn):
      - всередині — будь-які символи (крім закриваючої дужки), у т.ч. цифри, літери, пробіли,
      - закрита дужка, потім ідуть лише пробіли/кінець рядка.
    НО! Якщо товар використовується у order_details, ми не видаляємо, щоби не лягла цілісність.
-   """
-
-   with conn.cursor() as cur:
-       logger.info("Шукаємо товари з дужками у productnumber ...")
-
-       # 1) Вибираємо ID всіх таких товарів
-       #    (не робимо DELETE відразу, щоб перевірити зв'язки)
-       cur.execute("""
-           SELECT p.id
-           FROM products p
-           WHERE p.productnumber ~ E'\\(\\s*[^)]+\\s*\\)\\s*$'
-       """)
-       candidate_ids = [row[0] for row in cur.fetchall()]
-
-       if not candidate_ids:
-           logger.info("Немає жодного кандидата з суфіксом (..).")
-           return
 
-       logger.info(f"Знайдено {len(candidate_ids)} товар(ів), які закінчуються на (..). Перевіряємо зв'язки ...")
+   Пошук кандидатів, перевірка зв'язків (anti-join по order_details) і видалення -
+   один запит.
 
-       # 2) Перевіряємо, чи використовується товар у order_details
-       #    Якщо так - пропускаємо видалення
-       to_delete = []
-       for pid in candidate_ids:
-           # Перевірка
-           cur.execute("SELECT COUNT(*) FROM order_details WHERE product_id=%s", (pid,))
-           ref_count = cur.fetchone()[0]
-           if ref_count == 0:
-               to_delete.append(pid)
-
-       if not to_delete:
-           logger.info("Усі знайдені товари з (..) використовуються у замовленнях => не видаляємо їх.")
-           return
+   Returns:
+      tuple: (кількість кандидатів, кількість видалених)
+   """
 
-       logger.info(f"Видаляємо {len(to_delete)} товар(ів), що не використовуються ...")
+   with conn.cursor() as cur:
+       logger.info("Шукаємо та видаляємо товари з дужками у productnumber ...")
        cur.execute("""
-           DELETE FROM products
-           WHERE id = ANY(%s)
-       """, (to_delete,))
-       del_count = cur.rowcount
-       logger.info(f"Вилучено {del_count} товарів з '(..)' (не використовувались).")
+           WITH candidates AS (
+               SELECT p.id
+                 FROM products p
+                WHERE p.productnumber ~ %s
+           ), deleted AS (
+               DELETE FROM products p
+                WHERE p.id IN (SELECT id FROM candidates)
+                  AND NOT EXISTS (SELECT 1 FROM order_details od WHERE od.product_id = p.id)
+               RETURNING p.id
+           )
+           SELECT (SELECT count(*) FROM candidates), (SELECT count(*) FROM deleted)
+       """, (OLD_SUFFIX_SQL,))
+       candidates_count, del_count = cur.fetchone()
        conn.commit()
 
+   if not candidates_count:
+       logger.info("Немає жодного кандидата з суфіксом (..).")
+   else:
+       logger.info(f"Знайдено {candidates_count} товар(ів), які закінчуються на (..): "
+                   f"вилучено {del_count} (не використовувались), "
+                   f"залишено {candidates_count - del_count} (використовуються у замовленнях).")
+   return candidates_count, del_count
+
 
 def is_rostovka(existing_row, new_data):
    rid, rpn, rbrand, rtype, rsubtype, rmodel, rmarking = existing_row
@@ -592,126 +626,394 @@ def insert_or_update_product(cursor, p_data, conn):
        conn.commit()
 
 
-def merge_similar_products(conn):
-   with conn.cursor() as cursor:
-       cursor.execute("""
-           SELECT
-               id,
-               productnumber,
-               COALESCE(typeid,0),
-               COALESCE(subtypeid,0),
-               COALESCE(brandid,0),
-               COALESCE(genderid,0),
-               COALESCE(colorid,0),
-               LOWER(COALESCE(model,'')),
-               LOWER(COALESCE(marking,'')),
-               COALESCE(year,0),
-               LOWER(COALESCE(description,'')),
-               LOWER(COALESCE(sizeeu,'')),
-               LOWER(COALESCE(measurementscm,'')),
-               dateadded
-           FROM products
-       """)
-       rows = cursor.fetchall()
-
-       from collections import defaultdict
-       groups = defaultdict(list)
-       for r in rows:
-           rid, rpn, rtp, rst, rbr, rgd, rcl, rmd, rmk, ryr, rds, rsz, rms, rdate = r
-           basepn = re.sub(r"\(\d+\)$", "", rpn).strip()
-           groups[basepn].append(r)
-
-       def are_same(i1, i2):
-           (_, pn1, tp1, st1, b1, g1, c1, md1, mk1, yr1, ds1, sz1, ms1, _) = i1
-           (_, pn2, tp2, st2, b2, g2, c2, md2, mk2, yr2, ds2, sz2, ms2, __) = i2
-           return fully_identical_for_merge(
-               tp1, tp2, st1, st2, b1, b2, g1, g2, c1, c2,
-               md1, md2, mk1, mk2, yr1, yr2, ds1, ds2,
-               sz1, sz2, ms1, ms2
-           )
+# Колонки, за якими товар вважається тим самим (див. same_item_check)
+PRODUCT_MATCH_COLUMNS = (
+   'typeid', 'subtypeid', 'brandid', 'genderid', 'colorid',
+   'model', 'marking', 'year', 'description', 'sizeeu', 'measurementscm'
+)
 
-       for base, items in groups.items():
-           if len(items) < 2:
-               it = items[0]
-               _id, _pn = it[0], it[1]
-               new_ = re.sub(r"\(\d+\)$", "", _pn).strip()
-               if new_ != _pn:
-                   logger.info(f"[merge] Один => {_pn} => {new_}")
-                   cursor.execute("UPDATE products SET productnumber=%s WHERE id=%s", (new_, _id))
-               continue
+# Ключі p_data з назвами довідників для перевірки ростовки (не колонки products)
+PRODUCT_ROSTOVKA_KEYS = ('_b_name', '_t_name', '_st_name')
 
-           no_sfx = [xx for xx in items if not re.search(r"\(\d+\)$", xx[1])]
-           if no_sfx:
-               main_it = no_sfx[0]
-           else:
-               sfx_sorted = sorted(
-                   items,
-                   key=lambda x: int(re.search(r"\((\d+)\)$", x[1]).group(1))
-                   if re.search(r"\((\d+)\)$", x[1])
-                   else 9999
+
+def _copy_text_value(value):
+   """Значення для COPY ... FROM STDIN у текстовому форматі."""
+   if value is None:
+       return "\\N"
+   if isinstance(value, bool):
+       return "t" if value else "f"
+   if isinstance(value, (datetime, date)):
+       value = value.isoformat()
+   return (str(value).replace("\\", "\\\\").replace("\t", "\\t")
+           .replace("\n", "\\n").replace("\r", "\\r"))
+
+
+def bulk_load_products(conn, products, new_numbers=None):
+   """
+   Пакетний запис товарів аркуша з тією ж логікою, що й insert_or_update_product.
+
+   1) Усі товари потрапляють у тимчасову таблицю products_stage одним COPY.
+   2) Рядки класифікуються запитами над products_stage:
+      - insert   - перший рядок нового номера;
+      - rostovka - рядок, схожий (>= 3 ознак) на існуючий товар або на перший
+        рядок того ж номера: збільшує quantity;
+      - update   - перший рядок існуючого номера, повністю ідентичний товару;
+      - fallback - решта (потрібен суфікс номера тощо).
+   3) insert і update застосовуються одним INSERT ... ON CONFLICT (productnumber)
+      DO UPDATE, ростовки - одним UPDATE з кількістю по номеру.
+   4) Рядки fallback записуються по одному через insert_or_update_product
+      у порядку аркуша.
+
+   Args:
+      conn: з'єднання з БД
+      products: список p_data (колонки products + ключі PRODUCT_ROSTOVKA_KEYS)
+      new_numbers: множина, до якої додаються номери нових, оновлених (могли змінитися
+         ознаки для merge) і записаних по одному (можуть отримати суфікс) товарів
+
+   Returns:
+      dict: кількість рядків за діями insert, update, rostovka, fallback
+   """
+   result = {"insert": 0, "update": 0, "rostovka": 0, "fallback": 0}
+   if not products:
+       return result
+
+   columns = list(PRODUCT_MATCH_COLUMNS)
+   for p_data in products:
+       for key in p_data:
+           if key not in columns and key != 'productnumber' and not key.startswith('_'):
+               columns.append(key)
+   columns.insert(0, 'productnumber')
+   col_list = sql.SQL(', ').join(map(sql.Identifier, columns))
+
+   buffer = io.StringIO()
+   for seq, p_data in enumerate(products):
+       values = [seq] + [p_data.get(col) for col in columns] + [p_data.get(key) for key in PRODUCT_ROSTOVKA_KEYS]
+       buffer.write("\t".join(_copy_text_value(v) for v in values) + "\n")
+   buffer.seek(0)
+
+   similarity = """
+       (COALESCE((t.b_name <> '' AND t.b_name = lower(trim(s.b_name)))::int, 0)
+      + COALESCE((t.t_name <> '' AND t.t_name = lower(trim(s.t_name)))::int, 0)
+      + COALESCE((t.st_name <> '' AND t.st_name = lower(trim(s.st_name)))::int, 0)
+      + COALESCE((t.model <> '' AND t.model = lower(trim(s.model)))::int, 0)
+      + COALESCE((t.marking <> '' AND t.marking = lower(trim(s.marking)))::int, 0)) >= 3
+   """
+
+   with conn.cursor() as cur:
+       try:
+           cur.execute(sql.SQL("""
+               CREATE TEMP TABLE products_stage ON COMMIT DROP AS
+               SELECT NULL::integer AS seq, {cols},
+                      NULL::text AS b_name, NULL::text AS t_name, NULL::text AS st_name,
+                      NULL::text AS action
+                 FROM products
+               WITH NO DATA
+           """).format(cols=col_list))
+           cur.copy_expert(sql.SQL("COPY products_stage (seq, {cols}, b_name, t_name, st_name) FROM STDIN").format(
+               cols=col_list).as_string(conn), buffer)
+           cur.execute("ANALYZE products_stage")
+
+           # Перший рядок кожного нового номера
+           cur.execute("""
+               UPDATE products_stage s
+                  SET action = 'insert'
+                 FROM (
+                   SELECT DISTINCT ON (productnumber) seq
+                     FROM products_stage st
+                    WHERE NOT EXISTS (SELECT 1 FROM products p WHERE p.productnumber = st.productnumber)
+                    ORDER BY productnumber, seq
+                 ) h
+                WHERE s.seq = h.seq
+           """)
+
+           # Ростовка: схожість з існуючим товаром або з першим рядком нового номера
+           cur.execute(f"""
+               WITH target AS (
+                   SELECT x.productnumber,
+                          lower(COALESCE(b.brandname, '')) AS b_name,
+                          lower(COALESCE(tp.typename, '')) AS t_name,
+                          lower(COALESCE(st.subtypename, '')) AS st_name,
+                          lower(COALESCE(x.model, '')) AS model,
+                          lower(COALESCE(x.marking, '')) AS marking
+                     FROM (
+                       SELECT productnumber, brandid, typeid, subtypeid, model, marking
+                         FROM products
+                        WHERE productnumber IN (SELECT productnumber FROM products_stage)
+                       UNION ALL
+                       SELECT productnumber, brandid, typeid, subtypeid, model, marking
+                         FROM products_stage
+                        WHERE action = 'insert'
+                     ) x
+                     LEFT JOIN brands b ON b.id = x.brandid
+                     LEFT JOIN types tp ON tp.id = x.typeid
+                     LEFT JOIN subtypes st ON st.id = x.subtypeid
                )
-               main_it = sfx_sorted[0]
+               UPDATE products_stage s
+                  SET action = 'rostovka'
+                WHERE s.action IS NULL
+                  AND EXISTS (SELECT 1 FROM target t WHERE t.productnumber = s.productnumber AND {similarity})
+           """)
 
-           mid, mpn = main_it[0], main_it[1]
-           for x2 in items:
-               if x2[0] == mid:
-                   continue
-               if are_same(main_it, x2):
-                   logger.info(f"[merge] дубль {x2[1]} => {mpn}")
-                   cursor.execute("DELETE FROM products WHERE id=%s", (x2[0],))
+           # Перший із решти рядків існуючого номера, повністю ідентичний товару
+           cur.execute("""
+               UPDATE products_stage s
+                  SET action = 'update'
+                 FROM products p
+                WHERE s.action IS NULL
+                  AND p.productnumber = s.productnumber
+                  AND s.seq = (SELECT min(s2.seq) FROM products_stage s2
+                                WHERE s2.productnumber = s.productnumber AND s2.action IS NULL)
+                  AND COALESCE(s.typeid, 0) = COALESCE(p.typeid, 0)
+                  AND COALESCE(s.subtypeid, 0) = COALESCE(p.subtypeid, 0)
+                  AND COALESCE(s.brandid, 0) = COALESCE(p.brandid, 0)
+                  AND COALESCE(s.genderid, 0) = COALESCE(p.genderid, 0)
+                  AND COALESCE(s.colorid, 0) = COALESCE(p.colorid, 0)
+                  AND COALESCE(s.year, 0) = COALESCE(p.year, 0)
+                  AND lower(trim(COALESCE(s.model, ''))) = lower(trim(COALESCE(p.model, '')))
+                  AND lower(trim(COALESCE(s.marking, ''))) = lower(trim(COALESCE(p.marking, '')))
+                  AND lower(trim(COALESCE(s.description, ''))) = lower(trim(COALESCE(p.description, '')))
+                  AND (trim(COALESCE(s.sizeeu, '')) = '' OR trim(COALESCE(p.sizeeu, '')) = ''
+                       OR lower(trim(s.sizeeu)) = lower(trim(p.sizeeu)))
+                  AND (trim(COALESCE(s.measurementscm, '')) = '' OR trim(COALESCE(p.measurementscm, '')) = ''
+                       OR lower(trim(s.measurementscm)) = lower(trim(p.measurementscm)))
+           """)
+           cur.execute("UPDATE products_stage SET action = 'fallback' WHERE action IS NULL")
+
+           # Нові товари і повні збіги - одним INSERT ... ON CONFLICT
+           update_cols = [col for col in columns if col != 'productnumber']
+           cur.execute(sql.SQL("""
+               INSERT INTO products ({cols})
+               SELECT {cols}
+                 FROM products_stage
+                WHERE action IN ('insert', 'update')
+                ORDER BY seq
+               ON CONFLICT (productnumber) DO UPDATE SET {updates}
+           """).format(
+               cols=col_list,
+               updates=sql.SQL(', ').join(
+                   sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(col)) for col in update_cols
+               )
+           ))
 
-           new_m = re.sub(r"\(\d+\)$", "", mpn).strip()
-           if new_m != mpn:
-               logger.info(f"[merge] Головн. {mpn} => {new_m}")
-               cursor.execute("UPDATE products SET productnumber=%s WHERE id=%s", (new_m, mid))
+           # Ростовки - кількість по номеру
+           cur.execute("""
+               UPDATE products p
+                  SET quantity = p.quantity + r.cnt,
+                      updated_at = now()
+                 FROM (
+                   SELECT productnumber, count(*) AS cnt
+                     FROM products_stage
+                    WHERE action = 'rostovka'
+                    GROUP BY productnumber
+                 ) r
+                WHERE p.productnumber = r.productnumber
+           """)
 
-   conn.commit()
+           cur.execute("""
+               SELECT action, array_agg(seq ORDER BY seq), array_agg(DISTINCT productnumber)
+                 FROM products_stage
+                GROUP BY action
+           """)
+           fallback_seqs = []
+           for action, seqs, numbers in cur.fetchall():
+               result[action] = len(seqs)
+               if action == 'fallback':
+                   fallback_seqs = seqs
+               if new_numbers is not None and action in ('insert', 'update', 'fallback'):
+                   new_numbers.update(numbers)
+           conn.commit()
+       except psycopg2.Error as e:
+           conn.rollback()
+           logger.warning(f"Помилка пакетного запису товарів, записуємо по одному: {e}")
+           result = {"insert": 0, "update": 0, "rostovka": 0, "fallback": len(products)}
+           fallback_seqs = range(len(products))
+           if new_numbers is not None:
+               new_numbers.update(p_data['productnumber'] for p_data in products)
+
+       for seq in fallback_seqs:
+           p_data = dict(products[seq])
+           try:
+               insert_or_update_product(cur, p_data, conn)
+           except psycopg2.Error as e:
+               conn.rollback()
+               logger.error(f"Помилка запису товару '{p_data.get('productnumber')}': {e}")
+
+   return result
+
+
+# Суфікс номера товару: "ABC123(2)" -> база "ABC123"
+PRODUCT_SUFFIX_RE = re.compile(r"\(\d+\)$")
+PRODUCT_SUFFIX_SQL = r"\(\d+\)$"
+PRODUCT_SUFFIX_NUMBER_SQL = r"\((\d+)\)$"
+
+
+def product_base_number(product_number):
+   """Номер товару без суфікса "(N)"."""
+   return PRODUCT_SUFFIX_RE.sub("", product_number or "").strip()
+
+
+def _create_product_groups(cursor, base_numbers=None):
+   """
+   Тимчасова таблиця products_groups: товари з базовим номером (без суфікса "(N)")
+   і числом суфікса. base_numbers обмежує вибірку групами з цими базами.
+   """
+   cursor.execute("DROP TABLE IF EXISTS products_groups")
+   scope = sql.SQL("")
+   params = {"suffix": PRODUCT_SUFFIX_SQL, "suffix_number": PRODUCT_SUFFIX_NUMBER_SQL}
+   if base_numbers is not None:
+       scope = sql.SQL("WHERE trim(regexp_replace(productnumber, %(suffix)s, '')) = ANY(%(bases)s)")
+       params["bases"] = list(base_numbers)
+   cursor.execute(sql.SQL("""
+       CREATE TEMP TABLE products_groups ON COMMIT DROP AS
+       SELECT id,
+              productnumber,
+              trim(regexp_replace(productnumber, %(suffix)s, '')) AS base,
+              substring(productnumber FROM %(suffix_number)s)::numeric AS suffix,
+              dateadded
+         FROM products
+       {scope}
+   """).format(scope=scope), params)
+   cursor.execute("CREATE INDEX ON products_groups (base)")
+   cursor.execute("ANALYZE products_groups")
+
+
+def _apply_product_renames(cursor):
+   """
+   Перейменування з тимчасової таблиці products_rename (id, new_number) двома UPDATE:
+   спершу тимчасові унікальні номери, потім нові - щоб обмін номерами
+   всередині групи не порушував унікальність productnumber.
 
+   Returns:
+      int: кількість перейменованих товарів
+   """
+   cursor.execute("""
+       UPDATE products p
+          SET productnumber = '__rename__' || p.id
+         FROM products_rename r
+        WHERE p.id = r.id
+   """)
+   cursor.execute("""
+       UPDATE products p
+          SET productnumber = r.new_number
+         FROM products_rename r
+        WHERE p.id = r.id
+   """)
+   return cursor.rowcount
+
+
+def merge_similar_products(conn, base_numbers=None):
+   """
+   Об'єднує товари з однаковим базовим номером.
 
-def rename_different_products_in_date_order(conn):
+   У кожній групі головний товар - без суфікса (або з найменшим суфіксом);
+   товари, ідентичні головному (fully_identical_for_merge), видаляються,
+   головний отримує базовий номер. Групування і порівняння виконуються
+   в SQL (regexp_replace + віконні функції), зміни - кількома запитами.
+
+   Args:
+      conn: з'єднання з БД
+      base_numbers: обробити лише групи з цими базовими номерами (None - усі)
+   """
    with conn.cursor() as cursor:
+       _create_product_groups(cursor, base_numbers)
+
+       # Головний товар групи: без суфікса, далі - за числом суфікса
        cursor.execute("""
-           SELECT id, productnumber, dateadded
-           FROM products
-           ORDER BY productnumber
+           CREATE TEMP TABLE products_merge ON COMMIT DROP AS
+           SELECT g.id,
+                  g.base,
+                  first_value(g.id) OVER (PARTITION BY g.base ORDER BY g.suffix NULLS FIRST, g.id) AS main_id,
+                  COALESCE(p.typeid, 0) AS typeid,
+                  COALESCE(p.subtypeid, 0) AS subtypeid,
+                  COALESCE(p.brandid, 0) AS brandid,
+                  COALESCE(p.genderid, 0) AS genderid,
+                  COALESCE(p.colorid, 0) AS colorid,
+                  COALESCE(p.year, 0) AS year,
+                  lower(trim(COALESCE(p.model, ''))) AS model,
+                  lower(trim(COALESCE(p.marking, ''))) AS marking,
+                  lower(trim(COALESCE(p.description, ''))) AS description,
+                  lower(trim(COALESCE(p.sizeeu, ''))) AS sizeeu,
+                  lower(trim(COALESCE(p.measurementscm, ''))) AS measurementscm
+             FROM products_groups g
+             JOIN products p ON p.id = g.id
        """)
-       rows = cursor.fetchall()
-
-       from collections import defaultdict
-       groups = defaultdict(list)
-       for r in rows:
-           rid, rpn, rdt = r
-           basepn = re.sub(r"\(\d+\)$", "", rpn).strip()
-           groups[basepn].append((rid, rpn, rdt))
-
-       for base, items in groups.items():
-           if len(items) < 2:
-               if len(items) == 1:
-                   only_id, only_pn, only_dt = items[0]
-                   corr = re.sub(r"\(\d+\)$", "", only_pn).strip()
-                   if corr != only_pn:
-                       logger.info(f"[rename] один => {only_pn} => {corr}")
-                       cursor.execute("UPDATE products SET productnumber=%s WHERE id=%s", (corr, only_id))
-               continue
 
-           sorted_by_date = sorted(items, key=lambda x: x[2] or datetime(1970, 1, 1))
-           n = len(sorted_by_date)
-           for i in range(n):
-               rid, rpnum, rdt = sorted_by_date[i]
-               if i == (n - 1):
-                   new_pn = base
-               else:
-                   new_pn = f"{base}({i + 1})"
+       # Дублі головного товару (ті самі умови, що у fully_identical_for_merge)
+       cursor.execute("""
+           DELETE FROM products p
+            USING products_merge d
+             JOIN products_merge m ON m.id = d.main_id
+            WHERE p.id = d.id
+              AND d.id <> d.main_id
+              AND d.typeid = m.typeid
+              AND d.subtypeid = m.subtypeid
+              AND d.brandid = m.brandid
+              AND d.genderid = m.genderid
+              AND d.colorid = m.colorid
+              AND d.model = m.model
+              AND d.marking = m.marking
+              AND d.year = m.year
+              AND d.description = m.description
+              AND (d.sizeeu = '' OR m.sizeeu = '' OR d.sizeeu = m.sizeeu)
+              AND (d.measurementscm = '' OR m.measurementscm = '' OR d.measurementscm = m.measurementscm)
+       """)
+       deleted = cursor.rowcount
+
+       # Головні товари отримують базовий номер
+       cursor.execute("""
+           CREATE TEMP TABLE products_rename ON COMMIT DROP AS
+           SELECT g.id, g.base AS new_number
+             FROM products_groups g
+             JOIN products_merge m ON m.id = g.id
+            WHERE m.id = m.main_id
+              AND g.productnumber <> g.base
+       """)
+       renamed = _apply_product_renames(cursor)
 
-               if new_pn != rpnum:
-                   logger.info(f"[rename] {rpnum} => {new_pn} (date={rdt})")
-                   cursor.execute("UPDATE products SET productnumber=%s WHERE id=%s", (new_pn, rid))
+   conn.commit()
+   logger.info(f"[merge] Видалено дублів: {deleted}, головних товарів перейменовано: {renamed}")
+
+
+def rename_different_products_in_date_order(conn, base_numbers=None):
+   """
+   Нумерує різні товари з однаковим базовим номером за датою додавання:
+   найновіший отримує базовий номер, решта - "база(1)", "база(2)"... від найстарішого.
+
+   Args:
+      conn: з'єднання з БД
+      base_numbers: обробити лише групи з цими базовими номерами (None - усі)
+   """
+   with conn.cursor() as cursor:
+       _create_product_groups(cursor, base_numbers)
+       cursor.execute("""
+           CREATE TEMP TABLE products_rename ON COMMIT DROP AS
+           SELECT id, new_number
+             FROM (
+               SELECT id,
+                      productnumber,
+                      CASE WHEN row_number() OVER w = count(*) OVER (PARTITION BY base)
+                           THEN base
+                           ELSE base || '(' || row_number() OVER w || ')'
+                      END AS new_number
+                 FROM products_groups
+               WINDOW w AS (PARTITION BY base
+                            ORDER BY COALESCE(dateadded, TIMESTAMP '1970-01-01'), productnumber)
+             ) numbered
+            WHERE new_number <> productnumber
+       """)
+       renamed = _apply_product_renames(cursor)
 
    conn.commit()
+   logger.info(f"[rename] Перейменовано товарів: {renamed}")
 
 
-def process_sheet_data(data, wtitle, all_product_numbers):
-   """Обробка даних з аркуша."""
+def process_sheet_data(data, wtitle, all_product_numbers, new_product_numbers=None):
+   """
+   Обробка даних з аркуша.
+
+   Номери усіх товарів аркуша додаються до all_product_numbers, номери нових,
+   оновлених і записаних по одному товарів - до new_product_numbers, якщо її передано.
+   """
    logger.info(f"=== Початок обробки аркуша: {wtitle} ===")
    conn = connect_to_db()
    if not conn:
@@ -793,20 +1095,154 @@ def process_sheet_data(data, wtitle, all_product_numbers):
            conn.rollback()
            continue
 
+   # Запис товарів аркуша: COPY у проміжну таблицю і кілька set-based запитів
+   # замість окремих SELECT/UPDATE/INSERT і коміту на кожен товар
+   load_stats = bulk_load_products(conn, rows_data, new_product_numbers)
+   logger.info(f"Аркуш '{wtitle}': нових {load_stats['insert']}, оновлених {load_stats['update']}, "
+               f"ростовок {load_stats['rostovka']}, записаних по одному {load_stats['fallback']}")
+
    logger.info(f"=== Завершено обробку аркуша '{wtitle}': оновлено {processed_items} товарів ===")
    cursor.close()
    conn.close()
 
 
-def merge_similar_products_and_rename():
+def delete_missing_products(conn, product_numbers, dry_run=False, batch_size=PRODUCTS_DELETE_BATCH):
+   """
+   Видаляє товари, номерів яких немає в жодному аркуші.
+
+   Номери з аркушів передаються COPY у тимчасову таблицю seen_products,
+   відсутні товари знаходяться anti-join'ом по унікальному індексу
+   productnumber і видаляються пакетами по batch_size з комітом після
+   кожного, щоб не тримати блокування на весь каталог. Товари, що
+   використовуються у order_details, не видаляються і потрапляють у звіт.
+
+   Args:
+      conn: з'єднання з БД
+      product_numbers: номери товарів, зчитані з аркушів
+      dry_run: лише звіт, без видалення
+
+   Returns:
+      dict: звіт (seen, missing, referenced, deleted, batches, приклади номерів)
+      і deleted_numbers - множина видалених номерів
+   """
+   started = time.monotonic()
+   report = {
+       "dry_run": dry_run,
+       "seen": len(product_numbers),
+       "missing": 0,
+       "referenced": 0,
+       "deleted": 0,
+       "batches": 0,
+       "failed_batches": 0,
+       "sample_missing": [],
+       "sample_referenced": [],
+   }
+   deleted_numbers = set()
+   batch_size = max(1, batch_size)
+
+   with conn.cursor() as cur:
+       buffer = io.StringIO("".join(_copy_text_value(pn) + "\n" for pn in product_numbers))
+       cur.execute("DROP TABLE IF EXISTS seen_products, missing_products")
+       cur.execute("CREATE TEMP TABLE seen_products (productnumber text PRIMARY KEY)")
+       cur.copy_expert("COPY seen_products (productnumber) FROM STDIN", buffer)
+       cur.execute("ANALYZE seen_products")
+
+       cur.execute("""
+           CREATE TEMP TABLE missing_products AS
+           SELECT p.id,
+                  p.productnumber,
+                  EXISTS (SELECT 1 FROM order_details od WHERE od.product_id = p.id) AS referenced
+             FROM products p
+            WHERE NOT EXISTS (SELECT 1 FROM seen_products s WHERE s.productnumber = p.productnumber)
+       """)
+       cur.execute("""
+           SELECT count(*),
+                  count(*) FILTER (WHERE referenced),
+                  (array_agg(productnumber ORDER BY productnumber) FILTER (WHERE NOT referenced))[1:%(sample)s],
+                  (array_agg(productnumber ORDER BY productnumber) FILTER (WHERE referenced))[1:%(sample)s]
+             FROM missing_products
+       """, {"sample": PRODUCTS_DELETE_SAMPLE})
+       missing, referenced, sample_missing, sample_referenced = cur.fetchone()
+       report.update({
+           "missing": missing,
+           "referenced": referenced,
+           "sample_missing": sample_missing or [],
+           "sample_referenced": sample_referenced or [],
+       })
+       conn.commit()
+
+       if not dry_run:
+           cur.execute("""
+               CREATE TEMP TABLE delete_batches AS
+               SELECT id, (row_number() OVER (ORDER BY id) - 1) / %s AS batch
+                 FROM missing_products
+                WHERE NOT referenced
+           """, (batch_size,))
+           cur.execute("CREATE INDEX ON delete_batches (batch)")
+           conn.commit()
+
+           batches = -(-(missing - referenced) // batch_size)
+           for batch in range(batches):
+               try:
+                   # Зв'язок перевіряється ще раз: замовлення могло з'явитися після підрахунку
+                   cur.execute("""
+                       DELETE FROM products p
+                        USING delete_batches b
+                        WHERE b.batch = %s
+                          AND p.id = b.id
+                          AND NOT EXISTS (SELECT 1 FROM order_details od WHERE od.product_id = p.id)
+                       RETURNING p.productnumber
+                   """, (batch,))
+                   numbers = [row[0] for row in cur.fetchall()]
+                   conn.commit()
+               except psycopg2.Error as e:
+                   conn.rollback()
+                   report["failed_batches"] += 1
+                   logger.error(f"Помилка видалення пакета {batch + 1}/{batches} відсутніх товарів: {e}")
+                   continue
+               deleted_numbers.update(numbers)
+               report["batches"] += 1
+               logger.debug(f"Пакет {batch + 1}/{batches}: видалено {len(numbers)} товарів")
+           report["deleted"] = len(deleted_numbers)
+
+       cur.execute("DROP TABLE IF EXISTS seen_products, missing_products, delete_batches")
+       conn.commit()
+
+   report["elapsed_seconds"] = round(time.monotonic() - started, 3)
+   if dry_run:
+       logger.info(f"[dry-run] Відсутніх у таблицях товарів: {report['missing']}, з них у замовленнях "
+                   f"{report['referenced']} (не видалялися б); приклади: {', '.join(report['sample_missing'])}")
+   else:
+       logger.info(f"Видалено {report['deleted']} товарів, які відсутні в таблицях "
+                   f"({report['batches']} пакетів, {report['elapsed_seconds']} сек); "
+                   f"залишено {report['referenced']} товарів, що використовуються у замовленнях")
+   if report["sample_referenced"]:
+       logger.info(f"Відсутні в таблицях, але є в замовленнях: {', '.join(report['sample_referenced'])}")
+   if report["failed_batches"]:
+       logger.warning(f"Не вдалося видалити {report['failed_batches']} пакетів відсутніх товарів")
+   report["deleted_numbers"] = deleted_numbers
+   return report
+
+
+def merge_similar_products_and_rename(base_numbers=None):
+   """
+   Об'єднання дублів і нумерація різних товарів з однаковим базовим номером.
+
+   Args:
+      base_numbers: базові номери груп для обробки (None - усі товари)
+   """
+   if base_numbers is not None and not base_numbers:
+       logger.info("merge/rename: немає змінених груп товарів")
+       return
+
    conn = connect_to_db()
    if not conn:
        logger.error("Не вдалося підключитися для merge/rename")
        return
 
    try:
-       merge_similar_products(conn)
-       rename_different_products_in_date_order(conn)
+       merge_similar_products(conn, base_numbers)
+       rename_different_products_in_date_order(conn, base_numbers)
    except Exception as e:
        logger.error(f"Помилка merge/rename: {e}")
        conn.rollback()
@@ -814,16 +1250,20 @@ def merge_similar_products_and_rename():
        conn.close()
 
 
-def import_data():
+def import_data(dry_run_delete=PRODUCTS_DELETE_DRY_RUN):
    """
    1) Додаємо колонку quantity (якщо нема).
    2) Видаляємо (м'яко) товари з суфіксом "...( )", які НЕ використовуються у order_details.
    3) Читаємо всі аркуші, парсимо (process_sheet_data).
-   4) Видаляємо товари, яких немає в табличках + '#' з малою кількістю полів.
+   4) Видаляємо товари, яких немає в табличках (delete_missing_products) + '#' з малою кількістю полів.
    5) merge_similar_products_and_rename()
    6) Запускаємо orders_pars.py
+
+   dry_run_delete - на кроці 4 лише звіт про відсутні та порожні товари, без видалення;
+   крок 5 пропускається.
    """
    logger.info("=== ПОЧАТОК ОНОВЛЕННЯ ТОВАРІВ ===")
+   query_stats.reset()
    
    conn_mig = connect_to_db()
    if not conn_mig:
@@ -832,6 +1272,7 @@ def import_data():
    try:
        logger.info("Перевірка та додавання колонки quantity...")
        migrate_add_quantity_column(conn_mig)
+       migrate_add_order_details_product_index(conn_mig)
        conn_mig.close()
        logger.info("Міграція quantity завершена")
    except Exception as e:
@@ -860,20 +1301,27 @@ def import_data():
 
    logger.info(f"Документ: {SPREADSHEET_NAME}")
    try:
-       doc = client.open(SPREADSHEET_NAME)
+       doc = sheets_rate_limiter.call(client.open, SPREADSHEET_NAME)
    except Exception as e:
        logger.error(f"Помилка відкриття Google Sheets: {e}")
        return
 
    ignore_sheets = ['Suppliers', 'Publications', 'New', 'Data']
-   sheet_list = doc.worksheets()
+   sheet_list = sheets_rate_limiter.call(doc.worksheets)
    all_product_numbers = set()
+   new_product_numbers = set()
    
    total_sheets = len(sheet_list)
    processed_sheets = 0
    
    logger.info(f"Отримано {total_sheets} аркушів для обробки")
 
+   # Дані аркушів отримуємо групами одним запитом values_batch_get на групу;
+   # якщо документ не змінювався, аркуші беруться з локальних знімків
+   revision = google_sheets_service.get_modified_time(doc)
+   chunks = google_sheets_service.chunk_worksheets([ws for ws in sheet_list if ws.title not in ignore_sheets])
+   batch_values = {}
+
    for ws in sheet_list:
        wtitle = ws.title
        processed_sheets += 1
@@ -884,16 +1332,27 @@ def import_data():
            continue
 
        logger.info(f"Обробка: {wtitle} ({processed_sheets}/{total_sheets}, {progress_percent}%)")
-       try:
-           logger.info(f"Отримання даних з аркуша {wtitle}...")
-           data = ws.get_all_values()
-           logger.info(f"Отримано {len(data)} рядків з аркуша {wtitle}")
-       except Exception as e:
-           logger.error(f"Помилка get_all_values {wtitle}: {e}")
-           continue
+       if wtitle not in batch_values:
+           chunk = next(chunks, [])
+           try:
+               logger.info(f"Пакетне отримання даних з {len(chunk)} аркушів...")
+               batch_values = google_sheets_service.fetch_all_values(
+                   chunk, revisions={chunk_ws.title: revision for chunk_ws in chunk})
+           except Exception as e:
+               logger.warning(f"Помилка пакетного отримання даних, отримуємо аркуші поодинці: {e}")
+               batch_values = {chunk_ws.title: None for chunk_ws in chunk}
+
+       data = batch_values.pop(wtitle, None)
+       if data is None:
+           try:
+               logger.info(f"Отримання даних з аркуша {wtitle}...")
+               data = sheets_rate_limiter.call(ws.get_all_values)
+           except Exception as e:
+               logger.error(f"Помилка get_all_values {wtitle}: {e}")
+               continue
+       logger.info(f"Отримано {len(data)} рядків з аркуша {wtitle}")
 
-       process_sheet_data(data, wtitle, all_product_numbers)
-       time.sleep(1)
+       process_sheet_data(data, wtitle, all_product_numbers, new_product_numbers)
 
    if all_product_numbers:
        total_products = len(all_product_numbers)
@@ -907,17 +1366,11 @@ def import_data():
        cur = conn_del.cursor()
        try:
            # Видаляємо товари, які не знайдені в жодному з аркушів
-           cur.execute("""
-               DELETE FROM products
-               WHERE productnumber NOT IN %s
-           """, (tuple(all_product_numbers),))
-           deleted_count = cur.rowcount
-           conn_del.commit()
-           logger.info(f"Видалено {deleted_count} товарів, які відсутні в таблицях")
+           delete_report = delete_missing_products(conn_del, all_product_numbers, dry_run=dry_run_delete)
+           deleted_numbers = delete_report["deleted_numbers"]
 
            # Видаляємо порожні товари (без основних атрибутів)
-           cur.execute("""
-               DELETE FROM products
+           empty_products_where = """
                WHERE (productnumber IS NULL OR productnumber='#')
                  AND (
                    (CASE WHEN brandid IS NOT NULL THEN 1 ELSE 0 END)
@@ -925,17 +1378,30 @@ def import_data():
                  + (CASE WHEN marking IS NOT NULL AND marking<>'' THEN 1 ELSE 0 END)
                  + (CASE WHEN description IS NOT NULL AND description<>'' THEN 1 ELSE 0 END)
                  )<2
-           """)
-           deleted_empty_count = cur.rowcount
-           conn_del.commit()
-           logger.info(f"Видалено {deleted_empty_count} порожніх товарів з номером '#'")
+           """
+           if dry_run_delete:
+               cur.execute("SELECT count(*) FROM products " + empty_products_where)
+               logger.info(f"[dry-run] Порожніх товарів з номером '#', які було б видалено: {cur.fetchone()[0]}")
+               conn_del.rollback()
+           else:
+               cur.execute("DELETE FROM products " + empty_products_where)
+               deleted_empty_count = cur.rowcount
+               conn_del.commit()
+               logger.info(f"Видалено {deleted_empty_count} порожніх товарів з номером '#'")
 
            cur.close()
            conn_del.close()
 
-           logger.info("Об'єднання схожих товарів...")
-           merge_similar_products_and_rename()
-           logger.info("Об'єднання товарів завершено")
+           if dry_run_delete:
+               logger.info("[dry-run] Об'єднання і перейменування схожих товарів пропущено")
+           else:
+               logger.info("Об'єднання схожих товарів...")
+               merge_bases = None
+               if PRODUCTS_MERGE_SCOPE == "touched":
+                   merge_bases = {product_base_number(pn) for pn in new_product_numbers | deleted_numbers}
+                   logger.info(f"Об'єднання лише для {len(merge_bases)} змінених груп номерів")
+               merge_similar_products_and_rename(merge_bases)
+               logger.info("Об'єднання товарів завершено")
 
        except Exception as e:
            logger.error(f"Помилка видалення товарів: {e}")
@@ -946,6 +1412,7 @@ def import_data():
        logger.warning("Жодного товару не зчитано (all_product_numbers пустий).")
 
    logger.info("=== ОНОВЛЕННЯ ТОВАРІВ ЗАВЕРШЕНО ===")
+   logger.info(f"Запити до БД:\n{query_stats.format_report()}")
    logger.info("Запускаємо orders_pars.py...")
    try:
        script_path_orders = os.path.join(SCRIPT_DIR, 'orders_pars.py')
@@ -962,4 +1429,9 @@ def import_data():
 
 
 if __name__ == '__main__':
-   import_data()
\ No newline at end of file
+   parser = argparse.ArgumentParser(description='Оновлення товарів з Google Sheets.')
+   parser.add_argument('--dry-run-delete', action='store_true',
+                       help='Лише показати, які відсутні в таблицях і порожні товари було б видалено '
+                            '(без видалення та без об\'єднання схожих товарів)')
+   args = parser.parse_args()
+   import_data(dry_run_delete=args.dry_run_delete or PRODUCTS_DELETE_DRY_RUN)
\ No newline at end of file
@@ -3,6 +3,7 @@
 
 import os
 import re
+import sys
 import logging
 import time
 import hashlib
@@ -10,15 +11,40 @@ import argparse
 import threading
 import queue
 import json
-from datetime import datetime
+from datetime import datetime, timedelta
 from collections import defaultdict
+from operator import itemgetter
 
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import psycopg2
 from psycopg2 import sql
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 
+try:
+    from .db_pool import PooledConnectionManager
+except ImportError:  # запуск як окремого скрипта
+    from db_pool import PooledConnectionManager
+
+try:
+    from .stage_timer import stage_timer, traced_stage
+except ImportError:  # запуск як окремого скрипта
+    from stage_timer import stage_timer, traced_stage
+
+try:
+    from .query_stats import query_stats, InstrumentedConnection
+except ImportError:  # запуск як окремого скрипта
+    from query_stats import query_stats, InstrumentedConnection
+
+try:
+    from services.rate_limiter import sheets_rate_limiter
+    from services.google_sheets_service import google_sheets_service
+except ImportError:  # запуск як окремого скрипта: додаємо корінь проекту в шлях
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    from services.rate_limiter import sheets_rate_limiter
+    from services.google_sheets_service import google_sheets_service
+
 load_dotenv()
 
 # Встановлюємо більш детальне логування для моніторингу процесу парсингу
@@ -62,6 +88,39 @@ DB_PASSWORD = os.getenv("DB_PASSWORD")
 DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT", "5432")
 
+# Розмір спільного пулу з'єднань
+DB_POOL_MINCONN = int(os.getenv("DB_POOL_MINCONN", "1"))
+DB_POOL_MAXCONN = int(os.getenv("DB_POOL_MAXCONN", "8"))
+
+# Скільки записів хешів рядків накопичувати перед збереженням у БД
+ROW_HASH_FLUSH_EVERY = int(os.getenv("ROW_HASH_FLUSH_EVERY", "200"))
+
+# Потокова обробка аркуша: рядки читаються й хешуються вікнами по ORDERS_STREAM_WINDOW,
+# між читанням і записом у БД - черга щонайбільше з ORDERS_STREAM_QUEUE_WINDOWS вікон
+ORDERS_STREAM_WINDOW = int(os.getenv("ORDERS_STREAM_WINDOW", "500"))
+ORDERS_STREAM_QUEUE_WINDOWS = int(os.getenv("ORDERS_STREAM_QUEUE_WINDOWS", "2"))
+
+# Скільки оброблених рядків замовлень фіксувати одним комітом (кожен рядок - окремий
+# SAVEPOINT, тож помилка рядка відкочує лише його). 1 - коміт після кожного рядка
+ORDERS_COMMIT_EVERY = int(os.getenv("ORDERS_COMMIT_EVERY", "50"))
+
+# Аркуші з датою в назві, старшою за стільки днів, вважаються "замороженими":
+# для них збіг дайджесту діапазону-зонда достатній, щоб пропустити аркуш.
+# 0 (за замовчуванням) - вимкнено: статуси, оплата і ТТН змінюються і в старих аркушах
+ORDERS_SHEET_FREEZE_DAYS = int(os.getenv("ORDERS_SHEET_FREEZE_DAYS", "0"))
+
+db_pool = PooledConnectionManager(
+    minconn=DB_POOL_MINCONN,
+    maxconn=DB_POOL_MAXCONN,
+    host=DB_HOST,
+    port=DB_PORT,
+    database=DB_NAME,
+    user=DB_USER,
+    password=DB_PASSWORD,
+    # Облік запитів psycopg2 (див. query_stats)
+    connection_factory=InstrumentedConnection
+)
+
 # -------------------------------------------------------
 #   Дані для Google Sheets
 # -------------------------------------------------------
@@ -128,6 +187,172 @@ PRODUCT_STATUS_NOT_SOLD = 2
 # Глобальні опції, які можна змінити через аргументи командного рядка
 FORCE_PROCESS_ALL = False
 
+# -------------------------------------------------------
+#   Кеш довідників (статуси, методи доставки)
+# -------------------------------------------------------
+# вид довідника -> (таблиця, колонка з назвою, статична мапа)
+DIMENSION_TABLES = {
+   "order_status": ("order_statuses", "status_name", ORDER_STATUS_MAP),
+   "payment_status": ("payment_statuses", "status_name", PAYMENT_STATUS_MAP),
+   "delivery_method": ("delivery_methods", "method_name", DELIVERY_METHOD_MAP),
+   "delivery_status": ("delivery_statuses", "status_name", DELIVERY_STATUS_MAP),
+}
+
+def normalize_dimension_name(value):
+   """Нормалізує назву статусу/методу для пошуку в кеші."""
+   if value is None:
+      return ""
+   return " ".join(str(value).split()).lower()
+
+class DimensionCache:
+   """
+   Кеш ID довідників order_statuses, payment_statuses, delivery_methods,
+   delivery_statuses на час одного запуску імпорту.
+
+   Довідники завантажуються з БД одним запитом на таблицю при першому
+   зверненні, статичні мапи мають пріоритет (збігаються з попередньою логікою).
+   Невідомі значення додаються в таблицю і в кеш. hits - звернення без БД,
+   misses - звернення, для яких знадобився запит.
+   """
+
+   def __init__(self, tables=None):
+      self.tables = tables or DIMENSION_TABLES
+      self._lock = threading.Lock()
+      self._ids = {}
+      self._names = {}
+      self._loaded = False
+      self.hits = 0
+      self.misses = 0
+      self.inserted = 0
+
+   def reset(self):
+      """Скидає кеш: наступне звернення завантажить довідники заново."""
+      with self._lock:
+         self._ids = {}
+         self._names = {}
+         self._loaded = False
+         self.hits = 0
+         self.misses = 0
+         self.inserted = 0
+
+   def _load(self):
+      ids = {kind: {} for kind in self.tables}
+      names = {kind: {} for kind in self.tables}
+      conn = get_read_only_connection()
+      if conn is None:
+         logger.warning("Кеш довідників: немає з'єднання з БД, використовуються лише статичні мапи")
+      else:
+         try:
+            with conn.cursor() as cur:
+               for kind, (table, column, _static) in self.tables.items():
+                  cur.execute(sql.SQL("SELECT id, {} FROM {} ORDER BY id").format(
+                     sql.Identifier(column), sql.Identifier(table)))
+                  for row_id, name in cur.fetchall():
+                     ids[kind].setdefault(normalize_dimension_name(name), row_id)
+                     names[kind][row_id] = name
+         except psycopg2.Error as e:
+            logger.error(f"Кеш довідників: помилка завантаження: {e}")
+         finally:
+            conn.close()
+
+      for kind, (_table, _column, static_map) in self.tables.items():
+         for name, row_id in static_map.items():
+            ids[kind][normalize_dimension_name(name)] = row_id
+            names[kind].setdefault(row_id, name)
+
+      self._ids = ids
+      self._names = names
+      self._loaded = True
+      self.misses += len(self.tables)
+      logger.debug("Кеш довідників завантажено: " + ", ".join(f"{k}={len(v)}" for k, v in ids.items()))
+
+   def _insert(self, kind, value):
+      """Шукає значення в таблиці без урахування регістру або додає його. Повертає id."""
+      table, column, _static = self.tables[kind]
+      conn = db_pool.checkout(autocommit=True)
+      if conn is None:
+         return None
+      try:
+         with conn.cursor() as cur:
+            cur.execute(sql.SQL("SELECT id FROM {} WHERE lower(trim({})) = %s ORDER BY id LIMIT 1").format(
+               sql.Identifier(table), sql.Identifier(column)), (normalize_dimension_name(value),))
+            row = cur.fetchone()
+            if row:
+               return row[0]
+            cur.execute(sql.SQL("INSERT INTO {} ({}) VALUES (%s) RETURNING id").format(
+               sql.Identifier(table), sql.Identifier(column)), (value,))
+            self.inserted += 1
+            logger.info(f"Додано нове значення '{value}' до {table}")
+            return cur.fetchone()[0]
+      except psycopg2.Error as e:
+         logger.error(f"Не вдалося додати '{value}' до {table}: {e}")
+         return None
+      finally:
+         conn.close()
+
+   def get_id(self, kind, value, create=True):
+      """
+      Повертає ID значення довідника.
+
+      Args:
+         kind: вид довідника (ключ DIMENSION_TABLES)
+         value: назва з таблиці (регістр і пробіли не враховуються)
+         create: додавати невідоме значення в БД
+
+      Returns:
+         int або None
+      """
+      key = normalize_dimension_name(value)
+      if not key:
+         return None
+      with self._lock:
+         if not self._loaded:
+            self._load()
+         row_id = self._ids[kind].get(key)
+         if row_id is not None:
+            self.hits += 1
+            return row_id
+         self.misses += 1
+         if not create:
+            return None
+         row_id = self._insert(kind, str(value).strip())
+         if row_id is not None:
+            self._ids[kind][key] = row_id
+            self._names[kind].setdefault(row_id, str(value).strip())
+         return row_id
+
+   def get_name(self, kind, row_id):
+      """Повертає назву значення довідника за ID (для логування)."""
+      if row_id is None:
+         return ""
+      with self._lock:
+         if not self._loaded:
+            self._load()
+         name = self._names[kind].get(row_id)
+         if name is not None:
+            self.hits += 1
+         else:
+            self.misses += 1
+         return name or ""
+
+   def stats(self):
+      """Лічильники звернень до кешу."""
+      with self._lock:
+         return {"hits": self.hits, "misses": self.misses, "inserted": self.inserted,
+                 "loaded": self._loaded}
+
+dimension_cache = DimensionCache()
+
+def prepare_import_run():
+   """
+   Готує модуль до нового запуску імпорту: скидає кеші, щоб довідники
+   були завантажені з БД один раз на запуск.
+   """
+   dimension_cache.reset()
+   client_resolver.reset()
+   stage_timer.reset()
+   query_stats.reset()
+
 # Шлях до файлу логування проблем з парсингом аркушів
 SHEETS_ISSUES_LOG_FILE = os.path.join(SCRIPT_DIR, "sheets_parsing_issues.log")
 
@@ -238,8 +463,15 @@ def log_sheets_issues(issues_list):
     except Exception as e:
         logger.error(f"Помилка при збереженні логу проблем з парсингом аркушів: {e}")
 
+# Серіалізує DDL, коли кілька аркушів обробляються паралельно
+_schema_lock = threading.Lock()
+
 def init_tracking_tables(conn):
     """Створює таблиці для відстеження прогресу обробки, якщо вони не існують"""
+    with _schema_lock:
+        _create_tracking_tables(conn)
+
+def _create_tracking_tables(conn):
     cur = conn.cursor()
     try:
         # Таблиця для відстеження прогресу по аркушах
@@ -294,8 +526,27 @@ def init_tracking_tables(conn):
             """)
             logger.info("Додано колонку error_message до таблиці row_hashes")
             
+        # Колонки "відбитка" аркуша для пропуску незмінених аркушів
+        for column_name, column_type in (("file_modified_time", "VARCHAR(64)"), ("probe_digest", "VARCHAR(32)")):
+            cur.execute("""
+                SELECT column_name 
+                FROM information_schema.columns 
+                WHERE table_name='processing_progress' AND column_name=%s
+            """, (column_name,))
+            
+            if not cur.fetchone():
+                cur.execute(sql.SQL("ALTER TABLE processing_progress ADD COLUMN {} {}").format(
+                    sql.Identifier(column_name), sql.SQL(column_type)))
+                logger.info(f"Додано колонку {column_name} до таблиці processing_progress")
+            
+        # Індекс для пошуку клієнта за нормалізованим ПІБ
+        ensure_client_name_index(cur)
+            
         conn.commit()
         logger.debug("Таблиці відстеження прогресу створені або вже існують")
+
+        # Відбиток замовлень для find_exact_order (міграція виконується один раз за процес)
+        ensure_order_fingerprint(conn)
     except Exception as e:
         conn.rollback()
         logger.error(f"Помилка при створенні таблиць відстеження: {e}")
@@ -309,10 +560,14 @@ def compute_row_hash(row_data):
     """
     Обчислює хеш для рядка даних, щоб порівнювати зміни.
     Використовується для визначення, чи змінилися дані рядка.
+    Рядок може бути списком значень або словником {номер колонки: значення}.
     """
     # Перетворюємо всі значення в рядки і об'єднуємо їх
     # Ігноруємо порожні значення для зменшення хибних спрацьовувань
     try:
+        if isinstance(row_data, dict):
+            # Хешуємо значення в порядку колонок, а не ключі словника
+            row_data = [row_data[column] for column in sorted(row_data)]
         row_str = "||".join([str(val).strip() if val else "" for val in row_data])
         logger.debug(f"Обчислення хешу для рядка: {row_str[:100]}...")
         return hashlib.md5(row_str.encode('utf-8')).hexdigest()
@@ -333,6 +588,224 @@ def get_existing_row_hash(cursor, sheet_name, row_index):
         return {'hash': result[0], 'is_processed': result[1], 'error_message': result[2]}
     return None
 
+def load_sheet_row_hashes(cursor, sheet_name):
+    """
+    Завантажує всі збережені хеші рядків аркуша одним запитом.
+
+    Returns:
+        dict: {row_index: {'hash', 'is_processed', 'error_message', 'client_name'}}
+        у тому ж форматі, що й get_existing_row_hash
+    """
+    cursor.execute("""
+        SELECT row_index, row_hash, is_processed, error_message, client_name
+        FROM row_hashes
+        WHERE sheet_name = %s
+    """, (sheet_name,))
+
+    return {
+        row_index: {
+            'hash': row_hash,
+            'is_processed': is_processed,
+            'error_message': error_message,
+            'client_name': client_name
+        }
+        for row_index, row_hash, is_processed, error_message, client_name in cursor.fetchall()
+    }
+
+class OrderRow(tuple):
+    """
+    Рядок аркуша замовлень: кортеж значень колонок з іменованим доступом до
+    відомих колонок. Створюється один раз на рядок зі списку значень, без
+    словника на кожну клітинку; індексний доступ row[i] працює як і раніше.
+    """
+
+    __slots__ = ()
+
+    products = property(itemgetter(0), doc="Номери продуктів")
+    clones = property(itemgetter(1), doc="Номери клонів")
+    client_name = property(itemgetter(2), doc="ПІБ клієнта")
+    prices = property(itemgetter(10), doc="Ціни продуктів")
+    additional_operation = property(itemgetter(11), doc="Додаткова операція (+/- сума)")
+    discount = property(itemgetter(12), doc="Знижка")
+    order_status = property(itemgetter(14), doc="Статус замовлення")
+    payment_status = property(itemgetter(15), doc="Статус оплати")
+    delivery_method = property(itemgetter(16), doc="Спосіб доставки")
+    notes = property(itemgetter(17), doc="Примітки")
+    notes_extra = property(itemgetter(18), doc="Додаткові примітки")
+    delivery_status = property(itemgetter(21), doc="Статус доставки")
+    tracking_number = property(itemgetter(22), doc="Номер ТТН")
+    deferred_until = property(itemgetter(24), doc="Відкладено до")
+    priority = property(itemgetter(25), doc="Пріоритет")
+
+    @classmethod
+    def from_values(cls, values, width=None):
+        """
+        Створює рядок зі списку значень (width - обрізати до кількості колонок заголовка).
+        """
+        if type(values) is cls and width is None:
+            return values
+        if width is not None and len(values) > width:
+            values = values[:width]
+        return tuple.__new__(cls, values)
+
+def iter_row_windows(rows, window_size=None, queue_windows=None, first_row_index=2, min_columns=26):
+    """
+    Етап читання конвеєра парсингу аркуша: окремий потік читає рядки (rows може
+    бути генератором), обчислює їх хеші та передає вікнами по window_size рядків
+    через обмежену чергу. У пам'яті одночасно не більше queue_windows + 1 вікон,
+    а обробка першого вікна починається, поки наступні ще читаються.
+
+    Yields:
+        list: [(row_index, row, row_hash)]; row_hash = None для рядків,
+        у яких менше min_columns колонок
+    """
+    window_size = window_size or ORDERS_STREAM_WINDOW
+    windows = queue.Queue(maxsize=queue_windows or ORDERS_STREAM_QUEUE_WINDOWS)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                windows.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            window = []
+            started = time.perf_counter()
+            for row_index, row in enumerate(rows, start=first_row_index):
+                window.append((row_index, row, compute_row_hash(row) if len(row) >= min_columns else None))
+                if len(window) >= window_size:
+                    stage_timer.record("read_and_hash", time.perf_counter() - started)
+                    if not put(window):
+                        return
+                    window = []
+                    started = time.perf_counter()
+            if window:
+                stage_timer.record("read_and_hash", time.perf_counter() - started)
+                put(window)
+        except Exception as e:
+            put(e)
+        finally:
+            put(finished)
+
+    sheet_name = stage_timer.current_sheet()
+
+    def produce_for_sheet():
+        stage_timer.set_sheet(sheet_name)
+        produce()
+
+    producer = threading.Thread(target=produce_for_sheet, name="orders-row-reader", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = windows.get()
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+class RowHashMatcher:
+    """
+    Зіставляє рядки аркуша зі збереженими хешами за вмістом, а не лише за індексом.
+
+    Рядок спочатку зіставляється із записом того самого індексу, інакше - із
+    записом з тим самим хешем під іншим індексом: вставка чи видалення рядка
+    вище зсуває індекси, але переміщені рядки не вважаються зміненими. Кожен
+    збережений запис використовується не більше одного разу. Рядки подаються
+    по одному (потоково), тому серед кандидатів перевага надається вже
+    пройденим індексам - їхні рядки точно не збіглися зі своїм записом.
+
+    Args:
+        stored_hashes: {row_index: info} (див. load_sheet_row_hashes)
+    """
+
+    def __init__(self, stored_hashes):
+        self._stored = stored_hashes
+        self._claimed = set()
+        self._by_hash = defaultdict(list)
+        for row_index in sorted(stored_hashes):
+            self._by_hash[stored_hashes[row_index]['hash']].append(row_index)
+        self.moved = 0
+
+    def match(self, row_index, row_hash):
+        """
+        Returns:
+            dict: збережений запис з тим самим хешем (для переміщеного рядка
+            з ключем 'moved_from' - попередній індекс) або None
+        """
+        info = self._stored.get(row_index)
+        if info is not None and info['hash'] == row_hash and row_index not in self._claimed:
+            self._claimed.add(row_index)
+            return info
+
+        candidates = [c for c in self._by_hash.get(row_hash, ()) if c not in self._claimed]
+        if not candidates:
+            return None
+        self._by_hash[row_hash] = candidates
+        earlier = [c for c in candidates if c < row_index]
+        source_index = earlier[-1] if earlier else candidates[0]
+        self._claimed.add(source_index)
+        self.moved += 1
+        return dict(self._stored[source_index], moved_from=source_index)
+
+def find_unchanged_sheets(fingerprints):
+    """
+    Визначає аркуші, які не змінилися з останньої успішної обробки.
+
+    Аркуш пропускається, якщо:
+    - modifiedTime документа збігається зі збереженим (документ не редагувався), або
+    - аркуш "заморожений" (дата в назві старша за ORDERS_SHEET_FREEZE_DAYS днів,
+      лише якщо ORDERS_SHEET_FREEZE_DAYS > 0) і дайджест діапазону-зонда
+      збігається зі збереженим.
+
+    Args:
+        fingerprints: {назва аркуша: {"modified_time", "probe_digest"}}
+            (див. GoogleSheetsService.get_sheet_fingerprints)
+
+    Returns:
+        dict: {назва аркуша: причина пропуску}
+    """
+    if not fingerprints:
+        return {}
+    conn = get_read_only_connection()
+    if not conn:
+        return {}
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT sheet_name, file_modified_time, probe_digest
+                FROM processing_progress
+                WHERE sheet_name = ANY(%s)
+            """, (list(fingerprints),))
+            stored = cur.fetchall()
+    except psycopg2.Error as e:
+        logger.warning(f"Не вдалося завантажити відбитки аркушів: {e}")
+        return {}
+    finally:
+        conn.close()
+
+    frozen_before = datetime.now() - timedelta(days=ORDERS_SHEET_FREEZE_DAYS)
+    unchanged = {}
+    for sheet_name, stored_modified_time, stored_probe_digest in stored:
+        current = fingerprints[sheet_name]
+        if stored_modified_time and stored_modified_time == current.get("modified_time"):
+            unchanged[sheet_name] = "документ не змінювався"
+        elif (ORDERS_SHEET_FREEZE_DAYS > 0 and stored_probe_digest
+              and stored_probe_digest == current.get("probe_digest")):
+            sheet_date = worksheet_title_date(sheet_name)
+            if sheet_date is not None and sheet_date < frozen_before:
+                unchanged[sheet_name] = "архівний аркуш, зонд не змінився"
+    return unchanged
+
 def update_row_hash(cursor, connection, sheet_name, row_index, row_hash, client_name, is_processed=True, error_message=None):
     """Оновлює або додає запис хешу рядка в базу даних"""
     try:
@@ -344,11 +817,108 @@ def update_row_hash(cursor, connection, sheet_name, row_index, row_hash, client_
         """, (sheet_name, row_index, row_hash, client_name, is_processed, error_message, 
               row_hash, client_name, is_processed, error_message))
         
-        connection.commit()
+        commit_unless_deferred(connection)
     except Exception as e:
         connection.rollback()
         logger.error(f"Помилка при оновленні хешу рядка: {e}")
 
+class RowHashWriteBuffer:
+    """
+    Буфер відкладеного запису хешів рядків і прогресу аркуша.
+
+    Замість INSERT + commit на кожен рядок накопичує записи і зберігає їх
+    одним багаторядковим INSERT ... ON CONFLICT кожні flush_every рядків
+    та в кінці аркуша. Повторний запис того ж рядка замінює попередній.
+    """
+
+    def __init__(self, connection, sheet_name, flush_every=None):
+        self.connection = connection
+        self.sheet_name = sheet_name
+        self.flush_every = flush_every or ROW_HASH_FLUSH_EVERY
+        self._pending = {}
+        self._progress_rows = None
+        self._fingerprint = None
+        self._prune_after = None
+        self.flushes = 0
+        self.rows_written = 0
+
+    def add(self, row_index, row_hash, client_name, is_processed=True, error_message=None):
+        """Додає (або замінює) запис хешу рядка; при заповненні буфера зберігає його."""
+        self._pending[row_index] = (row_hash, client_name, is_processed, error_message)
+        if len(self._pending) >= self.flush_every:
+            self.flush()
+
+    def set_progress(self, total_rows, fingerprint=None):
+        """
+        Запам'ятовує прогрес аркуша, який буде збережено разом з наступним flush().
+        fingerprint - відбиток аркуша ({"modified_time", "probe_digest"}); без нього
+        збережений відбиток скидається, і аркуш буде завантажено наступного разу.
+        """
+        self._progress_rows = total_rows
+        self._fingerprint = fingerprint or {}
+
+    def prune_after(self, max_row_index):
+        """Видаляє (при наступному flush()) збережені хеші рядків з індексом більше max_row_index."""
+        self._prune_after = max_row_index
+
+    def __len__(self):
+        return len(self._pending)
+
+    def flush(self):
+        """
+        Зберігає накопичені записи однією транзакцією.
+
+        Returns:
+            bool: True, якщо записи збережено (або зберігати нічого)
+        """
+        if not self._pending and self._progress_rows is None and self._prune_after is None:
+            return True
+        try:
+            with self.connection.cursor() as cursor:
+                if self._pending:
+                    execute_values(cursor, """
+                        INSERT INTO row_hashes (sheet_name, row_index, row_hash, client_name, is_processed, error_message)
+                        VALUES %s
+                        ON CONFLICT (sheet_name, row_index)
+                        DO UPDATE SET row_hash = EXCLUDED.row_hash,
+                                      client_name = EXCLUDED.client_name,
+                                      is_processed = EXCLUDED.is_processed,
+                                      error_message = EXCLUDED.error_message
+                    """, [
+                        (self.sheet_name, row_index) + values
+                        for row_index, values in self._pending.items()
+                    ])
+                if self._prune_after is not None:
+                    cursor.execute(
+                        "DELETE FROM row_hashes WHERE sheet_name = %s AND row_index > %s",
+                        (self.sheet_name, self._prune_after)
+                    )
+                if self._progress_rows is not None:
+                    cursor.execute("""
+                        INSERT INTO processing_progress
+                            (sheet_name, last_processed_timestamp, last_row_index, file_modified_time, probe_digest)
+                        VALUES (%s, now(), %s, %s, %s)
+                        ON CONFLICT (sheet_name)
+                        DO UPDATE SET last_processed_timestamp = now(),
+                                      last_row_index = EXCLUDED.last_row_index,
+                                      file_modified_time = EXCLUDED.file_modified_time,
+                                      probe_digest = EXCLUDED.probe_digest
+                    """, (self.sheet_name, self._progress_rows,
+                          self._fingerprint.get("modified_time"), self._fingerprint.get("probe_digest")))
+            self.connection.commit()
+        except Exception as e:
+            self.connection.rollback()
+            logger.error(f"[{self.sheet_name}] Помилка при збереженні хешів рядків ({len(self._pending)} шт.): {e}")
+            return False
+
+        self.flushes += 1
+        self.rows_written += len(self._pending)
+        self._pending.clear()
+        self._progress_rows = None
+        self._fingerprint = None
+        self._prune_after = None
+        return True
+
 def update_sheet_progress(cursor, connection, sheet_name, total_rows):
     """Оновлює інформацію про прогрес обробки аркуша"""
     try:
@@ -383,21 +953,61 @@ def get_google_sheet_client():
 #   Підключення до PostgreSQL
 # -------------------------------------------------------
 def connect_to_db():
-   try:
-       return psycopg2.connect(
-           host=DB_HOST,
-           port=DB_PORT,
-           database=DB_NAME,
-           user=DB_USER,
-           password=DB_PASSWORD
-       )
-   except psycopg2.Error as e:
-       logger.error(f"Помилка підключення до бази даних: {e}")
-       return None
+   """
+   Видає з'єднання зі спільного пулу.
+   conn.close() повертає з'єднання в пул, а не розриває його.
+   """
+   conn = db_pool.checkout()
+   if conn is None:
+       logger.error("Помилка підключення до бази даних: не вдалося отримати з'єднання з пулу")
+   return conn
+
+def get_read_only_connection():
+   """
+   Видає з'єднання з пулу лише для читання (READ COMMITTED, автокоміт),
+   яке не блокує запис під час імпорту.
+   """
+   conn = db_pool.checkout(
+       isolation_level=psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED,
+       readonly=True,
+       autocommit=True
+   )
+   if conn is None:
+       logger.error("Помилка підключення до бази даних (лише читання): не вдалося отримати з'єднання з пулу")
+   return conn
+
+def get_db_pool_stats():
+   """Повертає статистику спільного пулу з'єднань (див. PooledConnectionManager.stats)."""
+   return db_pool.stats()
+
+# З'єднання, коміти якого у поточному потоці відкладені (див. ChunkedRowTransaction)
+_commit_scope = threading.local()
+
+def commits_deferred(connection):
+   """True, якщо коміти connection у поточному потоці фіксує викликач (режим транзакції на кілька рядків)."""
+   return getattr(_commit_scope, "connection", None) is connection
+
+def commit_unless_deferred(connection):
+   """
+   connection.commit() для допоміжних функцій запису. Якщо коміти з'єднання
+   відкладені, нічого не робить: зміни буде зафіксовано разом з групою рядків.
+   """
+   if not commits_deferred(connection):
+       connection.commit()
 
 # -------------------------------------------------------
 #   Сортування аркушів за датою в імені
 # -------------------------------------------------------
+def worksheet_title_date(title):
+    """Дата у форматі DD.MM.YYYY на початку назви аркуша або None."""
+    match = re.match(r'(\d{2}\.\d{2}\.\d{4})', title)
+    if not match:
+        return None
+    try:
+        return datetime.strptime(match.group(1), "%d.%m.%Y")
+    except ValueError:
+        return None
+
 def sort_worksheets_by_date(worksheets):
     """
     Сортує аркуші Google Sheets за датою (якщо дата вказана в імені аркуша)
@@ -408,19 +1018,8 @@ def sort_worksheets_by_date(worksheets):
     """
     def extract_date(worksheet):
         """Витягує дату з імені аркуша, якщо вона є"""
-        name = worksheet.title
-        # Шукаємо дату у форматі DD.MM.YYYY на початку назви
-        match = re.match(r'(\d{2}\.\d{2}\.\d{4})', name)
-        if match:
-            date_str = match.group(1)
-            try:
-                # Парсимо дату
-                return datetime.strptime(date_str, "%d.%m.%Y")
-            except ValueError:
-                # Якщо не вдалося розпарсити дату, повертаємо мінімальну дату
-                return datetime.min
-        # Якщо дати немає, повертаємо мінімальну дату
-        return datetime.min
+        # Якщо дати немає (або її не вдалося розпарсити), повертаємо мінімальну дату
+        return worksheet_title_date(worksheet.title) or datetime.min
     
     # Сортуємо аркуші за датами (нові аркуші спочатку)
     return sorted(worksheets, key=extract_date, reverse=True)
@@ -498,53 +1097,235 @@ def parse_broadcast_sheet_name(sheet_name):
 # -------------------------------------------------------
 #   Робота з клієнтами
 # -------------------------------------------------------
-def get_or_create_client(cursor, connection, full_name):
-   if not full_name:
-       return None
+def split_full_name(full_name):
+   """
+   Розбиває ПІБ на (first_name, last_name, middle_name).
+   Одне слово - лише ім'я, два - ім'я та прізвище, решта йде в middle_name.
+   """
    parts = full_name.split()
    if len(parts) == 1:
-       first_name = parts[0]
-       last_name = None
-       middle_name = None
-   elif len(parts) == 2:
-       first_name, last_name = parts
-       middle_name = None
-   else:
-       first_name = parts[0]
-       last_name = parts[1]
-       middle_name = " ".join(parts[2:])
+       return parts[0], None, None
+   if len(parts) == 2:
+       return parts[0], parts[1], None
+   return parts[0], parts[1], " ".join(parts[2:])
 
-   guessed_gender_id = guess_gender_by_last_name(last_name) if last_name else GENDER_ID_UNISEX
+def client_name_key(first_name, last_name, middle_name):
+   """Нормалізований ключ клієнта (відповідає індексу idx_clients_name_key)."""
+   return (
+       (first_name or "").strip().lower(),
+       (last_name or "").strip().lower(),
+       (middle_name or "").strip().lower()
+   )
 
+def ensure_client_name_index(cursor):
+   """Створює індекс за нормалізованим ПІБ клієнта, якщо його немає."""
    cursor.execute("""
-       SELECT id, gender_id
-         FROM clients
-        WHERE lower(trim(first_name)) = lower(trim(%s))
-          AND lower(trim(coalesce(last_name, ''))) = lower(trim(%s))
-          AND lower(trim(coalesce(middle_name, ''))) = lower(trim(%s))
-        LIMIT 1
-   """, (first_name or "", last_name or "", middle_name or ""))
-   row = cursor.fetchone()
-   if row:
-       cid, old_gender_id = row
-       if old_gender_id == GENDER_ID_UNISEX and guessed_gender_id != GENDER_ID_UNISEX:
-           cursor.execute("""
-               UPDATE clients
-                  SET gender_id=%s,
-                      updated_at=now()
-                WHERE id=%s
-           """,(guessed_gender_id, cid))
-           connection.commit()
-       return cid
+       CREATE INDEX IF NOT EXISTS idx_clients_name_key
+           ON clients ((lower(trim(first_name))),
+                       (lower(trim(coalesce(last_name, '')))),
+                       (lower(trim(coalesce(middle_name, '')))))
+   """)
 
-   cursor.execute("""
-       INSERT INTO clients (first_name, last_name, middle_name, gender_id, created_at, updated_at)
-       VALUES (%s, %s, %s, %s, now(), now())
-       RETURNING id
-   """,(first_name, last_name, middle_name, guessed_gender_id))
-   new_cid = cursor.fetchone()[0]
-   connection.commit()
-   return new_cid
+class ClientResolver:
+   """
+   Кеш відповідності нормалізованого ПІБ -> (client_id, gender_id).
+
+   Завантажується з БД одним запитом при першому зверненні за запуск.
+   Нових клієнтів створює пакетно (prefetch), а стать оновлює через окреме
+   з'єднання в автокоміті, щоб відкат транзакції рядка не залишав у кеші
+   неіснуючі ID чи незбережену стать.
+   """
+
+   def __init__(self):
+      self._lock = threading.Lock()
+      self._create_lock = threading.Lock()
+      self._clients = {}
+      self._loaded = False
+      self.hits = 0
+      self.misses = 0
+      self.created = 0
+
+   def reset(self):
+      with self._lock:
+         self._clients = {}
+         self._loaded = False
+         self.hits = 0
+         self.misses = 0
+         self.created = 0
+
+   def _load(self):
+      conn = get_read_only_connection()
+      if conn is None:
+         return
+      try:
+         with conn.cursor() as cur:
+            cur.execute("""
+               SELECT id, gender_id,
+                      lower(trim(first_name)),
+                      lower(trim(coalesce(last_name, ''))),
+                      lower(trim(coalesce(middle_name, '')))
+                 FROM clients
+                ORDER BY id
+            """)
+            for cid, gender_id, first_key, last_key, middle_key in cur.fetchall():
+               self._clients.setdefault((first_key or "", last_key, middle_key), [cid, gender_id])
+         self._loaded = True
+         logger.debug(f"Кеш клієнтів завантажено: {len(self._clients)} записів")
+      except psycopg2.Error as e:
+         logger.error(f"Помилка завантаження кешу клієнтів: {e}")
+      finally:
+         conn.close()
+
+   def _ensure_loaded(self):
+      if not self._loaded:
+         self._load()
+
+   @traced_stage("client_resolution")
+   def prefetch(self, full_names):
+      """
+      Гарантує наявність у кеші всіх переданих клієнтів: відсутніх шукає
+      в БД одним запитом, решту створює одним багаторядковим INSERT.
+
+      Запити до БД виконуються без self._lock (пошук у кеші з інших потоків
+      не чекає на них); _create_lock лише не дає двом prefetch створити
+      одного клієнта двічі.
+
+      Returns:
+         int: кількість створених клієнтів
+      """
+      with self._create_lock:
+         with self._lock:
+            self._ensure_loaded()
+            missing = {}
+            for full_name in full_names:
+               if not full_name:
+                  continue
+               first_name, last_name, middle_name = split_full_name(full_name)
+               key = client_name_key(first_name, last_name, middle_name)
+               if key not in self._clients and key not in missing:
+                  missing[key] = (first_name, last_name, middle_name)
+         if not missing:
+            return 0
+
+         conn = db_pool.checkout(autocommit=True)
+         if conn is None:
+            return 0
+         try:
+            with conn.cursor() as cur:
+               # Клієнти могли з'явитися після завантаження кешу
+               found = execute_values(cur, """
+                  SELECT c.id, c.gender_id, v.first_key, v.last_key, v.middle_key
+                    FROM (VALUES %s) AS v(first_key, last_key, middle_key)
+                    JOIN clients c
+                      ON lower(trim(c.first_name)) = v.first_key
+                     AND lower(trim(coalesce(c.last_name, ''))) = v.last_key
+                     AND lower(trim(coalesce(c.middle_name, ''))) = v.middle_key
+                   ORDER BY c.id
+               """, list(missing.keys()), fetch=True)
+               found_entries = {}
+               for cid, gender_id, first_key, last_key, middle_key in found:
+                  key = (first_key, last_key, middle_key)
+                  found_entries.setdefault(key, [cid, gender_id])
+                  missing.pop(key, None)
+
+               created = []
+               keys = list(missing.keys())
+               if keys:
+                  values = []
+                  for key in keys:
+                     first_name, last_name, middle_name = missing[key]
+                     gender_id = guess_gender_by_last_name(last_name) if last_name else GENDER_ID_UNISEX
+                     values.append((first_name, last_name, middle_name, gender_id))
+                  # RETURNING повертає рядки в порядку VALUES
+                  created = execute_values(cur, """
+                     INSERT INTO clients (first_name, last_name, middle_name, gender_id, created_at, updated_at)
+                     VALUES %s
+                     RETURNING id, gender_id
+                  """, values, template="(%s, %s, %s, %s, now(), now())", page_size=max(len(values), 1), fetch=True)
+         except psycopg2.Error as e:
+            logger.error(f"Помилка пакетного створення клієнтів: {e}")
+            return 0
+         finally:
+            conn.close()
+
+         with self._lock:
+            for key, entry in found_entries.items():
+               self._clients.setdefault(key, entry)
+            for key, (cid, gender_id) in zip(keys, created):
+               self._clients.setdefault(key, [cid, gender_id])
+            self.created += len(created)
+         if created:
+            logger.info(f"Створено {len(created)} нових клієнтів")
+         return len(created)
+
+   def get_or_create(self, full_name):
+      """
+      Повертає ID клієнта за ПІБ. У типовому випадку - пошук у словнику.
+      Якщо стать клієнта невідома, а за прізвищем її можна визначити,
+      оновлює її (див. _update_gender).
+      """
+      if not full_name:
+         return None
+      first_name, last_name, middle_name = split_full_name(full_name)
+      key = client_name_key(first_name, last_name, middle_name)
+      with self._lock:
+         self._ensure_loaded()
+         entry = self._clients.get(key)
+         if entry is not None:
+            self.hits += 1
+         else:
+            self.misses += 1
+      if entry is None:
+         self.prefetch([full_name])
+         with self._lock:
+            entry = self._clients.get(key)
+         if entry is None:
+            return None
+
+      cid, old_gender_id = entry
+      if old_gender_id == GENDER_ID_UNISEX and last_name:
+         guessed_gender_id = guess_gender_by_last_name(last_name)
+         if guessed_gender_id != GENDER_ID_UNISEX:
+            self._update_gender(entry, guessed_gender_id)
+      return cid
+
+   def _update_gender(self, entry, gender_id):
+      """
+      Записує стать клієнта окремим з'єднанням в автокоміті; кеш оновлюється
+      лише після успішного запису.
+      """
+      conn = db_pool.checkout(autocommit=True)
+      if conn is None:
+         return
+      try:
+         with conn.cursor() as cur:
+            cur.execute("""
+                UPDATE clients
+                   SET gender_id=%s,
+                       updated_at=now()
+                 WHERE id=%s AND gender_id=%s
+            """,(gender_id, entry[0], GENDER_ID_UNISEX))
+         with self._lock:
+            entry[1] = gender_id
+      except psycopg2.Error as e:
+         logger.error(f"Помилка оновлення статі клієнта id={entry[0]}: {e}")
+      finally:
+         conn.close()
+
+   def stats(self):
+      with self._lock:
+         return {"hits": self.hits, "misses": self.misses, "created": self.created,
+                 "cached": len(self._clients)}
+
+client_resolver = ClientResolver()
+
+@traced_stage("client_resolution")
+def get_or_create_client(cursor, connection, full_name):
+   """
+   Повертає ID клієнта за ПІБ, створюючи його за потреби (через client_resolver).
+   Створення клієнтів і оновлення статі не залежать від транзакції cursor.
+   """
+   return client_resolver.get_or_create(full_name)
 
 def get_or_create_default_client(cursor, connection):
     """Отримати або створити клієнта за замовчуванням для замовлень без вказаного клієнта"""
@@ -564,7 +1345,7 @@ def get_or_create_default_client(cursor, connection):
         RETURNING id
     """, (GENDER_ID_UNISEX,))
     new_id = cursor.fetchone()[0]
-    connection.commit()
+    commit_unless_deferred(connection)
     return new_id
 
 # -------------------------------------------------------
@@ -589,46 +1370,37 @@ def get_or_create_product(cursor, connection, product_number):
        RETURNING id
    """,(product_number, PRODUCT_STATUS_NOT_SOLD))
    pid = cursor.fetchone()[0]
-   connection.commit()
+   commit_unless_deferred(connection)
    return pid
 
 def update_product_price(cursor, connection, product_id, new_price):
+   """
+   Встановлює нову ціну продукту. Попередня ціна переноситься в oldprice,
+   якщо oldprice ще немає або він більший за нову ціну.
+   Виконується одним UPDATE без попереднього SELECT.
+   """
    if not product_id or new_price is None:
        return
-   cursor.execute("""
-       SELECT price, oldprice
-         FROM products
-        WHERE id=%s
-   """,(product_id,))
-   row = cursor.fetchone()
-   if not row:
-       return
-   current_price, current_oldprice = row
-
-   if current_price is not None:
-       if current_oldprice is None:
-           cursor.execute("""
-               UPDATE products
-                  SET oldprice=%s
-                WHERE id=%s
-           """,(current_price, product_id))
-       else:
-           if current_oldprice > new_price:
-               cursor.execute("""
-                   UPDATE products
-                      SET oldprice=%s
-                    WHERE id=%s
-               """,(current_price, product_id))
-
    cursor.execute("""
        UPDATE products
-          SET price=%s,
+          SET oldprice=CASE
+                         WHEN price IS NOT NULL AND (oldprice IS NULL OR oldprice > %s) THEN price
+                         ELSE oldprice
+                       END,
+              price=%s,
               updated_at=now()
         WHERE id=%s
-   """,(new_price, product_id))
-   connection.commit()
+   """,(new_price, new_price, product_id))
+   commit_unless_deferred(connection)
 
-def append_clonednumbers(cursor, connection, product_id, new_clones_list):
+def append_clonednumbers(cursor, connection, product_id, new_clones_list, known_clonednumbers=None):
+   """
+   Дописує номери-клони до products.clonednumbers.
+   known_clonednumbers - відоме значення clonednumbers (наприклад, з ProductBatchResolver):
+   клони, що вже в ньому є, відкидаються без запиту до БД.
+   """
+   if known_clonednumbers:
+       new_clones_list = [c for c in new_clones_list if c.strip() and c.strip() not in known_clonednumbers]
    if not new_clones_list:
        return
    cursor.execute("""
@@ -662,7 +1434,186 @@ def append_clonednumbers(cursor, connection, product_id, new_clones_list):
               updated_at=now()
         WHERE id=%s
    """,(new_val, product_id))
-   connection.commit()
+   commit_unless_deferred(connection)
+
+class ProductBatchResolver:
+   """
+   Пакетне визначення ID продуктів для одного аркуша.
+
+   prefetch() отримує всі номери продуктів аркуша одним запитом
+   WHERE productnumber = ANY(%s) і створює відсутні одним багаторядковим
+   INSERT ... RETURNING. Далі цикл рядків бере ID зі словника.
+   Номери, яких не було при prefetch, обробляються як раніше (по одному).
+   """
+
+   def __init__(self):
+      self._products = {}
+      self._clonednumbers = {}
+      self._absent = set()
+      self.created = 0
+
+   @traced_stage("product_resolution")
+   def prefetch(self, numbers_to_create, numbers_to_lookup=()):
+      """
+      Args:
+         numbers_to_create: номери, які потрібно створити, якщо їх немає
+         numbers_to_lookup: номери, які лише шукаються (оригінали клонів)
+
+      Returns:
+         dict: productnumber -> id для всіх знайдених і створених продуктів
+      """
+      to_create = {n for n in numbers_to_create if n}
+      wanted = (to_create | {n for n in numbers_to_lookup if n}) - set(self._products)
+      if not wanted:
+         return self.product_ids()
+
+      conn = db_pool.checkout(autocommit=True)
+      if conn is None:
+         return self.product_ids()
+      try:
+         with conn.cursor() as cur:
+            cur.execute("""
+               SELECT DISTINCT ON (productnumber) productnumber, id, clonednumbers
+                 FROM products
+                WHERE productnumber = ANY(%s)
+                ORDER BY productnumber, id
+            """, (list(wanted),))
+            for number, pid, clonednumbers in cur.fetchall():
+               self._products[number] = pid
+               self._clonednumbers[pid] = clonednumbers or ""
+
+            missing = sorted(n for n in to_create if n not in self._products)
+            if missing:
+               created = execute_values(cur, """
+                  INSERT INTO products (productnumber, created_at, updated_at, statusid)
+                  VALUES %s
+                  ON CONFLICT (productnumber) DO NOTHING
+                  RETURNING productnumber, id
+               """, [(n, PRODUCT_STATUS_NOT_SOLD) for n in missing],
+                  template="(%s, now(), now(), %s)", page_size=max(len(missing), 1), fetch=True)
+               for number, pid in created:
+                  self._products[number] = pid
+                  self._clonednumbers[pid] = ""
+               self.created += len(created)
+
+               # Продукти, створені паралельно іншим процесом
+               raced = [n for n in missing if n not in self._products]
+               if raced:
+                  cur.execute("""
+                     SELECT productnumber, id, clonednumbers
+                       FROM products
+                      WHERE productnumber = ANY(%s)
+                  """, (raced,))
+                  for number, pid, clonednumbers in cur.fetchall():
+                     self._products.setdefault(number, pid)
+                     self._clonednumbers.setdefault(pid, clonednumbers or "")
+
+         self._absent.update(n for n in wanted if n not in self._products)
+      except psycopg2.Error as e:
+         logger.error(f"Помилка пакетного визначення продуктів: {e}")
+      finally:
+         conn.close()
+      return self.product_ids()
+
+   def product_ids(self):
+      """Словник productnumber -> id."""
+      return dict(self._products)
+
+   @traced_stage("product_resolution")
+   def get_or_create(self, cursor, connection, product_number):
+      """
+      ID продукту зі словника; невідомий номер створюється через prefetch()
+      (окреме з'єднання з автокомітом), а якщо це не вдалося - get_or_create_product
+      у транзакції cursor.
+      """
+      pid = self._products.get(product_number or "???")
+      if pid is not None:
+         return pid
+      self.prefetch([product_number or "???"])
+      pid = self._products.get(product_number or "???")
+      if pid is not None:
+         return pid
+      pid = get_or_create_product(cursor, connection, product_number)
+      # Продукт, створений у відкладеній транзакції, може бути відкочений разом
+      # з рядком, тому його ID не кешуємо
+      if not commits_deferred(connection):
+         self._products[product_number or "???"] = pid
+      return pid
+
+   def find_id(self, cursor, product_number):
+      """ID існуючого продукту (без створення) або None."""
+      pid = self._products.get(product_number)
+      if pid is not None:
+         return pid
+      if product_number in self._absent:
+         return None
+      cursor.execute("""
+          SELECT id FROM products 
+          WHERE productnumber = %s
+      """, (product_number,))
+      row = cursor.fetchone()
+      return row[0] if row else None
+
+   def known_clonednumbers(self, product_id):
+      """clonednumbers продукту на момент prefetch (або None, якщо невідомо)."""
+      return self._clonednumbers.get(product_id)
+
+def parse_product_numbers(raw_products, raw_clones):
+   """
+   Розбирає колонки номерів продуктів і номерів-клонів рядка замовлення.
+
+   Returns:
+      tuple: (product_numbers, processed_clone_numbers, clones_list, clone_originals)
+         product_numbers - основні номери продуктів;
+         processed_clone_numbers - клони, що стають основними номерами;
+         clones_list - усі номери-клони;
+         clone_originals - клон -> номер оригіналу (для формату "НОМЕР(ОРИГІНАЛ)")
+   """
+   product_numbers = []
+   processed_clone_numbers = []  # Для зберігання оброблених номерів клонів
+
+   # Обробка стандартних номерів продуктів
+   if raw_products:
+       split_prods = re.split(r"[;,]", raw_products)
+       product_numbers = [p.strip() for p in split_prods if p.strip()]
+
+   # Обробка номерів-клонів
+   clones_list = []
+   clone_originals = {}  # Зберігаємо оригінальні номери для клонів
+
+   if raw_clones:
+       # Розділяємо рядок клонів за комою або крапкою з комою
+       cln = re.split(r"[;,]", raw_clones)
+
+       for c in cln:
+           c = c.strip()
+           if not c:
+               continue
+
+           # Перевіряємо формат "НОМЕР(ОРИГІНАЛ)" або "НОМЕР(???)"
+           clone_match = re.match(r"(.+?)\((.+?)\)", c)
+
+           if clone_match:
+               clone_number = clone_match.group(1).strip()
+               original_number = clone_match.group(2).strip()
+
+               # Зберігаємо клон та його оригінал
+               clones_list.append(clone_number)
+               clone_originals[clone_number] = original_number
+
+               # Якщо оригінал "???", додаємо клон як основний номер,
+               # інакше клон буде доданий до clonednumbers оригінального продукту
+               if original_number == "???" and not raw_products:
+                   processed_clone_numbers.append(clone_number)
+           else:
+               # Якщо формат не відповідає "НОМЕР(ОРИГІНАЛ)", просто додаємо як клон
+               clones_list.append(c)
+
+               # Якщо основних номерів немає, використовуємо клон як основний
+               if not raw_products:
+                   processed_clone_numbers.append(c)
+
+   return product_numbers, processed_clone_numbers, clones_list, clone_originals
 
 # -------------------------------------------------------
 #   Парсинг дод. операцій і знижок
@@ -711,6 +1662,146 @@ def parse_discount_str(discount_str):
 # -------------------------------------------------------
 #   Робота з таблицями orders, order_details
 # -------------------------------------------------------
+# Роздільник полів у відбитку замовлення (не зустрічається в даних таблиці)
+ORDER_FINGERPRINT_SEPARATOR = "\x1f"
+ORDER_FINGERPRINT_BACKFILL_BATCH = 5000
+
+# Простір ключів advisory lock для послідовного запису замовлень одного клієнта
+ORDER_CLIENT_LOCK_NAMESPACE = 7301
+
+# None - ще не перевірено, True/False - чи доступна колонка orders.match_fingerprint
+_order_fingerprint_ready = None
+
+def order_match_fingerprint(
+   client_id,
+   order_date,
+   order_status_id,
+   payment_status_id,
+   payment_status_text,
+   delivery_method_id,
+   delivery_status_id,
+   deferred_until,
+   priority_val,
+   notes
+):
+   """
+   Відбиток замовлення для точного пошуку в find_exact_order.
+   Має збігатися з тим, що обчислює тригер orders_match_fingerprint() у БД.
+   """
+   def date_str(value):
+       return value.strftime("%Y-%m-%d") if value else ""
+
+   parts = [
+       "" if client_id is None else str(client_id),
+       date_str(order_date) or "1970-01-01",
+       str(order_status_id or 0),
+       str(payment_status_id or 0),
+       payment_status_text or "",
+       str(delivery_method_id or 0),
+       str(delivery_status_id or 0),
+       date_str(deferred_until),
+       str(priority_val or 0),
+       notes or ""
+   ]
+   return hashlib.md5(ORDER_FINGERPRINT_SEPARATOR.join(parts).encode('utf-8')).hexdigest()
+
+def ensure_order_fingerprint(conn):
+   """
+   Міграція: додає orders.match_fingerprint, тригер, що підтримує його
+   актуальним при INSERT/UPDATE, індекс і заповнює відбиток для існуючих
+   замовлень (пакетами). Виконується один раз за процес.
+
+   Returns:
+       bool: True, якщо пошук за відбитком доступний
+   """
+   global _order_fingerprint_ready
+   if _order_fingerprint_ready is not None:
+       return _order_fingerprint_ready
+
+   # Викликається з init_tracking_tables під _schema_lock
+   cur = conn.cursor()
+   try:
+       cur.execute("""
+           SELECT column_name
+           FROM information_schema.columns
+           WHERE table_name='orders' AND column_name='match_fingerprint'
+       """)
+       if not cur.fetchone():
+           cur.execute("ALTER TABLE orders ADD COLUMN match_fingerprint VARCHAR(32)")
+           logger.info("Додано колонку match_fingerprint до таблиці orders")
+
+       cur.execute("""
+           CREATE OR REPLACE FUNCTION orders_match_fingerprint() RETURNS trigger AS $$
+           BEGIN
+               NEW.match_fingerprint := md5(concat_ws(E'\\x1f',
+                   coalesce(NEW.client_id::text, ''),
+                   to_char(coalesce(NEW.order_date, '1970-01-01'::date), 'YYYY-MM-DD'),
+                   coalesce(NEW.order_status_id, 0)::text,
+                   coalesce(NEW.payment_status_id, 0)::text,
+                   coalesce(NEW.payment_status, ''),
+                   coalesce(NEW.delivery_method_id, 0)::text,
+                   coalesce(NEW.delivery_status_id, 0)::text,
+                   coalesce(to_char(NEW.deferred_until, 'YYYY-MM-DD'), ''),
+                   coalesce(NEW.priority, 0)::text,
+                   coalesce(NEW.notes, '')
+               ));
+               RETURN NEW;
+           END;
+           $$ LANGUAGE plpgsql
+       """)
+       # Тригер та індекс створюються лише за відсутності: DROP/CREATE TRIGGER і
+       # CREATE INDEX блокують таблицю orders для інтерфейсу, що з нею працює.
+       # Тіло тригера оновлює CREATE OR REPLACE FUNCTION вище
+       cur.execute("""
+           SELECT EXISTS (SELECT 1 FROM pg_trigger
+                           WHERE tgrelid = 'orders'::regclass
+                             AND tgname = 'trg_orders_match_fingerprint'),
+                  to_regclass('idx_orders_match_fingerprint') IS NOT NULL
+       """)
+       trigger_exists, index_exists = cur.fetchone()
+       if not trigger_exists:
+           cur.execute("""
+               CREATE TRIGGER trg_orders_match_fingerprint
+                   BEFORE INSERT OR UPDATE ON orders
+                   FOR EACH ROW EXECUTE PROCEDURE orders_match_fingerprint()
+           """)
+           logger.info("Створено тригер trg_orders_match_fingerprint")
+       if not index_exists:
+           cur.execute("""
+               CREATE INDEX IF NOT EXISTS idx_orders_match_fingerprint
+                   ON orders (match_fingerprint)
+           """)
+       conn.commit()
+
+       # Заповнюємо відбиток для існуючих замовлень (тригер обчислює його при UPDATE)
+       backfilled = 0
+       while True:
+           cur.execute("""
+               UPDATE orders
+                  SET match_fingerprint = NULL
+                WHERE id IN (
+                    SELECT id FROM orders
+                     WHERE match_fingerprint IS NULL
+                     LIMIT %s
+                )
+           """, (ORDER_FINGERPRINT_BACKFILL_BATCH,))
+           updated = cur.rowcount
+           conn.commit()
+           backfilled += updated
+           if updated < ORDER_FINGERPRINT_BACKFILL_BATCH:
+               break
+       if backfilled:
+           logger.info(f"Заповнено відбиток для {backfilled} існуючих замовлень")
+
+       _order_fingerprint_ready = True
+   except Exception as e:
+       conn.rollback()
+       logger.error(f"Не вдалося підготувати відбитки замовлень, використовується повний пошук: {e}")
+       _order_fingerprint_ready = False
+   finally:
+       cur.close()
+   return _order_fingerprint_ready
+
 def find_exact_order(
    cursor,
    client_id,
@@ -731,10 +1822,36 @@ def find_exact_order(
              FROM orders
             WHERE tracking_number=%s
             LIMIT 1
-       """, (tracking_number,))
+       """, (tracking_number,))
+       row = cursor.fetchone()
+       if row:
+           return row[0]
+
+   if _order_fingerprint_ready:
+       # Один прохід по індексу idx_orders_match_fingerprint
+       cursor.execute("""
+           SELECT id
+             FROM orders
+            WHERE match_fingerprint=%s
+              AND client_id=%s
+            LIMIT 1
+       """, (
+           order_match_fingerprint(
+               client_id,
+               order_date,
+               order_status_id,
+               payment_status_id,
+               payment_status_text,
+               delivery_method_id,
+               delivery_status_id,
+               deferred_until,
+               priority_val,
+               notes
+           ),
+           client_id
+       ))
        row = cursor.fetchone()
-       if row:
-           return row[0]
+       return row[0] if row else None
 
    cursor.execute("""
        SELECT id
@@ -979,6 +2096,7 @@ def find_duplicate_order(cursor, client_id, product_numbers, order_date=None, pa
     logger.info(f"find_duplicate_order: Не знайдено дублікатів для клієнта '{client_name}' з продуктами: {', '.join(product_numbers)}")
     return None
 
+@traced_stage("create_or_update_order_details")
 def create_or_update_order_details(
    cursor,
    connection,
@@ -1018,7 +2136,7 @@ def create_or_update_order_details(
                   updated_at=now()
             WHERE id=%s
        """,(new_price, new_d_type, new_d_val, new_aop, new_aop_val, new_qty, detail_id))
-       connection.commit()
+       commit_unless_deferred(connection)
    else:
        cursor.execute("""
            INSERT INTO order_details (
@@ -1043,8 +2161,9 @@ def create_or_update_order_details(
             price if price is not None else 0.0,
             discount_type, discount_value,
             additional_operation_name, additional_operation_value))
-       connection.commit()
+       commit_unless_deferred(connection)
 
+@traced_stage("recalc_order_total")
 def recalc_order_total(cursor, connection, order_id, order_status_id):
    if not order_id:
        return
@@ -1055,7 +2174,7 @@ def recalc_order_total(cursor, connection, order_id, order_status_id):
                   updated_at=now()
             WHERE id=%s
        """,(order_id,))
-       connection.commit()
+       commit_unless_deferred(connection)
        return
 
    cursor.execute("""
@@ -1079,8 +2198,9 @@ def recalc_order_total(cursor, connection, order_id, order_status_id):
               updated_at=now()
         WHERE id=%s
    """,(sm, order_id))
-   connection.commit()
+   commit_unless_deferred(connection)
 
+@traced_stage("set_products_sold_if_paid")
 def set_products_sold_if_paid(cursor, connection, order_id, payment_status_text):
    if not order_id or not payment_status_text:
        return
@@ -1095,11 +2215,12 @@ def set_products_sold_if_paid(cursor, connection, order_id, payment_status_text)
                WHERE order_id=%s
             )
        """,(PRODUCT_STATUS_SOLD, order_id))
-       connection.commit()
+       commit_unless_deferred(connection)
 
 # -------------------------------------------------------
 #   Створення / оновлення замовлення (orders)
 # -------------------------------------------------------
+@traced_stage("upsert_order")
 def upsert_order(
    cursor,
    connection,
@@ -1168,7 +2289,7 @@ def upsert_order(
            payment_method_id_for_demo,
            existing_id
        ))
-       connection.commit()
+       commit_unless_deferred(connection)
        return existing_id
    else:
        cursor.execute("""
@@ -1214,7 +2335,7 @@ def upsert_order(
            payment_method_id_for_demo
        ))
        new_id = cursor.fetchone()[0]
-       connection.commit()
+       commit_unless_deferred(connection)
        return new_id
 
 # -------------------------------------------------------
@@ -1231,118 +2352,306 @@ def process_clients_sheet_data(rows, sheet_name):
    
    cur = conn.cursor()
 
-   for i, row in enumerate(rows[1:], start=2):
-       if len(row) < 8:
-           continue
-       
-       # Обчислюємо хеш рядка для перевірки змін
-       row_hash = compute_row_hash(row)
-       existing_hash_info = get_existing_row_hash(cur, sheet_name, i)
-       
-       # Пропускаємо рядок якщо хеш не змінився і він був успішно оброблений раніше
-       if existing_hash_info and existing_hash_info['hash'] == row_hash and existing_hash_info['is_processed']:
-           continue
-       
-       full_name = validate_text(row[0])
-       phone     = validate_text(row[1], max_length=20)
-       facebook  = validate_text(row[2], max_length=255)
-       viber     = validate_text(row[3], max_length=255)
-       telegram  = validate_text(row[4], max_length=255)
-       instagram = validate_text(row[5], max_length=255)
-       olx       = validate_text(row[6], max_length=255)
-       email     = validate_text(row[7], max_length=255)
-
-       if not full_name:
-           update_row_hash(cur, conn, sheet_name, i, row_hash, None, False, "Відсутнє ім'я клієнта")
-           continue
-           
-       try:
-           client_id = get_or_create_client(cur, conn, full_name)
-           if not client_id:
-               update_row_hash(cur, conn, sheet_name, i, row_hash, full_name, False, "Не вдалося створити клієнта")
+   # Знімок хешів аркуша: незмінені рядки відсіюються без звернень до БД
+   sheet_hashes = load_sheet_row_hashes(cur, sheet_name)
+   hash_buffer = RowHashWriteBuffer(conn, sheet_name)
+
+   # Хеші рядків зіставляються за вмістом: переміщені рядки не вважаються зміненими
+   hash_matcher = RowHashMatcher(sheet_hashes)
+
+   try:
+       # Спершу відсіюємо незмінені рядки, щоб не шукати й не створювати їх клієнтів
+       changed_rows = []
+       for i, row in enumerate(rows[1:], start=2):
+           if len(row) < 8:
+               continue
+        
+           # Обчислюємо хеш рядка для перевірки змін
+           row_hash = compute_row_hash(row)
+           existing_hash_info = hash_matcher.match(i, row_hash)
+        
+           # Пропускаємо рядок якщо хеш не змінився і він був успішно оброблений раніше
+           if existing_hash_info and existing_hash_info['hash'] == row_hash and existing_hash_info['is_processed']:
+               if 'moved_from' in existing_hash_info:
+                   # Рядок перемістився: переносимо запис хешу на новий індекс
+                   hash_buffer.add(i, row_hash, existing_hash_info['client_name'])
                continue
+           changed_rows.append((i, row, row_hash))
 
-           cur.execute("""
-               SELECT phone_number, facebook, viber, telegram, instagram, olx, email
-                 FROM clients
-                WHERE id=%s
-           """,(client_id,))
-           ex = cur.fetchone()
-           if not ex:
-               update_row_hash(cur, conn, sheet_name, i, row_hash, full_name, False, "Клієнт не знайдений після створення")
+       # Нових клієнтів змінених рядків створюємо одним пакетом
+       client_resolver.prefetch(validate_text(row[0]) for _, row, _ in changed_rows)
+
+       for i, row, row_hash in changed_rows:
+           full_name = validate_text(row[0])
+           phone     = validate_text(row[1], max_length=20)
+           facebook  = validate_text(row[2], max_length=255)
+           viber     = validate_text(row[3], max_length=255)
+           telegram  = validate_text(row[4], max_length=255)
+           instagram = validate_text(row[5], max_length=255)
+           olx       = validate_text(row[6], max_length=255)
+           email     = validate_text(row[7], max_length=255)
+
+           if not full_name:
+               hash_buffer.add(i, row_hash, None, False, "Відсутнє ім'я клієнта")
                continue
-               
-           ex_phone, ex_fb, ex_vb, ex_tg, ex_ig, ex_olx, ex_em = ex
-
-           update_fields = []
-           update_vals = []
-
-           def maybe_update_phone(new_phone, old_phone):
-               if new_phone and (not old_phone or not old_phone.strip()):
-                   cur.execute("SELECT id FROM clients WHERE phone_number=%s",(new_phone,))
-                   conf = cur.fetchone()
-                   if conf and conf[0] != client_id:
-                       logger.warning(
-                           f"[{sheet_name} row={i}] Телефон {new_phone} вже зайнятий іншим (id={conf[0]})."
-                       )
-                       return
-                   update_fields.append("phone_number=%s")
-                   update_vals.append(new_phone)
-
-           def maybe_update(field_name, new_val, old_val):
-               if new_val and (not old_val or not old_val.strip()):
-                   update_fields.append(f"{field_name}=%s")
-                   update_vals.append(new_val)
-
-           maybe_update_phone(phone, ex_phone)
-           maybe_update("facebook", facebook, ex_fb)
-           maybe_update("viber", viber, ex_vb)
-           maybe_update("telegram", telegram, ex_tg)
-           maybe_update("instagram", instagram, ex_ig)
-           maybe_update("olx", olx, ex_olx)
-           maybe_update("email", email, ex_em)
-
-           if update_fields:
-               sql_str = "UPDATE clients SET " + ", ".join(update_fields) + ", updated_at=now() WHERE id=%s"
-               update_vals.append(client_id)
-               cur.execute(sql_str, tuple(update_vals))
-               conn.commit()
-               
-           # Оновлюємо хеш рядка після успішної обробки
-           update_row_hash(cur, conn, sheet_name, i, row_hash, full_name, True)
-
-       except Exception as e:
-           logger.error(f"[{sheet_name}] Рядок {i} => Помилка: {e}")
-           conn.rollback()
-           update_row_hash(cur, conn, sheet_name, i, row_hash, full_name, False, str(e))
-   
-   # Оновлюємо прогрес обробки аркуша
-   update_sheet_progress(cur, conn, sheet_name, len(rows))
+            
+           try:
+               client_id = get_or_create_client(cur, conn, full_name)
+               if not client_id:
+                   hash_buffer.add(i, row_hash, full_name, False, "Не вдалося створити клієнта")
+                   continue
+
+               cur.execute("""
+                   SELECT phone_number, facebook, viber, telegram, instagram, olx, email
+                     FROM clients
+                    WHERE id=%s
+               """,(client_id,))
+               ex = cur.fetchone()
+               if not ex:
+                   hash_buffer.add(i, row_hash, full_name, False, "Клієнт не знайдений після створення")
+                   continue
+                
+               ex_phone, ex_fb, ex_vb, ex_tg, ex_ig, ex_olx, ex_em = ex
+
+               update_fields = []
+               update_vals = []
+
+               def maybe_update_phone(new_phone, old_phone):
+                   if new_phone and (not old_phone or not old_phone.strip()):
+                       cur.execute("SELECT id FROM clients WHERE phone_number=%s",(new_phone,))
+                       conf = cur.fetchone()
+                       if conf and conf[0] != client_id:
+                           logger.warning(
+                               f"[{sheet_name} row={i}] Телефон {new_phone} вже зайнятий іншим (id={conf[0]})."
+                           )
+                           return
+                       update_fields.append("phone_number=%s")
+                       update_vals.append(new_phone)
+
+               def maybe_update(field_name, new_val, old_val):
+                   if new_val and (not old_val or not old_val.strip()):
+                       update_fields.append(f"{field_name}=%s")
+                       update_vals.append(new_val)
+
+               maybe_update_phone(phone, ex_phone)
+               maybe_update("facebook", facebook, ex_fb)
+               maybe_update("viber", viber, ex_vb)
+               maybe_update("telegram", telegram, ex_tg)
+               maybe_update("instagram", instagram, ex_ig)
+               maybe_update("olx", olx, ex_olx)
+               maybe_update("email", email, ex_em)
+
+               if update_fields:
+                   sql_str = "UPDATE clients SET " + ", ".join(update_fields) + ", updated_at=now() WHERE id=%s"
+                   update_vals.append(client_id)
+                   cur.execute(sql_str, tuple(update_vals))
+                   conn.commit()
+                
+               # Оновлюємо хеш рядка після успішної обробки
+               hash_buffer.add(i, row_hash, full_name, True)
+
+           except Exception as e:
+               logger.error(f"[{sheet_name}] Рядок {i} => Помилка: {e}")
+               conn.rollback()
+               hash_buffer.add(i, row_hash, full_name, False, str(e))
+
+       # Оновлюємо прогрес обробки аркуша (зберігається разом з останніми хешами)
+       hash_buffer.set_progress(len(rows))
+       # Записи рядків, яких більше немає в аркуші, видаляємо (останній рядок має індекс len(rows))
+       hash_buffer.prune_after(len(rows))
+   finally:
+       # Зберігаємо буфер хешів навіть при аварійному виході з циклу
+       hash_buffer.flush()
    cur.close()
    conn.close()
 
+# -------------------------------------------------------
+#   Транзакція на групу рядків замовлень
+# -------------------------------------------------------
+class ChunkedRowTransaction:
+    """
+    Одна транзакція на кілька рядків аркуша замовлень.
+
+    Кожен рядок виконується всередині SAVEPOINT: помилка рядка відкочує лише
+    його зміни, решта рядків групи залишається. Коміт - раз на commit_every
+    рядків і в кінці аркуша. Поки об'єкт відкритий, допоміжні функції запису
+    не комітять самі (див. commit_unless_deferred).
+
+    Хеші успішних рядків передаються в hash_buffer лише після коміту групи,
+    щоб рядок не позначався обробленим, поки його зміни не зафіксовані.
+    Якщо коміт не вдався, рядки групи потрапляють у lost_rows.
+
+    Advisory lock клієнтів (lock_client) теж знімаються лише після коміту або
+    відкату групи: інакше інший аркуш міг би взяти блокування клієнта і не
+    побачити ще не зафіксоване замовлення (дублікат).
+    """
+
+    SAVEPOINT = "order_row"
+
+    def __init__(self, connection, hash_buffer, commit_every=None):
+        self.connection = connection
+        self.cursor = connection.cursor()
+        self.hash_buffer = hash_buffer
+        self.commit_every = commit_every or ORDERS_COMMIT_EVERY
+        self.lost_rows = []
+        self.commits = 0
+        self._pending = []
+        self._row_open = False
+        # (namespace, client_id) для кожного взятого advisory lock
+        self._client_locks = []
+        _commit_scope.connection = connection
+
+    def begin_row(self):
+        self.cursor.execute(f"SAVEPOINT {self.SAVEPOINT}")
+        self._row_open = True
+
+    def release_row(self, row_index, row_hash, client_name):
+        """Рядок оброблено успішно; при заповненні групи - коміт."""
+        self.cursor.execute(f"RELEASE SAVEPOINT {self.SAVEPOINT}")
+        self._row_open = False
+        self._pending.append((row_index, row_hash, client_name))
+        if len(self._pending) >= self.commit_every:
+            self.commit()
+
+    def rollback_row(self):
+        """
+        Відкочує зміни незавершеного рядка (якщо він є). Якщо відкотити SAVEPOINT
+        не вдалося, відкочується вся група (abort).
+        """
+        if not self._row_open:
+            return
+        try:
+            self.cursor.execute(f"ROLLBACK TO SAVEPOINT {self.SAVEPOINT}")
+            self._row_open = False
+        except psycopg2.Error as e:
+            logger.error(f"[{self.hash_buffer.sheet_name}] Не вдалося відкотити рядок до SAVEPOINT: {e}")
+            self.abort()
+
+    def lock_client(self, namespace, client_id):
+        """
+        Advisory lock клієнта для паралельної обробки аркушів. Якщо блокування
+        зайняте, перед очікуванням фіксуємо групу, щоб не тримати блокувань рядків.
+        """
+        self.cursor.execute("SELECT pg_try_advisory_lock(%s, %s)", (namespace, client_id))
+        if self.cursor.fetchone()[0]:
+            self._client_locks.append((namespace, client_id))
+            return
+        self._row_open = False
+        self.commit()
+        self.cursor.execute("SELECT pg_advisory_lock(%s, %s)", (namespace, client_id))
+        self._client_locks.append((namespace, client_id))
+        self.begin_row()
+
+    def _release_client_locks(self):
+        """Знімає advisory lock клієнтів групи (після коміту або відкату)."""
+        locks, self._client_locks = self._client_locks, []
+        if not locks or self.connection.closed:
+            return
+        try:
+            self.cursor.execute(
+                "SELECT pg_advisory_unlock(l.namespace, l.client_id) "
+                "FROM unnest(%s::int[], %s::int[]) AS l(namespace, client_id)",
+                ([namespace for namespace, _ in locks], [client_id for _, client_id in locks])
+            )
+            # Зняття блокувань не транзакційне - завершуємо транзакцію запиту без змін
+            self.connection.rollback()
+        except psycopg2.Error as e:
+            logger.error(f"[{self.hash_buffer.sheet_name}] Не вдалося зняти блокування клієнтів: {e}")
+
+    def commit(self):
+        """
+        Фіксує групу рядків і передає їх хеші в hash_buffer.
+
+        Returns:
+            bool: True, якщо коміт вдався
+        """
+        try:
+            self.connection.commit()
+        except psycopg2.Error as e:
+            logger.error(f"[{self.hash_buffer.sheet_name}] Помилка коміту групи з {len(self._pending)} рядків: {e}")
+            self.abort()
+            return False
+        self._release_client_locks()
+        for row_index, row_hash, client_name in self._pending:
+            self.hash_buffer.add(row_index, row_hash, client_name, True)
+        self._pending.clear()
+        self.commits += 1
+        return True
+
+    def abort(self):
+        """Відкочує всю групу (наприклад, після обриву з'єднання); її рядки - у lost_rows."""
+        try:
+            self.connection.rollback()
+        except psycopg2.Error:
+            pass
+        self._release_client_locks()
+        self.lost_rows.extend(self._pending)
+        self._pending.clear()
+        self._row_open = False
+
+    def take_lost_rows(self):
+        lost, self.lost_rows = self.lost_rows, []
+        return lost
+
+    def close(self):
+        """Знімає відкладення комітів; незафіксовані зміни не зберігаються."""
+        if commits_deferred(self.connection):
+            _commit_scope.connection = None
+        if self._client_locks:
+            try:
+                if not self.connection.closed:
+                    self.connection.rollback()
+            except psycopg2.Error:
+                pass
+            self._release_client_locks()
+        try:
+            self.cursor.close()
+        except psycopg2.Error:
+            pass
+
 # -------------------------------------------------------
 #   Обробка замовлень (основна логіка)
 # -------------------------------------------------------
-def process_orders_sheet_data(rows, sheet_name, force_process=False):
+def process_orders_sheet_data(rows, sheet_name, force_process=False, client_locks=False, fingerprint=None,
+                              prune_stale_rows=False):
     """
     Обробляє дані з аркуша Google Sheets і додає/оновлює замовлення в базі даних.
     
+    Рядки обробляються потоково: читання й хешування (iter_row_windows) ->
+    пакетне визначення клієнтів і продуктів для вікна рядків -> запис у БД.
+    Запис фіксується групами по ORDERS_COMMIT_EVERY рядків (SAVEPOINT на рядок,
+    див. ChunkedRowTransaction).
+
     Args:
-        rows: Рядки даних з аркуша
+        rows: Рядки даних з аркуша (без заголовка); список або генератор
         sheet_name: Назва аркуша
         force_process: Якщо True, обробляє всі рядки незалежно від хешу
+        client_locks: Якщо True, замовлення одного клієнта записуються під
+            advisory lock (для паралельної обробки кількох аркушів)
+        fingerprint: відбиток аркуша, знятий до завантаження даних; зберігається,
+            лише якщо аркуш оброблено без помилок (див. find_unchanged_sheets)
+        prune_stale_rows: True, якщо rows - увесь аркуш: тоді зберігається прогрес
+            аркуша і видаляються хеші рядків за його межами. Для вибірки рядків
+            (retry_failed_rows) має лишатися False
+
+    Returns:
+        list: помилки парсингу цього аркуша
     """
     global parsing_errors
-    parsing_errors = []  # Очищаємо список помилок перед новим парсингом
+    # Помилки збираються локально: аркуші можуть оброблятися паралельно
+    sheet_errors = []
+    # Час етапів обробки записується для цього аркуша (див. stage_timer)
+    stage_timer.set_sheet(sheet_name)
+    sheet_started = time.perf_counter()
     
     # Загальне підключення до БД для операцій з хешами рядків
     conn = connect_to_db_with_isolation(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
     if not conn:
         error_msg = "Не вдалося підключитися до БД (processing 'Замовлення')."
         logger.error(error_msg)
-        parsing_errors.append({"sheet": sheet_name, "row": 0, "error": error_msg, "client": "Немає"})
-        return parsing_errors
+        sheet_errors.append({"sheet": sheet_name, "row": 0, "error": error_msg, "client": "Немає"})
+        parsing_errors = sheet_errors
+        return sheet_errors
     
     # Ініціалізуємо таблиці відстеження
     init_tracking_tables(conn)
@@ -1352,6 +2661,7 @@ def process_orders_sheet_data(rows, sheet_name, force_process=False):
     orders_added = 0
     orders_updated = 0
     rows_no_changes = 0
+    rows_moved = 0
     rows_invalid = 0
     rows_errors = 0
     rows_processed = 0
@@ -1361,10 +2671,10 @@ def process_orders_sheet_data(rows, sheet_name, force_process=False):
 
     # Оновлюємо статус парсингу
     update_parsing_status("current_sheet", sheet_name)
-    update_parsing_status("total_rows", len(rows))
     update_parsing_status("processed_rows", 0)
-
-    logger.info(f"[{sheet_name}] Всього рядків для обробки: {len(rows)}")
+    if hasattr(rows, "__len__"):
+        update_parsing_status("total_rows", len(rows))
+        logger.info(f"[{sheet_name}] Всього рядків для обробки: {len(rows)}")
     
     # Перевірка, чи аркуш є новим (від 07.03.2025)
     is_new_sheet = False
@@ -1381,529 +2691,617 @@ def process_orders_sheet_data(rows, sheet_name, force_process=False):
     # Створюємо курсор для основного з'єднання
     cur = conn.cursor()
 
-    # У workers.py рядки створюються з data[1:], тому індекс 0 у rows[] фактично є другим рядком в xlsx
-    for i, row in enumerate(rows, start=1):
-        # Оновлюємо статус обробки
-        update_parsing_status("processed_rows", i)
-        
-        actual_row_index = i + 1  # Справжній індекс рядка в таблиці (з урахуванням заголовків)
-        client_name = None  # Ініціалізуємо для коректної обробки помилок
+    # Знімок хешів аркуша одним запитом: незмінені рядки відсіюються без звернень до БД
+    try:
+        sheet_hashes = load_sheet_row_hashes(cur, sheet_name)
+    except psycopg2.Error as e:
+        conn.rollback()
+        logger.error(f"[{sheet_name}] Не вдалося завантажити хеші рядків: {e}")
+        sheet_hashes = {}
+    hash_buffer = RowHashWriteBuffer(conn, sheet_name)
+
+    # Рядки зіставляються зі збереженими хешами за вмістом, тому вставка чи
+    # видалення рядка вище не робить "зміненими" всі рядки нижче
+    hash_matcher = RowHashMatcher(sheet_hashes)
+    product_resolver = ProductBatchResolver()
+
+    def resolved_rows():
+        """
+        Етап визначення ID: для кожного вікна рядків пакетно створює клієнтів
+        і продукти змінених рядків, щоб у циклі запису вони знаходились
+        пошуком у словнику.
+
+        Yields:
+            tuple: (row_index, row, row_hash, existing_hash_info)
+        """
+        windows = iter_row_windows(OrderRow.from_values(row) for row in rows)
+        try:
+            for window in windows:
+                resolved = []
+                changed_client_names = []
+                window_product_numbers = set()
+                window_clone_originals = set()
+                hash_check_started = time.perf_counter()
+                for row_index, row, row_hash in window:
+                    existing_hash_info = hash_matcher.match(row_index, row_hash) if row_hash is not None else None
+                    resolved.append((row_index, row, row_hash, existing_hash_info))
+                    if row_hash is None:
+                        continue
+                    if force_process or (is_new_sheet and row_index == 2) or not existing_hash_info:
+                        changed_client_names.append(validate_text(row.client_name))
+                        raw_products = validate_text(row.products)
+                        raw_clones = validate_text(row.clones)
+                        if raw_products or raw_clones:
+                            product_numbers, processed_clone_numbers, _clones, clone_originals = \
+                                parse_product_numbers(raw_products, raw_clones)
+                            window_product_numbers.update(product_numbers + processed_clone_numbers or ["???"])
+                            window_clone_originals.update(o for o in clone_originals.values() if o != "???")
+                stage_timer.record("hash_check", time.perf_counter() - hash_check_started)
+                client_resolver.prefetch(changed_client_names)
+                product_resolver.prefetch(window_product_numbers, window_clone_originals)
+                yield from resolved
+        finally:
+            windows.close()
+
+    # Транзакційне з'єднання береться з пулу один раз на аркуш і повторно
+    # використовується для всіх рядків. При ORDERS_COMMIT_EVERY > 1 рядки
+    # фіксуються групами (ChunkedRowTransaction), інакше кожен рядок - окрема транзакція
+    transaction_conn = None
+    transaction_cur = None
+    chunk = None
+
+    def fail_uncommitted_rows(lost_rows):
+        """Рядки групи, зміни яких не вдалося зафіксувати, записуються як помилки."""
+        for row_index, row_hash, row_client_name in lost_rows:
+            error_msg = "Зміни рядка не збережено: не вдалося зафіксувати групу рядків"
+            logger.error(f"[{sheet_name}] Рядок {row_index}: {error_msg}")
+            sheet_errors.append({"sheet": sheet_name, "row": row_index, "error": error_msg, "client": row_client_name or "Немає"})
+            hash_buffer.add(row_index, row_hash, row_client_name, False, error_msg)
+        return len(lost_rows)
+
+    # У workers.py рядки створюються з data[1:], тому перший рядок rows фактично є другим рядком в xlsx
+    row_stream = resolved_rows()
+    rows_seen = 0
+    try:
+        for actual_row_index, row, row_hash, existing_hash_info in row_stream:
+            # Оновлюємо статус обробки
+            rows_seen = actual_row_index - 1
+            update_parsing_status("processed_rows", rows_seen)
         
-        # Створюємо окреме підключення для кожного рядка
-        # Це дозволяє іншим частинам програми отримувати доступ до даних поки ми оновлюємо
-        transaction_conn = None
-        transaction_cur = None
+            client_name = None  # Ініціалізуємо для коректної обробки помилок
+            locked_client_id = None
         
-        try:
-            if len(row) < 26:
-                error_msg = f"[{sheet_name}] Рядок {actual_row_index}: мало колонок (очікувалось ~26, отримано {len(row)}). Пропуск."
-                logger.warning(error_msg)
-                parsing_errors.append({"sheet": sheet_name, "row": actual_row_index, "error": error_msg, "client": "Немає"})
-                rows_invalid += 1
-                continue
+            try:
+                if len(row) < 26:
+                    error_msg = f"[{sheet_name}] Рядок {actual_row_index}: мало колонок (очікувалось ~26, отримано {len(row)}). Пропуск."
+                    logger.warning(error_msg)
+                    sheet_errors.append({"sheet": sheet_name, "row": actual_row_index, "error": error_msg, "client": "Немає"})
+                    rows_invalid += 1
+                    continue
 
-            # Перевіряємо, чи не пустий рядок
-            row_has_data = False
-            for cell in row:
-                if cell:
-                    row_has_data = True
-                    break
+                # Перевіряємо, чи не пустий рядок
+                row_has_data = False
+                for cell in row:
+                    if cell:
+                        row_has_data = True
+                        break
             
-            if not row_has_data:
-                logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: порожній рядок, пропускаємо")
-                rows_invalid += 1
-                continue
+                if not row_has_data:
+                    logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: порожній рядок, пропускаємо")
+                    rows_invalid += 1
+                    continue
 
-            # Обчислюємо хеш рядка
-            row_hash = compute_row_hash(row)
-            existing_hash_info = get_existing_row_hash(cur, sheet_name, actual_row_index)
+                # Якщо це новий аркуш (від 07.03.2025) або увімкнено режим примусової обробки,
+                # обробляємо рядок в будь-якому разі
+                force_row_process = force_process or (is_new_sheet and actual_row_index == 2)
             
-            # Якщо це новий аркуш (від 07.03.2025) або увімкнено режим примусової обробки,
-            # обробляємо рядок в будь-якому разі
-            force_row_process = force_process or (is_new_sheet and actual_row_index == 2)
+                if force_row_process and actual_row_index == 2:
+                    logger.info(f"[{sheet_name}] Примусово обробляємо рядок 2 (перший після заголовків)")
             
-            if force_row_process and actual_row_index == 2:
-                logger.info(f"[{sheet_name}] Примусово обробляємо рядок 2 (перший після заголовків)")
+                # Якщо хеш не змінився і був успішно оброблений раніше, пропускаємо рядок, 
+                # але тільки якщо не увімкнений форсований режим і це не примусово оброблюваний рядок
+                if not force_row_process and existing_hash_info and existing_hash_info['hash'] == row_hash and existing_hash_info['is_processed']:
+                    if 'moved_from' in existing_hash_info:
+                        # Рядок лише перемістився: переносимо запис хешу на новий індекс
+                        logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: переміщено з рядка {existing_hash_info['moved_from']}, пропускаємо")
+                        hash_buffer.add(actual_row_index, row_hash, existing_hash_info['client_name'])
+                        rows_moved += 1
+                    else:
+                        logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: хеш не змінився, пропускаємо")
+                    rows_no_changes += 1
+                    continue
             
-            # Якщо хеш не змінився і був успішно оброблений раніше, пропускаємо рядок, 
-            # але тільки якщо не увімкнений форсований режим і це не примусово оброблюваний рядок
-            if not force_row_process and existing_hash_info and existing_hash_info['hash'] == row_hash and existing_hash_info['is_processed']:
-                logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: хеш не змінився, пропускаємо")
-                rows_no_changes += 1
-                continue
+                # Якщо хеш не змінився, але була помилка раніше і не увімкнений примусовий режим - пропускаємо
+                if not force_row_process and existing_hash_info and existing_hash_info['hash'] == row_hash and not existing_hash_info['is_processed']:
+                    error_msg = f"[{sheet_name}] Рядок {actual_row_index}: хеш не змінився, але раніше була помилка: {existing_hash_info['error_message']}"
+                    logger.info(error_msg)
+                    sheet_errors.append({"sheet": sheet_name, "row": actual_row_index, "error": existing_hash_info['error_message'],
+                                         "client": existing_hash_info.get('client_name', 'Немає'), "repeated": True})
+                    if 'moved_from' in existing_hash_info:
+                        hash_buffer.add(actual_row_index, row_hash, existing_hash_info['client_name'],
+                                        False, existing_hash_info['error_message'])
+                    rows_errors += 1
+                    continue
+
+                # Беремо транзакційне з'єднання з пулу (один раз на аркуш або після обриву)
+                if transaction_conn is None or transaction_conn.closed:
+                    if transaction_conn is not None:
+                        transaction_conn.close()  # обірване з'єднання повертається в пул і відкидається
+                    transaction_conn = connect_to_db_with_isolation(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+                    if not transaction_conn:
+                        error_msg = f"[{sheet_name}] Не вдалося створити з'єднання для обробки рядка {actual_row_index}"
+                        logger.error(error_msg)
+                        sheet_errors.append({"sheet": sheet_name, "row": actual_row_index, "error": error_msg, "client": "Немає"})
+                        continue
+                    transaction_cur = transaction_conn.cursor()
+                    if ORDERS_COMMIT_EVERY > 1:
+                        chunk = ChunkedRowTransaction(transaction_conn, hash_buffer)
+                if chunk is not None:
+                    chunk.begin_row()
             
-            # Якщо хеш не змінився, але була помилка раніше і не увімкнений примусовий режим - пропускаємо
-            if not force_row_process and existing_hash_info and existing_hash_info['hash'] == row_hash and not existing_hash_info['is_processed']:
-                error_msg = f"[{sheet_name}] Рядок {actual_row_index}: хеш не змінився, але раніше була помилка: {existing_hash_info['error_message']}"
-                logger.info(error_msg)
-                parsing_errors.append({"sheet": sheet_name, "row": actual_row_index, "error": existing_hash_info['error_message'], "client": existing_hash_info.get('client_name', 'Немає')})
-                rows_errors += 1
-                continue
+                # Отримуємо дані з рядка
+                raw_products        = validate_text(row.products)
+                raw_clones          = validate_text(row.clones)
+                client_name         = validate_text(row.client_name)
 
-            # Тепер створюємо окреме підключення для транзакції обробки рядка
-            transaction_conn = connect_to_db_with_isolation(psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
-            if not transaction_conn:
-                error_msg = f"[{sheet_name}] Не вдалося створити з'єднання для обробки рядка {actual_row_index}"
-                logger.error(error_msg)
-                parsing_errors.append({"sheet": sheet_name, "row": actual_row_index, "error": error_msg, "client": "Немає"})
-                continue
-                
-            transaction_cur = transaction_conn.cursor()
-            
-            # Отримуємо дані з рядка
-            raw_products        = validate_text(row[0])
-            raw_clones          = validate_text(row[1])
-            client_name         = validate_text(row[2])
-
-            raw_prices          = validate_text(row[10])
-            op_str              = validate_text(row[11])
-            disc_str            = validate_text(row[12])
-
-            raw_order_status    = validate_text(row[14])
-            raw_payment_status  = validate_text(row[15])
-            raw_delivery_method = validate_text(row[16])
-
-            note_r              = validate_text(row[17])
-            note_s              = validate_text(row[18])
-
-            raw_delivery_status = validate_text(row[21])
-            tracking_number     = validate_text(row[22])
-            raw_deferred_until  = validate_text(row[24])
-            raw_priority        = validate_text(row[25])
-
-            # Логування важливих деталей рядка
-            logger.info(f"[{sheet_name}] Рядок {actual_row_index}: Клієнт='{client_name}', " +
-                        f"Продукти='{raw_products}', Клони='{raw_clones}', " +
-                        f"Статус='{raw_order_status}', Оплата='{raw_payment_status}', " +
-                        f"Доставка='{raw_delivery_method}', " +
-                        f"Статус доставки='{raw_delivery_status}'")
-            
-            # Перевірка наявності продуктів
-            if not raw_products and not raw_clones:
-                error_msg = f"[{sheet_name}] Рядок {actual_row_index}: відсутні номери продуктів та клонів"
-                logger.warning(error_msg)
-                parsing_errors.append({"sheet": sheet_name, "row": actual_row_index, "error": error_msg, "client": client_name or "Немає"})
-                rows_invalid += 1
-                continue
+                raw_prices          = validate_text(row.prices)
+                op_str              = validate_text(row.additional_operation)
+                disc_str            = validate_text(row.discount)
+
+                raw_order_status    = validate_text(row.order_status)
+                raw_payment_status  = validate_text(row.payment_status)
+                raw_delivery_method = validate_text(row.delivery_method)
+
+                note_r              = validate_text(row.notes)
+                note_s              = validate_text(row.notes_extra)
+
+                raw_delivery_status = validate_text(row.delivery_status)
+                tracking_number     = validate_text(row.tracking_number)
+                raw_deferred_until  = validate_text(row.deferred_until)
+                raw_priority        = validate_text(row.priority)
+
+                # Логування важливих деталей рядка
+                logger.info(f"[{sheet_name}] Рядок {actual_row_index}: Клієнт='{client_name}', " +
+                            f"Продукти='{raw_products}', Клони='{raw_clones}', " +
+                            f"Статус='{raw_order_status}', Оплата='{raw_payment_status}', " +
+                            f"Доставка='{raw_delivery_method}', " +
+                            f"Статус доставки='{raw_delivery_status}'")
+            
+                # Перевірка наявності продуктів
+                if not raw_products and not raw_clones:
+                    error_msg = f"[{sheet_name}] Рядок {actual_row_index}: відсутні номери продуктів та клонів"
+                    logger.warning(error_msg)
+                    sheet_errors.append({"sheet": sheet_name, "row": actual_row_index, "error": error_msg, "client": client_name or "Немає"})
+                    rows_invalid += 1
+                    continue
                 
-            # Обробка клієнта (порожнє поле - це нормально, створюємо "Невідомий")
-            if not client_name:
-                logger.info(f"[{sheet_name}] Рядок {actual_row_index}: відсутнє ім'я клієнта, використовуємо клієнта за замовчуванням")
-                client_id = get_or_create_default_client(transaction_cur, transaction_conn)
-            else:
-                client_id = get_or_create_client(transaction_cur, transaction_conn, client_name)
-                if not client_id:
-                    logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: не вдалося створити клієнта '{client_name}', використовуємо клієнта за замовчуванням")
+                # Обробка клієнта (порожнє поле - це нормально, створюємо "Невідомий")
+                if not client_name:
+                    logger.info(f"[{sheet_name}] Рядок {actual_row_index}: відсутнє ім'я клієнта, використовуємо клієнта за замовчуванням")
                     client_id = get_or_create_default_client(transaction_cur, transaction_conn)
-
-            # Обробка дати відкладення
-            deferred_until = parse_date_dd_mm_yyyy(raw_deferred_until)
-            if deferred_until:
-                logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: замовлення відкладене до {deferred_until}")
-                low_ps = (raw_payment_status or "").strip().lower()
-                if low_ps in ("оплачено","доплатити"):
-                    logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: оплачене відкладене замовлення, встановлюємо метод доставки 'відкладено'")
-                    raw_delivery_method = "відкладено"
-                else:
-                    if not raw_payment_status or not raw_payment_status.strip():
-                        logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: неоплачене відкладене замовлення, встановлюємо статус оплати 'Відкладено'")
-                        raw_payment_status = "Відкладено"
-
-            # Обробка статусів замовлення
-            order_status_id = None
-            if raw_order_status:
-                st = raw_order_status.strip().lower()
-                if st == "підтвердженно":
-                    st = "підтверджено"
-                order_status_id = ORDER_STATUS_MAP.get(st)
-                if not order_status_id:
-                    logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: невідомий статус замовлення '{raw_order_status}'")
-
-            payment_status_id = None
-            payment_status_text = "Не оплачено"
-            if raw_payment_status:
-                ps = raw_payment_status.strip().lower()
-                payment_status_id = PAYMENT_STATUS_MAP.get(ps)
-                payment_status_text = raw_payment_status
-                if not payment_status_id:
-                    logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: невідомий статус оплати '{raw_payment_status}'")
-
-            delivery_method_id = None
-            if raw_delivery_method:
-                dm = raw_delivery_method.strip().lower()
-                delivery_method_id = DELIVERY_METHOD_MAP.get(dm)
-                if not delivery_method_id:
-                    logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: невідомий метод доставки '{raw_delivery_method}'")
-
-            delivery_status_id = None
-            if raw_delivery_status:
-                ds = raw_delivery_status.strip().lower()
-                delivery_status_id = DELIVERY_STATUS_MAP.get(ds)
-                if not delivery_status_id:
-                    logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: невідомий статус доставки '{raw_delivery_status}'")
-
-            # Додаткові примітки можуть містити ID замовлення
-            notes = ""
-            exact_order_id = None
-            
-            if note_r:
-                notes += note_r
-                # Перевіряємо, чи є в примітці ID замовлення
-                order_id_match = re.search(r'OrderID[:=](\d+)', note_r)
-                if order_id_match:
-                    try:
-                        exact_order_id = int(order_id_match.group(1))
-                        logger.info(f"[{sheet_name}] Рядок {actual_row_index}: знайдено ID замовлення {exact_order_id} в примітці")
-                    except ValueError:
-                        logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: некоректний ID замовлення в примітці")
-                    
-            if note_s:
-                if notes:
-                    notes += " | " + note_s
                 else:
-                    notes = note_s
-                # Перевіряємо, чи є в примітці ID замовлення, якщо ще не знайдено
-                if exact_order_id is None:
-                    order_id_match = re.search(r'OrderID[:=](\d+)', note_s)
+                    client_id = get_or_create_client(transaction_cur, transaction_conn, client_name)
+                    if not client_id:
+                        logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: не вдалося створити клієнта '{client_name}', використовуємо клієнта за замовчуванням")
+                        client_id = get_or_create_default_client(transaction_cur, transaction_conn)
+
+                # У паралельному режимі замовлення одного клієнта з різних аркушів
+                # записуються по черзі. Перед очікуванням фіксуємо транзакцію,
+                # щоб не тримати блокувань рядків
+                if client_locks and client_id:
+                    if chunk is not None:
+                        chunk.lock_client(ORDER_CLIENT_LOCK_NAMESPACE, client_id)
+                    else:
+                        transaction_conn.commit()
+                        transaction_cur.execute("SELECT pg_advisory_lock(%s, %s)", (ORDER_CLIENT_LOCK_NAMESPACE, client_id))
+                    locked_client_id = client_id
+
+                # Обробка дати відкладення
+                deferred_until = parse_date_dd_mm_yyyy(raw_deferred_until)
+                if deferred_until:
+                    logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: замовлення відкладене до {deferred_until}")
+                    low_ps = (raw_payment_status or "").strip().lower()
+                    if low_ps in ("оплачено","доплатити"):
+                        logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: оплачене відкладене замовлення, встановлюємо метод доставки 'відкладено'")
+                        raw_delivery_method = "відкладено"
+                    else:
+                        if not raw_payment_status or not raw_payment_status.strip():
+                            logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: неоплачене відкладене замовлення, встановлюємо статус оплати 'Відкладено'")
+                            raw_payment_status = "Відкладено"
+
+                # Обробка статусів замовлення
+                order_status_id = None
+                if raw_order_status:
+                    st = raw_order_status.strip().lower()
+                    if st == "підтвердженно":
+                        st = "підтверджено"
+                    order_status_id = dimension_cache.get_id("order_status", st)
+                    if not order_status_id:
+                        logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: невідомий статус замовлення '{raw_order_status}'")
+
+                payment_status_id = None
+                payment_status_text = "Не оплачено"
+                if raw_payment_status:
+                    payment_status_id = dimension_cache.get_id("payment_status", raw_payment_status)
+                    payment_status_text = raw_payment_status
+                    if not payment_status_id:
+                        logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: невідомий статус оплати '{raw_payment_status}'")
+
+                delivery_method_id = None
+                if raw_delivery_method:
+                    delivery_method_id = dimension_cache.get_id("delivery_method", raw_delivery_method)
+                    if not delivery_method_id:
+                        logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: невідомий метод доставки '{raw_delivery_method}'")
+
+                delivery_status_id = None
+                if raw_delivery_status:
+                    delivery_status_id = dimension_cache.get_id("delivery_status", raw_delivery_status)
+                    if not delivery_status_id:
+                        logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: невідомий статус доставки '{raw_delivery_status}'")
+
+                # Додаткові примітки можуть містити ID замовлення
+                notes = ""
+                exact_order_id = None
+            
+                if note_r:
+                    notes += note_r
+                    # Перевіряємо, чи є в примітці ID замовлення
+                    order_id_match = re.search(r'OrderID[:=](\d+)', note_r)
                     if order_id_match:
                         try:
                             exact_order_id = int(order_id_match.group(1))
                             logger.info(f"[{sheet_name}] Рядок {actual_row_index}: знайдено ID замовлення {exact_order_id} в примітці")
                         except ValueError:
                             logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: некоректний ID замовлення в примітці")
+                    
+                if note_s:
+                    if notes:
+                        notes += " | " + note_s
+                    else:
+                        notes = note_s
+                    # Перевіряємо, чи є в примітці ID замовлення, якщо ще не знайдено
+                    if exact_order_id is None:
+                        order_id_match = re.search(r'OrderID[:=](\d+)', note_s)
+                        if order_id_match:
+                            try:
+                                exact_order_id = int(order_id_match.group(1))
+                                logger.info(f"[{sheet_name}] Рядок {actual_row_index}: знайдено ID замовлення {exact_order_id} в примітці")
+                            except ValueError:
+                                logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: некоректний ID замовлення в примітці")
             
-            priority_val = validate_integer(raw_priority)
-            order_date = broadcast_date
+                priority_val = validate_integer(raw_priority)
+                order_date = broadcast_date
 
-            # Розбір номерів продуктів та номерів-клонів
-            product_numbers = []
-            processed_clone_numbers = []  # Для зберігання оброблених номерів клонів
+                # Розбір номерів продуктів та номерів-клонів
+                product_numbers, processed_clone_numbers, clones_list, clone_originals = \
+                    parse_product_numbers(raw_products, raw_clones)
             
-            # Обробка стандартних номерів продуктів
-            if raw_products:
-                split_prods = re.split(r"[;,]", raw_products)
-                product_numbers = [p.strip() for p in split_prods if p.strip()]
+                # Об'єднуємо стандартні номери та номери-клони, що мають стати основними
+                final_product_numbers = product_numbers + processed_clone_numbers
             
-            # Обробка номерів-клонів
-            clones_list = []
-            clone_originals = {}  # Зберігаємо оригінальні номери для клонів
-            
-            if raw_clones:
-                # Розділяємо рядок клонів за комою або крапкою з комою
-                cln = re.split(r"[;,]", raw_clones)
-                
-                for c in cln:
-                    c = c.strip()
-                    if not c:
-                        continue
-                    
-                    # Перевіряємо формат "НОМЕР(ОРИГІНАЛ)" або "НОМЕР(???)"
-                    clone_match = re.match(r"(.+?)\((.+?)\)", c)
-                    
-                    if clone_match:
-                        clone_number = clone_match.group(1).strip()
-                        original_number = clone_match.group(2).strip()
-                        
-                        # Зберігаємо клон та його оригінал
-                        clones_list.append(clone_number)
-                        clone_originals[clone_number] = original_number
-                        
-                        # Якщо оригінал "???", додаємо клон як основний номер
-                        if original_number == "???" and not raw_products:
-                            processed_clone_numbers.append(clone_number)
-                        # Інакше додаємо клон до clonednumbers відповідного продукту
-                        elif original_number != "???":
-                            # Будемо додавати клон до оригінального продукту пізніше
-                            pass
-                    else:
-                        # Якщо формат не відповідає "НОМЕР(ОРИГІНАЛ)", просто додаємо як клон
-                        clones_list.append(c)
-                        
-                        # Якщо основних номерів немає, використовуємо клон як основний
-                        if not raw_products:
-                            processed_clone_numbers.append(c)
-            
-            # Об'єднуємо стандартні номери та номери-клони, що мають стати основними
-            final_product_numbers = product_numbers + processed_clone_numbers
-            
-            # Якщо немає номерів продуктів і клонів, створюємо "???" номери на основі цін
-            if not final_product_numbers:
-                prices_text = raw_prices or ''
-                if prices_text:
-                    # Розбиваємо ціни по роздільнику і рахуємо їх
-                    prices = [p.strip() for p in re.split('[,;]', prices_text) if p.strip()]
-                    # Якщо є хоча б одна ціна, додаємо відповідну кількість "???" номерів
-                    if prices:
-                        final_product_numbers = ["???" for _ in prices]
-                        logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: відсутні номери продуктів та клонів, створюємо {len(prices)} товарів з номером '???' на основі цін")
+                # Якщо немає номерів продуктів і клонів, створюємо "???" номери на основі цін
+                if not final_product_numbers:
+                    prices_text = raw_prices or ''
+                    if prices_text:
+                        # Розбиваємо ціни по роздільнику і рахуємо їх
+                        prices = [p.strip() for p in re.split('[,;]', prices_text) if p.strip()]
+                        # Якщо є хоча б одна ціна, додаємо відповідну кількість "???" номерів
+                        if prices:
+                            final_product_numbers = ["???" for _ in prices]
+                            logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: відсутні номери продуктів та клонів, створюємо {len(prices)} товарів з номером '???' на основі цін")
+                        else:
+                            # Якщо немає цін, додаємо один "???"
+                            final_product_numbers = ["???"]
+                            logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: відсутні номери продуктів та клонів і цін, створюємо один товар з номером '???'")
                     else:
                         # Якщо немає цін, додаємо один "???"
                         final_product_numbers = ["???"]
-                        logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: відсутні номери продуктів та клонів і цін, створюємо один товар з номером '???'")
-                else:
-                    # Якщо немає цін, додаємо один "???"
-                    final_product_numbers = ["???"]
-                    logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: відсутні номери продуктів, клонів і цін, створюємо один товар з номером '???'")
+                        logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: відсутні номери продуктів, клонів і цін, створюємо один товар з номером '???'")
                 
-                issue_text = f"[{sheet_name}] Рядок {actual_row_index}: відсутні номери продуктів та клонів, використовуємо '???' ({len(final_product_numbers)} шт.)"
-                parsing_errors.append({
-                    'row_num': actual_row_index,
-                    'sheet_name': sheet_name,
-                    'client': client_name,
-                    'issue': issue_text
-                })
+                    issue_text = f"[{sheet_name}] Рядок {actual_row_index}: відсутні номери продуктів та клонів, використовуємо '???' ({len(final_product_numbers)} шт.)"
+                    sheet_errors.append({
+                        'row_num': actual_row_index,
+                        'sheet_name': sheet_name,
+                        'client': client_name,
+                        'issue': issue_text
+                    })
             
-            logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: Фінальні номери продуктів: {', '.join(final_product_numbers)}")
-            
-            # Перевірка на дублікати замовлень з урахуванням додаткових критеріїв
-            duplicate_order_id = find_duplicate_order(
-                transaction_cur, 
-                client_id, 
-                final_product_numbers, 
-                order_date, 
-                payment_status_text,
-                ignore_unknown_check=True,  # Дозволяємо оновлювати замовлення для Невідомого клієнта
-                exact_order_id=exact_order_id  # Якщо в примітці був ID замовлення, використовуємо його
-            )
+                logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: Фінальні номери продуктів: {', '.join(final_product_numbers)}")
+            
+                # Перевірка на дублікати замовлень з урахуванням додаткових критеріїв
+                duplicate_order_id = find_duplicate_order(
+                    transaction_cur, 
+                    client_id, 
+                    final_product_numbers, 
+                    order_date, 
+                    payment_status_text,
+                    ignore_unknown_check=True,  # Дозволяємо оновлювати замовлення для Невідомого клієнта
+                    exact_order_id=exact_order_id  # Якщо в примітці був ID замовлення, використовуємо його
+                )
             
-            if duplicate_order_id:
-                logger.info(f"[{sheet_name}] Рядок {actual_row_index}: знайдено дублікат замовлення (ID={duplicate_order_id}) для клієнта {client_name} з продуктами {', '.join(final_product_numbers)}. Оновлюємо існуюче замовлення.")
-                order_id = duplicate_order_id
-                orders_skipped_duplicate += 1
+                if duplicate_order_id:
+                    logger.info(f"[{sheet_name}] Рядок {actual_row_index}: знайдено дублікат замовлення (ID={duplicate_order_id}) для клієнта {client_name} з продуктами {', '.join(final_product_numbers)}. Оновлюємо існуюче замовлення.")
+                    order_id = duplicate_order_id
+                    orders_skipped_duplicate += 1
                 
-                # Додаємо ID замовлення в примітки, якщо його там немає
-                if not re.search(r'OrderID[:=](\d+)', notes):
-                    notes = f"{notes} | OrderID={duplicate_order_id}".strip('| ')
+                    # Додаємо ID замовлення в примітки, якщо його там немає
+                    if not re.search(r'OrderID[:=](\d+)', notes):
+                        notes = f"{notes} | OrderID={duplicate_order_id}".strip('| ')
                 
-                # Оновлюємо існуюче замовлення замість створення нового
-                transaction_cur.execute("""
-                    UPDATE orders
-                      SET client_id=%s,
-                          order_date=%s,
-                          order_status_id=%s,
-                          payment_status_id=%s,
-                          payment_status=%s,
-                          delivery_method_id=%s,
-                          delivery_status_id=%s,
-                          tracking_number=%s,
-                          deferred_until=%s,
-                          priority=%s,
-                          notes=%s,
-                          updated_at=now()
-                    WHERE id=%s
-                """,(
-                    client_id,
-                    order_date,
-                    order_status_id,
-                    payment_status_id,
-                    payment_status_text or "Не оплачено",
-                    delivery_method_id,
-                    delivery_status_id,
-                    tracking_number,
-                    deferred_until,
-                    priority_val or 0,
-                    notes,
-                    duplicate_order_id
-                ))
+                    # Оновлюємо існуюче замовлення замість створення нового
+                    transaction_cur.execute("""
+                        UPDATE orders
+                          SET client_id=%s,
+                              order_date=%s,
+                              order_status_id=%s,
+                              payment_status_id=%s,
+                              payment_status=%s,
+                              delivery_method_id=%s,
+                              delivery_status_id=%s,
+                              tracking_number=%s,
+                              deferred_until=%s,
+                              priority=%s,
+                              notes=%s,
+                              updated_at=now()
+                        WHERE id=%s
+                    """,(
+                        client_id,
+                        order_date,
+                        order_status_id,
+                        payment_status_id,
+                        payment_status_text or "Не оплачено",
+                        delivery_method_id,
+                        delivery_status_id,
+                        tracking_number,
+                        deferred_until,
+                        priority_val or 0,
+                        notes,
+                        duplicate_order_id
+                    ))
                 
-                # Видаляємо старі деталі замовлення, щоб замінити їх на нові
-                transaction_cur.execute("""
-                    DELETE FROM order_details
-                    WHERE order_id = %s
-                """, (duplicate_order_id,))
+                    # Видаляємо старі деталі замовлення, щоб замінити їх на нові
+                    transaction_cur.execute("""
+                        DELETE FROM order_details
+                        WHERE order_id = %s
+                    """, (duplicate_order_id,))
                 
-                transaction_conn.commit()
-                orders_updated += 1
-                logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: оновлено існуюче замовлення ID={order_id} та видалено старі деталі для повного оновлення")
-            else:
-                # Створюємо нове замовлення
-                logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: створюємо нове замовлення")
-                order_id = upsert_order(
-                    transaction_cur,
-                    transaction_conn,
-                    client_id,
-                    order_date,
-                    order_status_id,
-                    payment_status_id,
-                    payment_status_text,
-                    delivery_method_id,
-                    delivery_status_id,
-                    tracking_number,
-                    deferred_until,
-                    priority_val,
-                    notes
-                )
-                if order_id:
-                    # Додаємо ID замовлення в примітки і оновлюємо замовлення
-                    if not re.search(r'OrderID[:=](\d+)', notes):
-                        notes = f"{notes} | OrderID={order_id}".strip('| ')
-                        transaction_cur.execute("""
-                            UPDATE orders
-                              SET notes=%s
-                            WHERE id=%s
-                        """, (notes, order_id))
-                        transaction_conn.commit()
-                    
-                    orders_added += 1
-                    logger.info(f"[{sheet_name}] Рядок {actual_row_index}: створено нове замовлення ID={order_id}")
+                    commit_unless_deferred(transaction_conn)
+                    orders_updated += 1
+                    logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: оновлено існуюче замовлення ID={order_id} та видалено старі деталі для повного оновлення")
                 else:
-                    error_msg = "Не вдалося створити нове замовлення"
+                    # Створюємо нове замовлення
+                    logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: створюємо нове замовлення")
+                    order_id = upsert_order(
+                        transaction_cur,
+                        transaction_conn,
+                        client_id,
+                        order_date,
+                        order_status_id,
+                        payment_status_id,
+                        payment_status_text,
+                        delivery_method_id,
+                        delivery_status_id,
+                        tracking_number,
+                        deferred_until,
+                        priority_val,
+                        notes
+                    )
+                    if order_id:
+                        # Додаємо ID замовлення в примітки і оновлюємо замовлення
+                        if not re.search(r'OrderID[:=](\d+)', notes):
+                            notes = f"{notes} | OrderID={order_id}".strip('| ')
+                            transaction_cur.execute("""
+                                UPDATE orders
+                                  SET notes=%s
+                                WHERE id=%s
+                            """, (notes, order_id))
+                            commit_unless_deferred(transaction_conn)
+                    
+                        orders_added += 1
+                        logger.info(f"[{sheet_name}] Рядок {actual_row_index}: створено нове замовлення ID={order_id}")
+                    else:
+                        error_msg = "Не вдалося створити нове замовлення"
+                        logger.error(f"[{sheet_name}] Рядок {actual_row_index}: {error_msg}")
+                        hash_buffer.add(actual_row_index, row_hash, client_name, False, error_msg)
+                        continue
+            
+                if not order_id:
+                    error_msg = "Не отримано ID замовлення, пропускаємо обробку деталей"
                     logger.error(f"[{sheet_name}] Рядок {actual_row_index}: {error_msg}")
-                    update_row_hash(cur, conn, sheet_name, actual_row_index, row_hash, client_name, False, error_msg)
-                    if transaction_conn:
-                        transaction_conn.close()
+                    hash_buffer.add(actual_row_index, row_hash, client_name, False, error_msg)
                     continue
-            
-            if not order_id:
-                error_msg = "Не отримано ID замовлення, пропускаємо обробку деталей"
-                logger.error(f"[{sheet_name}] Рядок {actual_row_index}: {error_msg}")
-                update_row_hash(cur, conn, sheet_name, actual_row_index, row_hash, client_name, False, error_msg)
-                if transaction_conn:
-                    transaction_conn.close()
-                continue
 
-            # Обробка цін
-            price_values = []
-            if raw_prices:
-                split_prices = re.split(r"[;,]", raw_prices)
-                price_values = [x.strip() for x in split_prices]
+                # Обробка цін
+                price_values = []
+                if raw_prices:
+                    split_prices = re.split(r"[;,]", raw_prices)
+                    price_values = [x.strip() for x in split_prices]
 
-            # Обробка знижок і додаткових операцій
-            addop_name, addop_val = parse_additional_operation(op_str)
-            discount_type, discount_value = parse_discount_str(disc_str)
-            used_addop = False
-            used_discount = False
+                # Обробка знижок і додаткових операцій
+                addop_name, addop_val = parse_additional_operation(op_str)
+                discount_type, discount_value = parse_discount_str(disc_str)
+                used_addop = False
+                used_discount = False
 
-            # Обробка товарів замовлення
-            for idx3, pnum in enumerate(final_product_numbers):
-                try:
-                    product_id = get_or_create_product(transaction_cur, transaction_conn, pnum)
-
-                    # Обробка клонів для цього продукту
-                    if pnum in clone_originals:
-                        # Якщо це клон з оригіналом "???", він вже був доданий як основний номер
-                        if clone_originals[pnum] == "???":
-                            pass
-                        # Інакше знаходимо оригінальний продукт і додаємо до нього клон
-                        else:
-                            original_product_number = clone_originals[pnum]
-                            try:
-                                transaction_cur.execute("""
-                                    SELECT id FROM products 
-                                    WHERE productnumber = %s
-                                """, (original_product_number,))
-                                original_product_row = transaction_cur.fetchone()
+                # Обробка товарів замовлення
+                for idx3, pnum in enumerate(final_product_numbers):
+                    try:
+                        product_id = product_resolver.get_or_create(transaction_cur, transaction_conn, pnum)
+
+                        # Обробка клонів для цього продукту
+                        if pnum in clone_originals:
+                            # Якщо це клон з оригіналом "???", він вже був доданий як основний номер
+                            if clone_originals[pnum] == "???":
+                                pass
+                            # Інакше знаходимо оригінальний продукт і додаємо до нього клон
+                            else:
+                                original_product_number = clone_originals[pnum]
+                                try:
+                                    original_product_id = product_resolver.find_id(transaction_cur, original_product_number)
                                 
-                                if original_product_row:
-                                    original_product_id = original_product_row[0]
-                                    # Додаємо клон до оригінального продукту
-                                    append_clonednumbers(transaction_cur, transaction_conn, original_product_id, [pnum])
-                                    logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: додано клон {pnum} до продукту {original_product_number}")
-                            except Exception as clone_error:
-                                logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: не вдалося додати клон {pnum} до продукту {original_product_number}: {clone_error}")
+                                    if original_product_id:
+                                        # Додаємо клон до оригінального продукту
+                                        append_clonednumbers(transaction_cur, transaction_conn, original_product_id, [pnum],
+                                                             product_resolver.known_clonednumbers(original_product_id))
+                                        logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: додано клон {pnum} до продукту {original_product_number}")
+                                except Exception as clone_error:
+                                    logger.warning(f"[{sheet_name}] Рядок {actual_row_index}: не вдалося додати клон {pnum} до продукту {original_product_number}: {clone_error}")
                     
-                    # Додаємо клони для всіх продуктів (якщо є)
-                    if idx3 < len(product_numbers) and clones_list:
-                        clones_to_add = []
-                        for clone in clones_list:
-                            # Додаємо клони до продукту, якщо вони не є самостійними продуктами
-                            if clone not in processed_clone_numbers:
-                                clones_to_add.append(clone)
+                        # Додаємо клони для всіх продуктів (якщо є)
+                        if idx3 < len(product_numbers) and clones_list:
+                            clones_to_add = []
+                            for clone in clones_list:
+                                # Додаємо клони до продукту, якщо вони не є самостійними продуктами
+                                if clone not in processed_clone_numbers:
+                                    clones_to_add.append(clone)
                         
-                        if clones_to_add:
-                            append_clonednumbers(transaction_cur, transaction_conn, product_id, clones_to_add)
-                            logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: додано клони {', '.join(clones_to_add)} до продукту {pnum}")
-
-                    # Обробка цін
-                    this_price = None
-                    if idx3 < len(price_values):
-                        pr = validate_decimal(price_values[idx3])
-                        if pr is not None:
-                            this_price = pr
-
-                    if this_price is not None:
-                        update_product_price(transaction_cur, transaction_conn, product_id, this_price)
-
-                    # Застосування знижки і додаткових операцій
-                    aop_name = None
-                    aop_val = 0.0
-                    d_type = None
-                    d_val = None
-                    if not used_addop and addop_name:
-                        aop_name = addop_name
-                        aop_val = addop_val
-                        used_addop = True
-                    if not used_discount and discount_type:
-                        d_type = discount_type
-                        d_val = discount_value
-                        used_discount = True
-
-                    # Додавання деталей замовлення
-                    create_or_update_order_details(
-                        transaction_cur,
-                        transaction_conn,
-                        order_id,
-                        product_id,
-                        this_price,
-                        d_type,
-                        d_val,
-                        aop_name,
-                        aop_val
-                    )
-                    logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: додано/оновлено деталь замовлення для продукту {pnum}")
-                except Exception as product_error:
-                    logger.error(f"[{sheet_name}] Рядок {actual_row_index}: помилка при обробці продукту {pnum}: {product_error}")
-                    # Продовжуємо з наступним продуктом, але не робимо rollback всієї транзакції
+                            if clones_to_add:
+                                append_clonednumbers(transaction_cur, transaction_conn, product_id, clones_to_add,
+                                                     product_resolver.known_clonednumbers(product_id))
+                                logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: додано клони {', '.join(clones_to_add)} до продукту {pnum}")
+
+                        # Обробка цін
+                        this_price = None
+                        if idx3 < len(price_values):
+                            pr = validate_decimal(price_values[idx3])
+                            if pr is not None:
+                                this_price = pr
+
+                        if this_price is not None:
+                            update_product_price(transaction_cur, transaction_conn, product_id, this_price)
+
+                        # Застосування знижки і додаткових операцій
+                        aop_name = None
+                        aop_val = 0.0
+                        d_type = None
+                        d_val = None
+                        if not used_addop and addop_name:
+                            aop_name = addop_name
+                            aop_val = addop_val
+                            used_addop = True
+                        if not used_discount and discount_type:
+                            d_type = discount_type
+                            d_val = discount_value
+                            used_discount = True
 
-            # Перерахунок загальної суми замовлення
-            recalc_order_total(transaction_cur, transaction_conn, order_id, order_status_id)
+                        # Додавання деталей замовлення
+                        create_or_update_order_details(
+                            transaction_cur,
+                            transaction_conn,
+                            order_id,
+                            product_id,
+                            this_price,
+                            d_type,
+                            d_val,
+                            aop_name,
+                            aop_val
+                        )
+                        logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: додано/оновлено деталь замовлення для продукту {pnum}")
+                    except Exception as product_error:
+                        logger.error(f"[{sheet_name}] Рядок {actual_row_index}: помилка при обробці продукту {pnum}: {product_error}")
+                        # Продовжуємо з наступним продуктом, але не робимо rollback всієї транзакції
+
+                # Перерахунок загальної суми замовлення
+                recalc_order_total(transaction_cur, transaction_conn, order_id, order_status_id)
             
-            # Позначення товарів як проданих, якщо замовлення оплачене
-            set_products_sold_if_paid(transaction_cur, transaction_conn, order_id, payment_status_text)
+                # Позначення товарів як проданих, якщо замовлення оплачене
+                set_products_sold_if_paid(transaction_cur, transaction_conn, order_id, payment_status_text)
             
-            # Оновлюємо хеш рядка як успішно оброблений
-            update_row_hash(cur, conn, sheet_name, actual_row_index, row_hash, client_name, True)
-            logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: оновлено хеш рядка")
-            transaction_conn.commit()
+                # Оновлюємо хеш рядка як успішно оброблений (у режимі груп - після коміту групи)
+                if chunk is not None:
+                    chunk.release_row(actual_row_index, row_hash, client_name)
+                else:
+                    hash_buffer.add(actual_row_index, row_hash, client_name, True)
+                    transaction_conn.commit()
+                logger.debug(f"[{sheet_name}] Рядок {actual_row_index}: оновлено хеш рядка")
             
-            # Інкрементуємо лічильник успішно оброблених рядків
-            rows_processed += 1
+                # Інкрементуємо лічильник успішно оброблених рядків
+                rows_processed += 1
             
-            # Даємо можливість інтерфейсу оновитися, вивільняючи процесор
-            if i % 10 == 0:  # Кожні 10 рядків
-                time.sleep(0.01)  # Маленька пауза для роботи інтерфейсу
+                # Даємо можливість інтерфейсу оновитися, вивільняючи процесор
+                if rows_seen % 10 == 0:  # Кожні 10 рядків
+                    time.sleep(0.01)  # Маленька пауза для роботи інтерфейсу
 
-        except Exception as e:
-            try:
-                if transaction_conn:
-                    transaction_conn.rollback()
-            except:
-                pass
+            except Exception as e:
+                try:
+                    if chunk is not None:
+                        chunk.rollback_row()
+                    elif transaction_conn:
+                        transaction_conn.rollback()
+                except:
+                    pass
                 
-            error_msg = f"[{sheet_name}] Рядок {actual_row_index} => Помилка: {e}"
-            logger.error(error_msg)
-            import traceback
-            logger.error(traceback.format_exc())
+                error_msg = f"[{sheet_name}] Рядок {actual_row_index} => Помилка: {e}"
+                logger.error(error_msg)
+                import traceback
+                logger.error(traceback.format_exc())
             
-            # Додаємо помилку до списку для відображення в UI
-            parsing_errors.append({"sheet": sheet_name, "row": actual_row_index, "error": str(e), "client": client_name or "Немає"})
+                # Додаємо помилку до списку для відображення в UI
+                sheet_errors.append({"sheet": sheet_name, "row": actual_row_index, "error": str(e), "client": client_name or "Немає"})
             
-            # Зберігаємо інформацію про помилку в хеш-таблиці, але позначаємо як не оброблений
-            update_row_hash(cur, conn, sheet_name, actual_row_index, row_hash, client_name, False, str(e))
-            rows_errors += 1
-        finally:
-            # Закриваємо транзакційне з'єднання для цього рядка
-            if transaction_conn:
-                transaction_conn.close()
-    
-    # Оновлюємо прогрес обробки аркуша
-    update_sheet_progress(cur, conn, sheet_name, len(rows))
+                # Зберігаємо інформацію про помилку в хеш-таблиці, але позначаємо як не оброблений
+                hash_buffer.add(actual_row_index, row_hash, client_name, False, str(e))
+                rows_errors += 1
+            finally:
+                # Відкочуємо незавершену транзакцію (або SAVEPOINT) рядка, з'єднання лишається для наступного
+                if transaction_conn is not None and not transaction_conn.closed:
+                    try:
+                        if chunk is not None:
+                            chunk.rollback_row()
+                        else:
+                            transaction_conn.rollback()
+                        # У режимі груп блокування клієнта знімає chunk після коміту групи
+                        if locked_client_id is not None and chunk is None:
+                            transaction_cur.execute("SELECT pg_advisory_unlock(%s, %s)", (ORDER_CLIENT_LOCK_NAMESPACE, locked_client_id))
+                            transaction_conn.rollback()
+                    except psycopg2.Error:
+                        if chunk is not None:
+                            chunk.abort()
+                        transaction_conn.close()
+                        transaction_conn = None
+                elif chunk is not None:
+                    chunk.abort()
+                if chunk is not None:
+                    lost = fail_uncommitted_rows(chunk.take_lost_rows())
+                    rows_processed -= lost
+                    rows_errors += lost
+                    # Нова група почнеться з новим з'єднанням
+                    if transaction_conn is None or transaction_conn.closed:
+                        chunk.close()
+                        chunk = None
+
+        # Фіксуємо останню групу рядків
+        if chunk is not None:
+            chunk.commit()
+            lost = fail_uncommitted_rows(chunk.take_lost_rows())
+            rows_processed -= lost
+            rows_errors += lost
+
+        if prune_stale_rows:
+            # Оновлюємо прогрес обробки аркуша (зберігається разом з останніми хешами).
+            # Аркуш з новими помилками не можна пропускати наступного разу, тому відбиток
+            # скидаємо; повторно повідомлені помилки минулих запусків (repeated) не враховуються
+            new_errors = any(not error.get("repeated") for error in sheet_errors)
+            hash_buffer.set_progress(rows_seen, None if new_errors else fingerprint)
+            # Записи рядків, яких більше немає в аркуші, видаляємо
+            hash_buffer.prune_after(rows_seen + 1)
+    finally:
+        # Зупиняємо потік читання рядків, якщо цикл перервано
+        row_stream.close()
+        # Повертаємо транзакційне з'єднання в пул (незафіксована група відкочується)
+        if chunk is not None:
+            chunk.close()
+        if transaction_conn is not None:
+            transaction_conn.close()
+        # Зберігаємо буфер хешів навіть при аварійному виході з циклу
+        hash_buffer.flush()
     
     logger.info(f"""
 [{sheet_name}] Результати парсингу:
     Оброблено рядків: {rows_processed}
     Пропущено порожніх/неповних рядків: {rows_invalid}
     Пропущено рядків (немає змін): {rows_no_changes}
+    З них переміщених рядків: {rows_moved}
     Пропущено дублікатів замовлень: {orders_skipped_duplicate}
     Додано нових замовлень: {orders_added}
     Оновлено існуючих замовлень: {orders_updated}
@@ -1918,208 +3316,176 @@ def process_orders_sheet_data(rows, sheet_name, force_process=False):
     update_parsing_status("orders_updated", parsing_status["orders_updated"] + orders_updated)
     update_parsing_status("errors", parsing_status["errors"] + rows_errors)
     
+    stage_timer.record("sheet_total", time.perf_counter() - sheet_started)
+    stage_timer.set_sheet(None)
+    
     # Повертаємо список помилок для відображення в UI
-    return parsing_errors
+    parsing_errors = sheet_errors
+    return sheet_errors
 
 # -------------------------------------------------------
 #   Видалення дубльованих замовлень
 # -------------------------------------------------------
-def remove_redundant_order_duplicates():
+def remove_redundant_order_duplicates(dry_run=False):
    """
    Знаходить і видаляє дублікати замовлень за такими критеріями:
    1. Дублі в order_details (однакові (order_id, product_id))
-   2. Замовлення з однаковими клієнтами та однаковими наборами продуктів
-   3. Замовлення з однаковими клієнтами, продуктами та сумами
+   2. Замовлення одного клієнта з однаковим набором продуктів, статусом
+      оплати ("оплачено" чи ні) і датою замовлення - залишається найновіше
+      (за created_at), інші видаляються. Якщо група оплачена, продукти
+      видалених замовлень позначаються як продані.
+
+   Пошук дублікатів виконується одним SQL-проходом (array_agg + віконні
+   функції) замість запитів по кожному клієнту.
+
+   Args:
+       dry_run: лише порахувати, що було б видалено, без змін у БД
+
+   Returns:
+       dict: звіт (кількість дублів деталей, груп, замовлень, тривалість, пари
+       видалене->залишене) або None, якщо не вдалося підключитися
    """
+   started = time.monotonic()
    conn = connect_to_db()
    if not conn:
        logger.error("Не вдалося підключитися для видалення дублювань у замовленнях")
-       return
+       return None
    cur = conn.cursor()
+   report = {
+       "dry_run": dry_run,
+       "duplicate_details": 0,
+       "duplicate_groups": 0,
+       "duplicate_orders": 0,
+       "details_deleted": 0,
+       "products_marked_sold": 0,
+       "duplicates": [],
+       "elapsed_seconds": 0.0
+   }
    try:
-       # 1. Видалення дублікатів у order_details
+       # 1. Дублікати у order_details
        logger.info("Видаляємо дублікати у order_details (за (order_id, product_id))...")
-       cur.execute("""
-           WITH duplicates AS (
-               SELECT
-                 id,
-                 order_id,
-                 product_id,
-                 ROW_NUMBER() OVER(PARTITION BY order_id, product_id ORDER BY id) AS rn
+       if dry_run:
+           cur.execute("""
+               SELECT count(*) - count(DISTINCT (order_id, product_id))
                FROM order_details
+           """)
+           report["duplicate_details"] = cur.fetchone()[0]
+       else:
+           cur.execute("""
+               WITH duplicates AS (
+                   SELECT
+                     id,
+                     ROW_NUMBER() OVER(PARTITION BY order_id, product_id ORDER BY id) AS rn
+                   FROM order_details
+               )
+               DELETE FROM order_details
+               WHERE id IN (
+                   SELECT id
+                   FROM duplicates
+                   WHERE rn>1
+               )
+           """)
+           report["duplicate_details"] = cur.rowcount
+       logger.info(f"Дублів у order_details: {report['duplicate_details']}")
+
+       # 2. Дублікати замовлень: групуємо за клієнтом, відсортованим набором продуктів,
+       #    статусом оплати і датою; у кожній групі перше (найновіше) замовлення залишається
+       logger.info("Шукаємо замовлення з однаковими клієнтами та продуктами...")
+       cur.execute("""
+           CREATE TEMP TABLE tmp_order_duplicates ON COMMIT DROP AS
+           WITH order_sets AS (
+               SELECT o.id AS order_id,
+                      o.client_id,
+                      o.order_date,
+                      o.created_at,
+                      coalesce(lower(o.payment_status) = 'оплачено', FALSE) AS is_paid,
+                      -- DISTINCT: у dry_run дублі order_details не видалено, групи мають
+                      -- збігатися зі звичайним запуском (productnumber унікальний)
+                      array_agg(DISTINCT p.productnumber ORDER BY p.productnumber) AS product_numbers
+               FROM orders o
+               JOIN order_details od ON od.order_id = o.id
+               JOIN products p ON p.id = od.product_id
+               WHERE o.client_id IS NOT NULL
+               GROUP BY o.id
+           ),
+           ranked AS (
+               SELECT order_sets.*,
+                      first_value(order_id) OVER w AS keep_order_id,
+                      row_number() OVER w AS rn
+               FROM order_sets
+               WINDOW w AS (
+                   PARTITION BY client_id, product_numbers, is_paid, order_date
+                   ORDER BY created_at DESC NULLS LAST, order_id DESC
+               )
            )
-           DELETE FROM order_details
-           WHERE id IN (
-               SELECT id
-               FROM duplicates
-               WHERE rn>1
-           )
-           RETURNING id, order_id, product_id
+           SELECT order_id, keep_order_id, client_id, is_paid, order_date, product_numbers
+           FROM ranked
+           WHERE rn > 1
        """)
-       deleted_details = cur.fetchall()
-       dd_count = len(deleted_details)
-       logger.info(f"Видалено дублів у order_details: {dd_count}")
-       
-       if dd_count > 0:
-           for detail_id, order_id, product_id in deleted_details:
-               logger.debug(f"Видалено дубль деталі ID={detail_id} (замовлення={order_id}, продукт={product_id})")
-       
-       # 2. Знаходимо замовлення, які можуть бути дублікатами
-       logger.info("Шукаємо замовлення з однаковими клієнтами та продуктами...")
-       
-       # Отримуємо список усіх клієнтів
-       cur.execute("SELECT id, first_name, last_name FROM clients")
-       clients = cur.fetchall()
-       logger.debug(f"Знайдено {len(clients)} клієнтів для перевірки дублікатів замовлень")
-       
-       duplicates_deleted = 0
-       
-       for client_row in clients:
-           client_id = client_row[0]
-           client_name = f"{client_row[1] or ''} {client_row[2] or ''}".strip() if client_row else f"ID: {client_id}"
-           
-           # Отримуємо всі замовлення цього клієнта
+       cur.execute("""
+           SELECT order_id, keep_order_id, client_id, is_paid, order_date, product_numbers
+           FROM tmp_order_duplicates
+           ORDER BY client_id, keep_order_id, order_id
+       """)
+       for order_id, keep_order_id, client_id, is_paid, order_date, product_numbers in cur.fetchall():
+           report["duplicates"].append({
+               "order_id": order_id,
+               "keep_order_id": keep_order_id,
+               "client_id": client_id,
+               "is_paid": is_paid,
+               "order_date": order_date,
+               "product_numbers": product_numbers
+           })
+           logger.debug(f"Дублікат замовлення ID={order_id} (клієнт={client_id}, оплачено: {is_paid}, " +
+                        f"дата: {order_date}, продукти: {', '.join(product_numbers)}), залишається ID={keep_order_id}")
+       report["duplicate_orders"] = len(report["duplicates"])
+       report["duplicate_groups"] = len({d["keep_order_id"] for d in report["duplicates"]})
+
+       if report["duplicate_orders"] and not dry_run:
+           # Якщо залишене замовлення оплачене, продукти видалених мають бути "Продано"
            cur.execute("""
-               SELECT o.id, o.total_amount, o.created_at, o.payment_status, 
-                      o.order_status_id, o.delivery_method_id, o.order_date
-               FROM orders o
-               WHERE o.client_id = %s
-               ORDER BY o.created_at DESC
-           """, (client_id,))
-           
-           client_orders = cur.fetchall()
-           if len(client_orders) <= 1:
-               continue
-               
-           logger.debug(f"Клієнт '{client_name}' має {len(client_orders)} замовлень, перевіряємо на дублікати")
-               
-           # Для кожного замовлення отримаємо список продуктів
-           orders_with_products = []
-           for order_id, total, created_at, payment_status, order_status_id, delivery_method_id, order_date in client_orders:
-               cur.execute("""
-                   SELECT p.productnumber, p.id
-                   FROM order_details od
-                   JOIN products p ON p.id = od.product_id
-                   WHERE od.order_id = %s
-               """, (order_id,))
-               
-               order_products = cur.fetchall()
-               if not order_products:
-                   logger.debug(f"Замовлення ID={order_id} клієнта '{client_name}' не має продуктів, пропускаємо")
-                   continue
-                   
-               # Розділяємо номери продуктів та їх ID
-               product_numbers = [row[0] for row in order_products]
-               product_ids = [row[1] for row in order_products]
-               
-               # Перевіряємо статус оплати
-               is_paid = payment_status.lower() == "оплачено" if payment_status else False
-               
-               # Додаємо інформацію про статус для логування
-               status_info = ""
-               if order_status_id:
-                   cur.execute("SELECT status_name FROM order_statuses WHERE id = %s", (order_status_id,))
-                   status_row = cur.fetchone()
-                   if status_row:
-                       status_info = status_row[0]
-               
-               # Додаємо інформацію про метод доставки для логування
-               delivery_info = ""
-               if delivery_method_id:
-                   cur.execute("SELECT method_name FROM delivery_methods WHERE id = %s", (delivery_method_id,))
-                   delivery_row = cur.fetchone()
-                   if delivery_row:
-                       delivery_info = delivery_row[0]
-               
-               orders_with_products.append((
-                   order_id, 
-                   product_numbers, 
-                   product_ids, 
-                   total, 
-                   created_at, 
-                   is_paid, 
-                   status_info, 
-                   delivery_info,
-                   order_date
-               ))
-               
-               logger.debug(f"Замовлення ID={order_id} клієнта '{client_name}': {len(product_numbers)} продуктів, " +
-                           f"оплачено: {is_paid}, статус: {status_info}, доставка: {delivery_info}, " +
-                           f"дата: {order_date}, створено: {created_at}, сума: {total}")
-           
-           # Групуємо замовлення за однаковими наборами продуктів, статусом оплати І датою замовлення
-           product_groups = {}
-           for order_id, product_numbers, product_ids, total, created_at, is_paid, status_info, delivery_info, order_date in orders_with_products:
-               key = (tuple(sorted(product_numbers)), is_paid, order_date)
-               if key not in product_groups:
-                   product_groups[key] = []
-               product_groups[key].append((order_id, product_ids, total, created_at, is_paid, status_info, delivery_info, order_date))
-           
-           # Для кожної групи з однаковими продуктами, залишаємо найновіше замовлення
-           for product_key, order_group in product_groups.items():
-               product_numbers, is_paid_key, order_date_key = product_key
-               
-               if len(order_group) <= 1:
-                   continue
-                   
-               logger.info(f"Знайдено {len(order_group)} замовлень з однаковими продуктами для клієнта '{client_name}', " +
-                          f"оплачено: {is_paid_key}, дата: {order_date_key}, продукти: {', '.join(product_numbers)}")
-                   
-               # Сортуємо за датою (найновіші спочатку)
-               order_group.sort(key=lambda x: -int(x[3].timestamp() if x[3] else 0))
-               
-               # Залишаємо найновіше замовлення, видаляємо всі інші
-               keep_order_id, keep_product_ids, keep_total, keep_created_at, is_paid, keep_status, keep_delivery, keep_date = order_group[0]
-               
-               logger.info(f"Залишаємо замовлення ID={keep_order_id} (оплачено: {is_paid}, статус: {keep_status}, " + 
-                          f"доставка: {keep_delivery}, дата: {keep_date}, створено: {keep_created_at}, сума: {keep_total})")
-               
-               for order_id, product_ids, total, created_at, order_is_paid, status, delivery, order_date in order_group[1:]:
-                   try:
-                       logger.warning(f"Видаляємо дублікат замовлення ID={order_id} (оплачено: {order_is_paid}, статус: {status}, " +
-                                     f"доставка: {delivery}, дата: {order_date}, створено: {created_at}, сума: {total})")
-                       
-                       # Перевіряємо статус продуктів, які видаляємо
-                       # Якщо залишене замовлення оплачене, статус продуктів має бути "Продано"
-                       if is_paid:
-                           for prod_id in product_ids:
-                               cur.execute("""
-                                   UPDATE products 
-                                   SET statusid = %s, updated_at = now()
-                                   WHERE id = %s
-                               """, (PRODUCT_STATUS_SOLD, prod_id))
-                               logger.debug(f"Встановлено статус 'Продано' для продукту ID={prod_id} у видаленому замовленні")
-                       
-                       # Спочатку видаляємо деталі замовлення
-                       cur.execute("DELETE FROM order_details WHERE order_id = %s RETURNING id, product_id", (order_id,))
-                       deleted_details = cur.fetchall()
-                       details_deleted = len(deleted_details)
-                       
-                       for det_id, prod_id in deleted_details:
-                           logger.debug(f"Видалено деталь ID={det_id} (продукт={prod_id}) замовлення ID={order_id}")
-                       
-                       # Потім видаляємо саме замовлення
-                       cur.execute("DELETE FROM orders WHERE id = %s", (order_id,))
-                       order_deleted = cur.rowcount
-                       
-                       if details_deleted > 0 or order_deleted > 0:
-                           duplicates_deleted += 1
-                           logger.info(f"Видалено дублікат замовлення ID={order_id}, залишено ID={keep_order_id}")
-                   except Exception as delete_err:
-                       logger.error(f"Помилка при видаленні дубліката ID={order_id}: {delete_err}")
-                       conn.rollback()
-                       # Продовжуємо з наступним замовленням
-       
-       if duplicates_deleted > 0:
-           logger.info(f"Видалено дублікатів замовлень: {duplicates_deleted}")
+               UPDATE products
+                  SET statusid = %s, updated_at = now()
+                WHERE id IN (
+                    SELECT od.product_id
+                      FROM order_details od
+                      JOIN tmp_order_duplicates d ON d.order_id = od.order_id
+                     WHERE d.is_paid
+                )
+           """, (PRODUCT_STATUS_SOLD,))
+           report["products_marked_sold"] = cur.rowcount
+
+           cur.execute("""
+               DELETE FROM order_details
+                WHERE order_id IN (SELECT order_id FROM tmp_order_duplicates)
+           """)
+           report["details_deleted"] = cur.rowcount
+
+           cur.execute("""
+               DELETE FROM orders
+                WHERE id IN (SELECT order_id FROM tmp_order_duplicates)
+           """)
+
+       if dry_run:
+           conn.rollback()
        else:
-           logger.info("Дублікатів замовлень не знайдено")
-           
-       conn.commit()
+           conn.commit()
+
+       report["elapsed_seconds"] = round(time.monotonic() - started, 3)
+       action = "Буде видалено" if dry_run else "Видалено"
+       if report["duplicate_orders"] > 0:
+           logger.info(f"{action} дублікатів замовлень: {report['duplicate_orders']} " +
+                       f"у {report['duplicate_groups']} групах за {report['elapsed_seconds']} сек")
+       else:
+           logger.info(f"Дублікатів замовлень не знайдено ({report['elapsed_seconds']} сек)")
+       return report
 
    except Exception as e:
        logger.error(f"Помилка remove_redundant_order_duplicates(): {e}")
        conn.rollback()
+       report["error"] = str(e)
+       report["elapsed_seconds"] = round(time.monotonic() - started, 3)
+       return report
    finally:
        cur.close()
        conn.close()
@@ -2223,7 +3589,7 @@ def retry_failed_rows(sheet_name=None):
             
         # Відкриваємо документ
         try:
-            doc = client.open(SPREADSHEET_NAME)
+            doc = sheets_rate_limiter.call(client.open, SPREADSHEET_NAME)
         except Exception as e:
             logger.error(f"Помилка відкриття Google Sheets: {e}")
             return
@@ -2233,7 +3599,7 @@ def retry_failed_rows(sheet_name=None):
             try:
                 # Знаходимо аркуш
                 worksheet = None
-                for ws in doc.worksheets():
+                for ws in sheets_rate_limiter.call(doc.worksheets):
                     if ws.title.strip() == sheet_name:
                         worksheet = ws
                         break
@@ -2243,7 +3609,7 @@ def retry_failed_rows(sheet_name=None):
                     continue
                     
                 # Отримуємо дані аркуша
-                data = worksheet.get_all_values()
+                data = sheets_rate_limiter.call(worksheet.get_all_values)
                 if not data:
                     logger.error(f"Аркуш '{sheet_name}' порожній.")
                     continue
@@ -2302,6 +3668,7 @@ def import_data(sheet_links, force_process=False):
     
     start_time = datetime.now()
     logger.info(f"Починаємо імпорт даних з Google Sheets ({len(sheet_links)} файлів)")
+    prepare_import_run()
     
     # Підрахунок загальної кількості рядків у всіх файлах для відображення прогресу
     try:
@@ -2324,7 +3691,7 @@ def import_data(sheet_links, force_process=False):
                     continue
                     
                 try:
-                    sheet = gc.open_by_url(sheet_url)
+                    sheet = sheets_rate_limiter.call(gc.open_by_url, sheet_url)
                     logger.info(f"Відкрито файл: {sheet.title}")
                 except Exception as e:
                     error_msg = f"Помилка при відкритті файлу {sheet_url}: {str(e)}"
@@ -2339,7 +3706,7 @@ def import_data(sheet_links, force_process=False):
                     
                 # Отримуємо список аркушів
                 try:
-                    worksheets = sheet.worksheets()
+                    worksheets = sheets_rate_limiter.call(sheet.worksheets)
                     worksheet_names = [ws.title for ws in worksheets]
                     logger.info(f"Знайдено аркуші: {', '.join(worksheet_names)}")
                     
@@ -2348,8 +3715,8 @@ def import_data(sheet_links, force_process=False):
                         if ws.title in ["товары", "traking", "трекинг", "history"]:
                             continue  # Пропускаємо службові аркуші
                         
-                        # Підраховуємо кількість рядків у кожному аркуші
-                        rows_count = len(ws.get_all_values())
+                        # Кількість рядків беремо з метаданих аркуша (без окремого запиту даних)
+                        rows_count = ws.row_count
                         if rows_count > 0:
                             total_rows_count += rows_count
                             total_sheets_count += 1
@@ -2396,7 +3763,7 @@ def import_data(sheet_links, force_process=False):
                 continue
                 
             try:
-                sheet = gc.open_by_url(sheet_url)
+                sheet = sheets_rate_limiter.call(gc.open_by_url, sheet_url)
                 logger.info(f"Відкрито файл: {sheet.title}")
             except Exception as e:
                 error_msg = f"Помилка при відкритті файлу {sheet_url}: {str(e)}"
@@ -2412,7 +3779,7 @@ def import_data(sheet_links, force_process=False):
             # Отримуємо список аркушів
             try:
                 # Сортуємо аркуші за датою
-                worksheets = sort_worksheets_by_date(sheet.worksheets())
+                worksheets = sort_worksheets_by_date(sheets_rate_limiter.call(sheet.worksheets))
                 worksheet_names = [ws.title for ws in worksheets]
                 logger.info(f"Знайдено аркуші: {', '.join(worksheet_names)}")
             except Exception as e:
@@ -2426,6 +3793,11 @@ def import_data(sheet_links, force_process=False):
                 })
                 continue
             
+            # Дані аркушів отримуємо групами одним запитом values_batch_get на групу
+            chunks = google_sheets_service.chunk_worksheets(
+                [ws for ws in worksheets if ws.title not in ["товары", "traking", "трекинг", "history"]])
+            batch_values = {}
+            
             # Обробляємо дані з аркушів
             for worksheet in worksheets:
                 worksheet_name = worksheet.title
@@ -2435,10 +3807,20 @@ def import_data(sheet_links, force_process=False):
                 try:
                     logger.info(f"Обробка аркуша: {worksheet_name}")
                     
+                    if worksheet_name not in batch_values:
+                        chunk = next(chunks, [])
+                        try:
+                            batch_values = google_sheets_service.fetch_all_values(chunk)
+                        except Exception as e:
+                            logger.warning(f"Помилка пакетного отримання даних, отримуємо аркуші поодинці: {e}")
+                            batch_values = {chunk_ws.title: None for chunk_ws in chunk}
+                    
                     # Отримуємо дані аркуша
                     try:
-                        # Використовуємо get_all_values замість get_all_records для кращої сумісності
-                        all_values = worksheet.get_all_values()
+                        all_values = batch_values.pop(worksheet_name, None)
+                        if all_values is None:
+                            # Використовуємо get_all_values замість get_all_records для кращої сумісності
+                            all_values = sheets_rate_limiter.call(worksheet.get_all_values)
                         logger.info(f"Отримано {len(all_values)} рядків з аркуша {worksheet_name}")
                         
                         if len(all_values) <= 1:  # Тільки заголовок або порожній аркуш
@@ -2456,7 +3838,8 @@ def import_data(sheet_links, force_process=False):
                         continue
                     
                     # Обробляємо дані аркуша
-                    sheet_errors = process_orders_sheet_data(all_values[1:], worksheet_name, force_process)
+                    sheet_errors = process_orders_sheet_data(all_values[1:], worksheet_name, force_process,
+                                                             prune_stale_rows=True)
                     
                     # Додаємо помилки з цього аркуша до загального списку
                     if sheet_errors:
@@ -2479,8 +3862,8 @@ def import_data(sheet_links, force_process=False):
             if tracking_worksheet_names:
                 tracking_worksheet_name = tracking_worksheet_names[0]
                 try:
-                    tracking_worksheet = sheet.worksheet(tracking_worksheet_name)
-                    tracking_rows = tracking_worksheet.get_all_values()
+                    tracking_worksheet = sheets_rate_limiter.call(sheet.worksheet, tracking_worksheet_name)
+                    tracking_rows = sheets_rate_limiter.call(tracking_worksheet.get_all_values)
                     logger.info(f"Отримано {len(tracking_rows)} рядків з аркуша трекінгу {tracking_worksheet_name}")
                     
                     # Тут можна додати функцію для обробки даних трекінгу
@@ -2524,6 +3907,10 @@ def import_data(sheet_links, force_process=False):
     logger.info(f"Статистика: оброблено {orders_processed} замовлень, пропущено {orders_skipped}, " +
                f"оновлено {orders_updated}, додано {products_added} продуктів, {tracking_added} трекінгів")
     logger.info(f"Зафіксовано {len(all_parsing_errors)} помилок парсингу, деталі у файлі: {SHEETS_ISSUES_LOG_FILE}")
+    cache_stats = dimension_cache.stats()
+    logger.info(f"Кеш довідників: {cache_stats['hits']} звернень без БД, {cache_stats['misses']} звернень до БД, " +
+               f"додано {cache_stats['inserted']} нових значень")
+    logger.info(f"Запити до БД:\n{query_stats.format_report()}")
     
     return orders_processed, orders_skipped, orders_updated, products_added, tracking_added
 
@@ -2539,6 +3926,8 @@ if __name__ == "__main__":
     parser.add_argument('--sheet', type=str, help='Ім\'я аркуша для обробки помилок', default=None)
     parser.add_argument('--async', action='store_true', help='Запустити парсинг асинхронно у фоновому режимі')
     parser.add_argument('--status', action='store_true', help='Показати поточний статус асинхронного парсингу')
+    parser.add_argument('--remove-duplicates', action='store_true', help='Видалити дублікати замовлень')
+    parser.add_argument('--dry-run', action='store_true', help='Разом з --remove-duplicates: лише показати, що буде видалено')
     
     args = parser.parse_args()
     
@@ -2546,6 +3935,9 @@ if __name__ == "__main__":
         list_failed_rows()
     elif args.retry_errors:
         retry_failed_rows(args.sheet)
+    elif args.remove_duplicates:
+        report = remove_redundant_order_duplicates(dry_run=args.dry_run)
+        print(json.dumps(report, default=str, indent=2, ensure_ascii=False))
     elif args.status:
         status = get_parsing_status()
         print(json.dumps(status, default=str, indent=2))
@@ -3164,16 +4556,8 @@ def import_data_async(sheet_links, force_process=False):
 #   Підключення до PostgreSQL з рівнем ізоляції
 # -------------------------------------------------------
 def connect_to_db_with_isolation(isolation_level):
-   try:
-       connection = psycopg2.connect(
-           host=DB_HOST,
-           port=DB_PORT,
-           database=DB_NAME,
-           user=DB_USER,
-           password=DB_PASSWORD
-       )
-       connection.set_isolation_level(isolation_level)
-       return connection
-   except psycopg2.Error as e:
-       logger.error(f"Помилка підключення до бази даних з ізоляцією {isolation_level}: {e}")
-       return None
\ No newline at end of file
+   """Видає з'єднання з пулу із заданим рівнем ізоляції."""
+   connection = db_pool.checkout(isolation_level=isolation_level)
+   if connection is None:
+       logger.error(f"Помилка підключення до бази даних з ізоляцією {isolation_level}: не вдалося отримати з'єднання з пулу")
+   return connection
\ No newline at end of file
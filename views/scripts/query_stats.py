@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Облік SQL-запитів, виконаних через psycopg2 напряму (поза SQLAlchemy).
+
+- InstrumentedCursor - курсор, що вимірює кожен execute/executemany/copy_expert;
+- InstrumentedConnection - з'єднання пулу (PooledConnection), яке видає такі
+  курсори і враховує commit/rollback як окремі "запити";
+- query_stats - спільний збирач: для кожного нормалізованого тексту SQL
+  (літерали замінено на ?, списки VALUES/IN згорнуто) рахує виклики,
+  інструкції, звернення до сервера, повернуті/змінені рядки та час;
+- query_stats.report()/write_report(path) - загальні лічильники і top-N запитів.
+
+Нормалізація дає змогу побачити регресії на кшталт коміту після кожного рядка
+чи запиту в циклі: такі запити з'являються вгорі звіту з тисячами викликів.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+from functools import lru_cache
+
+import psycopg2.extensions
+from psycopg2 import sql as pg_sql
+
+try:
+    from .db_pool import PooledConnection
+except ImportError:  # запуск як окремого скрипта
+    from db_pool import PooledConnection
+
+logger = logging.getLogger(__name__)
+
+# Вимкнути облік запитів: DB_QUERY_STATS=0
+DB_QUERY_STATS = os.getenv("DB_QUERY_STATS", "1") != "0"
+# Скільки запитів показувати у звіті
+DB_QUERY_STATS_TOP = int(os.getenv("DB_QUERY_STATS_TOP", "20"))
+
+_STRING_LITERAL_RE = re.compile(r"(?:E|e)?'(?:[^']|'')*'")
+_NUMBER_RE = re.compile(r"(?<![\w$])-?\d+(?:\.\d+)?\b")
+_PLACEHOLDER_RE = re.compile(r"%\((\w+)\)s|%s")
+_PARENS_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_ROWS_LIST_RE = re.compile(r"(\([^()]*\))(?:\s*,\s*\([^()]*\))+")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Довші тексти (сторінки execute_values з підставленими значеннями) не кешуються:
+# кожна сторінка - окремий рядок, кеш лише тримав би їх у пам'яті
+NORMALIZE_CACHE_MAX_LENGTH = 2048
+
+
+def normalize_sql(query):
+    """
+    Приводить текст SQL до шаблону: літерали і параметри -> ?,
+    списки (?, ?, ...) і рядки VALUES згортаються, пробіли схлопуються.
+    """
+    if len(query) > NORMALIZE_CACHE_MAX_LENGTH:
+        return _normalize_sql(query)
+    return _normalize_sql_cached(query)
+
+
+def _normalize_sql(query):
+    text = _STRING_LITERAL_RE.sub("?", query)
+    text = _PLACEHOLDER_RE.sub("?", text)
+    text = _NUMBER_RE.sub("?", text)
+    text = _PARENS_LIST_RE.sub("(?, ...)", text)
+    text = _ROWS_LIST_RE.sub(r"\1, ...", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+_normalize_sql_cached = lru_cache(maxsize=4096)(_normalize_sql)
+
+
+def _query_text(query):
+    if isinstance(query, bytes):
+        return query.decode("utf-8", errors="replace")
+    if isinstance(query, str):
+        return query
+    # psycopg2.sql.Composable без з'єднання - беремо repr як ключ
+    return repr(query)
+
+
+class QueryStats:
+    """Потокобезпечний збирач статистики SQL-запитів за нормалізованим текстом."""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._queries = {}
+
+    def record(self, query, seconds, round_trips=1, rows_returned=0, rows_affected=0):
+        """Додає одне виконання запиту (query - текст SQL, str або bytes)."""
+        if not self.enabled:
+            return
+        key = normalize_sql(_query_text(query))
+        statements = max(1, sum(1 for part in key.split(";") if part.strip()))
+        with self._lock:
+            stat = self._queries.get(key)
+            if stat is None:
+                # calls, statements, round_trips, rows_returned, rows_affected, total, max
+                self._queries[key] = [1, statements * round_trips, round_trips,
+                                      rows_returned, rows_affected, seconds, seconds]
+            else:
+                stat[0] += 1
+                stat[1] += statements * round_trips
+                stat[2] += round_trips
+                stat[3] += rows_returned
+                stat[4] += rows_affected
+                stat[5] += seconds
+                if seconds > stat[6]:
+                    stat[6] = seconds
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
+
+    def totals(self):
+        """
+        Загальні лічильники.
+
+        Returns:
+            dict: calls, statements, round_trips, rows_returned, rows_affected,
+            total_seconds, commits, distinct_queries
+        """
+        with self._lock:
+            stats = {key: list(stat) for key, stat in self._queries.items()}
+        result = {"calls": 0, "statements": 0, "round_trips": 0,
+                  "rows_returned": 0, "rows_affected": 0, "total_seconds": 0.0}
+        for calls, statements, round_trips, rows_returned, rows_affected, total, _ in stats.values():
+            result["calls"] += calls
+            result["statements"] += statements
+            result["round_trips"] += round_trips
+            result["rows_returned"] += rows_returned
+            result["rows_affected"] += rows_affected
+            result["total_seconds"] += total
+        result["total_seconds"] = round(result["total_seconds"], 4)
+        result["commits"] = stats.get("COMMIT", [0])[0]
+        result["distinct_queries"] = len(stats)
+        return result
+
+    def report(self, top_n=DB_QUERY_STATS_TOP, order_by="total_seconds"):
+        """
+        Зведення: загальні лічильники і top_n запитів.
+
+        Args:
+            order_by: total_seconds, calls, round_trips або rows_returned
+
+        Returns:
+            dict: {"totals": {...}, "top": [{"sql", "calls", "statements", "round_trips",
+            "rows_returned", "rows_affected", "total_seconds", "avg_ms", "max_ms"}, ...]}
+        """
+        with self._lock:
+            stats = {key: list(stat) for key, stat in self._queries.items()}
+        top = [
+            {
+                "sql": key,
+                "calls": calls,
+                "statements": statements,
+                "round_trips": round_trips,
+                "rows_returned": rows_returned,
+                "rows_affected": rows_affected,
+                "total_seconds": round(total, 4),
+                "avg_ms": round(total / calls * 1000, 3) if calls else 0.0,
+                "max_ms": round(slowest * 1000, 3),
+            }
+            for key, (calls, statements, round_trips, rows_returned, rows_affected, total, slowest)
+            in stats.items()
+        ]
+        top.sort(key=lambda item: item[order_by], reverse=True)
+        return {"totals": self.totals(), "top": top[:top_n]}
+
+    def format_report(self, top_n=10):
+        """Короткий текстовий звіт для логу: загальні лічильники і top_n запитів за часом."""
+        report = self.report(top_n)
+        totals = report["totals"]
+        lines = [
+            f"- Запитів: {totals['calls']}, звернень до сервера: {totals['round_trips']}, "
+            f"комітів: {totals['commits']}, повернуто рядків: {totals['rows_returned']}, "
+            f"час: {totals['total_seconds']:.1f} сек"
+        ]
+        for item in report["top"]:
+            lines.append(f"- {item['total_seconds']:.2f} сек, {item['calls']} разів: {item['sql'][:160]}")
+        return "\n".join(lines)
+
+    def write_report(self, path, top_n=DB_QUERY_STATS_TOP):
+        """Записує зведення у JSON-файл. Returns: True, якщо файл записано."""
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(self.report(top_n), f, ensure_ascii=False, indent=2)
+            return True
+        except OSError as e:
+            logger.error(f"Не вдалося записати звіт запитів до БД {path}: {e}")
+            return False
+
+
+# Спільний збирач для процесу імпорту
+query_stats = QueryStats(DB_QUERY_STATS)
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    """Курсор psycopg2, що записує кожен запит у query_stats."""
+
+    def _template(self, query):
+        """Текст шаблону запиту: sql.Composed збирається з %s, без значень параметрів."""
+        if isinstance(query, pg_sql.Composable):
+            try:
+                return query.as_string(self)
+            except psycopg2.Error:
+                pass
+        return query
+
+    def _record(self, query, started, round_trips=1):
+        seconds = time.perf_counter() - started
+        rowcount = max(self.rowcount, 0)
+        if self.description is not None:
+            query_stats.record(query, seconds, round_trips, rows_returned=rowcount)
+        else:
+            query_stats.record(query, seconds, round_trips, rows_affected=rowcount)
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            # Ключ - шаблон, а не self.query з підставленими значеннями
+            self._record(self._template(query), started)
+
+    def executemany(self, query, vars_list):
+        # psycopg2 виконує executemany окремим зверненням на кожен набір параметрів
+        vars_list = list(vars_list)
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._record(self._template(query), started, round_trips=len(vars_list))
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._record(self._template(sql), started)
+
+
+class InstrumentedConnection(PooledConnection):
+    """
+    З'єднання пулу з обліком запитів: курсори за замовчуванням - InstrumentedCursor,
+    commit/rollback враховуються як запити COMMIT/ROLLBACK.
+    Поза пулом поводиться як звичайне з'єднання.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = InstrumentedCursor
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            query_stats.record("COMMIT", time.perf_counter() - started)
+
+    def rollback(self):
+        started = time.perf_counter()
+        try:
+            return super().rollback()
+        finally:
+            query_stats.record("ROLLBACK", time.perf_counter() - started)
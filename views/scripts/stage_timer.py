@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Легке вимірювання часу етапів імпорту замовлень.
+
+- stage_timer.span("етап") - контекстний менеджер, що додає тривалість блоку
+  до статистики етапу поточного аркуша;
+- @traced_stage("етап") - те саме для функції чи методу;
+- stage_timer.set_sheet(name) - задає аркуш для поточного потоку (кожен потік
+  запису обробляє свій аркуш, тому аркуш зберігається в threading.local);
+- stage_timer.report()/write_report(path) - зведення по аркушах і загальне.
+
+Час етапів інклюзивний: вкладені етапи враховуються і в зовнішньому.
+"""
+
+import json
+import time
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Ключ для етапів, виконаних поза обробкою конкретного аркуша (наприклад, пакетне завантаження)
+GENERAL_SHEET_KEY = "(загальне)"
+
+
+class StageTimer:
+    """Потокобезпечний агрегатор тривалостей етапів по аркушах."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sheets = {}
+
+    def set_sheet(self, sheet_name):
+        """Задає аркуш, до якого відносяться етапи поточного потоку (None - загальні)."""
+        self._local.sheet = sheet_name
+
+    def current_sheet(self):
+        return getattr(self._local, "sheet", None)
+
+    def record(self, stage, seconds, sheet_name=None):
+        """Додає одне вимірювання етапу."""
+        sheet_key = sheet_name or self.current_sheet() or GENERAL_SHEET_KEY
+        with self._lock:
+            stages = self._sheets.setdefault(sheet_key, {})
+            stat = stages.get(stage)
+            if stat is None:
+                stages[stage] = [1, seconds, seconds]
+            else:
+                stat[0] += 1
+                stat[1] += seconds
+                if seconds > stat[2]:
+                    stat[2] = seconds
+
+    @contextmanager
+    def span(self, stage, sheet_name=None):
+        """Вимірює тривалість блоку як етап stage."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started, sheet_name)
+
+    def reset(self):
+        with self._lock:
+            self._sheets.clear()
+
+    @staticmethod
+    def _format(stat):
+        count, total, slowest = stat
+        return {
+            "count": count,
+            "total_seconds": round(total, 4),
+            "avg_ms": round(total / count * 1000, 3) if count else 0.0,
+            "max_ms": round(slowest * 1000, 3),
+        }
+
+    def report(self):
+        """
+        Зведення вимірювань.
+
+        Returns:
+            dict: {"sheets": {аркуш: {етап: статистика}}, "totals": {етап: статистика}},
+            де статистика - count, total_seconds, avg_ms, max_ms
+        """
+        with self._lock:
+            snapshot = {sheet: {stage: list(stat) for stage, stat in stages.items()}
+                        for sheet, stages in self._sheets.items()}
+
+        totals = {}
+        for stages in snapshot.values():
+            for stage, (count, total, slowest) in stages.items():
+                stat = totals.setdefault(stage, [0, 0.0, 0.0])
+                stat[0] += count
+                stat[1] += total
+                stat[2] = max(stat[2], slowest)
+
+        def by_total(stages):
+            return dict(sorted(((stage, self._format(stat)) for stage, stat in stages.items()),
+                               key=lambda item: item[1]["total_seconds"], reverse=True))
+
+        return {
+            "sheets": {sheet: by_total(stages) for sheet, stages in snapshot.items()},
+            "totals": by_total(totals),
+        }
+
+    def write_report(self, path):
+        """Записує зведення у JSON-файл. Returns: True, якщо файл записано."""
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(self.report(), f, ensure_ascii=False, indent=2)
+            return True
+        except OSError as e:
+            logger.error(f"Не вдалося записати звіт часу етапів {path}: {e}")
+            return False
+
+
+# Спільний агрегатор для процесу імпорту
+stage_timer = StageTimer()
+
+
+def traced_stage(stage):
+    """Декоратор: вимірює кожен виклик функції як етап stage поточного аркуша."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer.span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
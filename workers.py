@@ -6,6 +6,11 @@ import asyncio
 import qasync
 import time
 import datetime
+import queue
+import itertools
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from PyQt6.QtCore import QObject, pyqtSignal, QThread, pyqtSlot, QCoreApplication
 from PyQt6.QtWidgets import QApplication, QMessageBox, QDialog, QVBoxLayout, QLabel, QRadioButton, QPushButton, QDialogButtonBox
 from sqlalchemy.orm import aliased
@@ -14,15 +19,19 @@ from models import (
    Product, Type, Subtype, Brand, Gender, Color, Country, Status, Condition, Import
 )
 from db import Session
-from views.scripts.orders_pars import process_orders_sheet_data, get_parsing_errors
+from views.scripts.orders_pars import process_orders_sheet_data, get_parsing_errors, prepare_import_run, dimension_cache, db_pool, find_unchanged_sheets, OrderRow, ORDERS_SHEET_FREEZE_DAYS
 import gspread
 from oauth2client.service_account import ServiceAccountCredentials
 import traceback
-from time import sleep
-import random
 from gspread.exceptions import APIError
 from services.google_sheets_service import google_sheets_service
+from views.scripts.stage_timer import stage_timer
+from views.scripts.query_stats import query_stats
+from services.rate_limiter import is_quota_error
+from services.sheet_snapshot_service import SHEET_SNAPSHOT_OFFLINE
 
+# Кількість аркушів замовлень, що записуються в БД паралельно (1 - послідовна обробка)
+ORDERS_PARSING_WORKERS = int(os.getenv("ORDERS_PARSING_WORKERS", "1"))
 
 # Налаштування більш детального логування
 LOG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
@@ -454,11 +463,22 @@ class OrderParsingWorker(QObject):
     status_update = pyqtSignal(str)
     parsing_error = pyqtSignal(dict)  # Новий сигнал для помилок парсингу
     
-    def __init__(self, force_process=False):
+    def __init__(self, force_process=False, max_workers=None):
         super().__init__()
         self.force_process = force_process
         self.logger = logging.getLogger('OrderParsingWorker')
-        self.logger.info(f"Ініціалізація OrderParsingWorker з force_process={force_process}")
+        self._is_running = True
+        self._stats_lock = threading.Lock()
+        self._fingerprints = {}
+        
+        # Кількість аркушів, що записуються одночасно (1 - послідовний режим).
+        # Кожен аркуш тримає до 3 з'єднань з пулу, тому значення обмежується розміром пулу
+        requested_workers = max_workers or ORDERS_PARSING_WORKERS
+        pool_limit = max(1, (db_pool.maxconn - 1) // 3)
+        self.max_workers = max(1, min(requested_workers, pool_limit))
+        if self.max_workers < requested_workers:
+            self.logger.warning(f"Кількість потоків запису зменшено з {requested_workers} до {self.max_workers} (розмір пулу з'єднань {db_pool.maxconn})")
+        self.logger.info(f"Ініціалізація OrderParsingWorker з force_process={force_process}, max_workers={self.max_workers}")
         
     def parse_orders(self):
         """
@@ -504,6 +524,428 @@ class OrderParsingWorker(QObject):
             self.logger.info("Користувач скасував діалог вибору типу оновлення")
             return None
         
+    def stop(self):
+        self._is_running = False
+
+    def _count(self, key, value=1):
+        """Потокобезпечно збільшує лічильник статистики запуску."""
+        with self._stats_lock:
+            self._stats[key] += value
+
+    def _skip_unchanged_sheets(self, sheets_list):
+        """
+        Знімає відбитки аркушів (modifiedTime документа і дайджест діапазону-зонда)
+        і, якщо парсинг не примусовий, відкидає аркуші, що не змінилися з
+        останньої успішної обробки (див. find_unchanged_sheets).
+
+        Returns:
+            list: аркуші, які потрібно завантажити й обробити
+        """
+        session_logger = self._session_logger
+        try:
+            with stage_timer.span("change_detection"):
+                # Зонди потрібні лише для пропуску "заморожених" аркушів
+                self._fingerprints = google_sheets_service.get_sheet_fingerprints(
+                    sheets_list, with_probe=ORDERS_SHEET_FREEZE_DAYS > 0)
+        except Exception as e:
+            warning_msg = f"Не вдалося отримати відбитки аркушів, обробляємо всі аркуші: {e}"
+            self.logger.warning(warning_msg)
+            session_logger.warning(warning_msg)
+            self._fingerprints = {}
+            return sheets_list
+        
+        if self.force_process:
+            return sheets_list
+        
+        unchanged = find_unchanged_sheets(self._fingerprints)
+        for sheet_name, reason in unchanged.items():
+            session_logger.info(f"[Аркуш {sheet_name}] Пропущено без завантаження: {reason}")
+        if unchanged:
+            self._count("sheets_skipped", len(unchanged))
+            self.logger.info(f"Пропущено {len(unchanged)} незмінених аркушів без завантаження")
+            session_logger.info(f"Пропущено {len(unchanged)} незмінених аркушів без завантаження")
+        return [ws for ws in sheets_list if ws.title not in unchanged]
+
+    def _run_sequential(self, sheets_list):
+        """
+        Послідовний режим: отримання і обробка кожного аркуша по черзі.
+        Темп запитів до API регулює обмежувач частоти, а не фіксовані паузи.
+        """
+        total_sheets = len(sheets_list)
+        
+        for index, worksheet, data in self._iter_sheet_data(sheets_list):
+            if not self._is_running:
+                break
+            sheet_name = worksheet.title
+            sheet_start_time = datetime.datetime.now()
+            
+            # Оновлюємо прогрес і статус
+            progress_percent = int((index / total_sheets) * 100)
+            self.progress.emit(progress_percent)
+            self.status_update.emit(f"Обробка аркуша {sheet_name} ({index+1}/{total_sheets})...")
+            
+            rows = self._prepare_rows(sheet_name, data)
+            if rows is None:
+                continue
+            
+            try:
+                result = self._process_sheet(sheet_name, rows)
+                self._handle_sheet_result(sheet_name, result, sheet_start_time)
+            except Exception as e:
+                self._handle_sheet_exception(sheet_name, e)
+                continue
+
+
+    def _run_pipelined(self, sheets_list):
+        """
+        Конвеєрний режим: окремий потік завантажує аркуші з Google наперед
+        (не більше max_workers у черзі), а пул із max_workers потоків
+        записує кілька аркушів одночасно, кожен на своїх з'єднаннях з пулу.
+        Замовлення одного клієнта серіалізуються advisory lock у БД.
+        Прогрес і статус повідомляються по завершенню кожного аркуша.
+        """
+        total_sheets = len(sheets_list)
+        fetched = queue.Queue(maxsize=self.max_workers)
+        
+        def fetch_ahead():
+            try:
+                for index, worksheet, data in self._iter_sheet_data(sheets_list):
+                    if not self._is_running:
+                        break
+                    fetched.put((index, worksheet.title, data))
+            finally:
+                fetched.put(None)
+        
+        fetcher = threading.Thread(target=fetch_ahead, name="orders-sheet-fetcher", daemon=True)
+        fetcher.start()
+        
+        completed = 0
+        in_flight = {}
+        
+        def finish(done_futures):
+            nonlocal completed
+            for future in done_futures:
+                sheet_name, sheet_start_time = in_flight.pop(future)
+                try:
+                    self._handle_sheet_result(sheet_name, future.result(), sheet_start_time)
+                except Exception as e:
+                    self._handle_sheet_exception(sheet_name, e)
+                completed += 1
+                self.progress.emit(int((completed / total_sheets) * 100))
+                self.status_update.emit(f"Оброблено аркуш {sheet_name} ({completed}/{total_sheets})")
+        
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="orders-sheet-writer") as executor:
+                while True:
+                    item = fetched.get()
+                    if item is None:
+                        break
+                    index, sheet_name, data = item
+                    rows = self._prepare_rows(sheet_name, data)
+                    if rows is None:
+                        completed += 1
+                        self.progress.emit(int((completed / total_sheets) * 100))
+                        continue
+                    
+                    # Не більше max_workers аркушів у роботі одночасно
+                    if len(in_flight) >= self.max_workers:
+                        done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                        finish(done)
+                    
+                    self.status_update.emit(f"Обробка аркуша {sheet_name} ({index+1}/{total_sheets})...")
+                    future = executor.submit(self._process_sheet, sheet_name, rows, True)
+                    in_flight[future] = (sheet_name, datetime.datetime.now())
+                
+                while in_flight:
+                    done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                    finish(done)
+        finally:
+            # Зупиняємо потік завантаження, якщо цикл перервано помилкою
+            if fetcher.is_alive():
+                self._is_running = False
+                while fetcher.is_alive():
+                    try:
+                        fetched.get(timeout=0.5)
+                    except queue.Empty:
+                        pass
+            fetcher.join()
+
+    def _iter_sheet_data(self, sheets_list):
+        """
+        Завантажує аркуші групами через пакетний запит values_batch_get
+        (кілька запитів до API замість запиту на кожен аркуш). Аркуші, чий
+        документ не змінився, беруться з локальних знімків. Якщо пакетний
+        запит не вдався, аркуші групи завантажуються поодинці.
+
+        Yields:
+            tuple: (index, worksheet, data), data - рядки аркуша або None
+        """
+        session_logger = self._session_logger
+        total_sheets = len(sheets_list)
+        revisions = {title: fingerprint["modified_time"] for title, fingerprint in self._fingerprints.items()}
+        index = 0
+        for chunk in google_sheets_service.chunk_worksheets(sheets_list):
+            if not self._is_running:
+                return
+            try:
+                with stage_timer.span("fetch"):
+                    values = google_sheets_service.fetch_all_values(chunk, max_retries=20, revisions=revisions)
+            except Exception as e:
+                warning_msg = f"Пакетне отримання {len(chunk)} аркушів не вдалося, отримуємо поодинці: {e}"
+                self.logger.warning(warning_msg)
+                session_logger.warning(warning_msg)
+                values = {}
+            for worksheet in chunk:
+                if not self._is_running:
+                    return
+                data = self._fetch_sheet_data(worksheet, index, total_sheets, values.pop(worksheet.title, None))
+                yield index, worksheet, data
+                index += 1
+
+    def _fetch_sheet_data(self, worksheet, index, total_sheets, prefetched=None):
+        """
+        Отримує всі значення аркуша з повторними спробами при помилках квоти API.
+        Якщо значення вже отримано пакетним запитом (prefetched), лише перевіряє їх.
+
+        Returns:
+            list: рядки аркуша або None, якщо отримати дані не вдалося
+        """
+        session_logger = self._session_logger
+        sheet_name = worksheet.title
+        
+        # Логуємо початок обробки аркуша
+        self.logger.info(f"===== ПОЧАТОК ОБРОБКИ АРКУША {sheet_name} ({index+1}/{total_sheets}) =====")
+        session_logger.info(f"===== ПОЧАТОК ОБРОБКИ АРКУША {sheet_name} ({index+1}/{total_sheets}) =====")
+        
+        if prefetched is not None:
+            data = prefetched
+            self.logger.info(f"[Аркуш {sheet_name}] Отримано {len(data)} рядків даних (пакетний запит)")
+            session_logger.info(f"[Аркуш {sheet_name}] Отримано {len(data)} рядків даних (пакетний запит)")
+        else:
+            data = self._request_sheet_values(worksheet)
+            fingerprint = self._fingerprints.get(sheet_name) or {}
+            if data:
+                google_sheets_service.snapshots.put(
+                    worksheet.spreadsheet.id, worksheet.id, fingerprint.get("modified_time"), data, sheet_name)
+            elif SHEET_SNAPSHOT_OFFLINE:
+                # Офлайн-режим: беремо останній збережений знімок аркуша
+                data = google_sheets_service.snapshots.get(worksheet.spreadsheet.id, worksheet.id)
+                if data is not None:
+                    warning_msg = f"[Аркуш {sheet_name}] Використано останній локальний знімок ({len(data)} рядків)"
+                    self.logger.warning(warning_msg)
+                    session_logger.warning(warning_msg)
+        
+        # Перевіряємо, чи отримали дані аркуша
+        if not data:
+            error_msg = f"Не вдалося отримати дані з аркуша {sheet_name}"
+            self.logger.error(error_msg)
+            session_logger.error(error_msg)
+            self.status_update.emit(error_msg)
+            self._count("sheets_with_errors")
+            return None
+        return data
+
+    def _request_sheet_values(self, worksheet):
+        """
+        Окремий запит get_all_values() для одного аркуша.
+
+        Returns:
+            list: рядки аркуша або None, якщо отримати дані не вдалося
+        """
+        session_logger = self._session_logger
+        sheet_name = worksheet.title
+        
+        # Запит проходить через спільний обмежувач частоти: він притримує запити
+        # до вичерпання квоти і сам повторює їх після відповіді 429
+        max_retries = 20
+        throttle_events_before = google_sheets_service.rate_limiter.stats()["throttle_events"]
+        data = None
+        try:
+            with stage_timer.span("fetch", sheet_name):
+                data = google_sheets_service.call(worksheet.get_all_values, max_retries=max_retries)
+            self.logger.info(f"[Аркуш {sheet_name}] Отримано {len(data)} рядків даних")
+            session_logger.info(f"[Аркуш {sheet_name}] Отримано {len(data)} рядків даних")
+        except gspread.exceptions.APIError as api_error:
+            error_str = str(api_error)
+            if is_quota_error(api_error):
+                error_msg = f"[Аркуш {sheet_name}] Перевищено квоту API, вичерпано {max_retries} спроб"
+                self.logger.error(error_msg)
+                session_logger.error(error_msg)
+                quota_logger.warning(f"[Аркуш {sheet_name}] Quota exceeded: {error_str}")
+                self.status_update.emit(error_msg)
+            else:
+                # Інші помилки API
+                self._count("other_errors")
+                error_msg = f"Помилка API при отриманні даних з аркуша {sheet_name}: {api_error}"
+                
+                self.logger.error(error_msg)
+                session_logger.error(f"{error_msg}\n{traceback.format_exc()}")
+                error_logger.error(f"{error_msg}\n{traceback.format_exc()}")
+                api_logger.error(f"[Аркуш {sheet_name}] Невідома помилка API: {error_str}")
+                
+                self.status_update.emit(error_msg)
+                error_data = {
+                    "sheet": sheet_name, 
+                    "row": 0, 
+                    "error": f"Помилка API: {api_error}",
+                    "client": "Немає",
+                    "error_type": "APIError",
+                    "traceback": traceback.format_exc()
+                }
+                self.parsing_error.emit(error_data)
+                self._collected_errors.append(error_data)
+        except Exception as e:
+            # Інші неочікувані помилки
+            self._count("other_errors")
+            error_msg = f"Помилка при отриманні даних з аркуша {sheet_name}: {e}"
+            self.logger.error(error_msg)
+            session_logger.error(f"{error_msg}\n{traceback.format_exc()}")
+            error_logger.error(f"{error_msg}\n{traceback.format_exc()}")
+            
+            self.status_update.emit(error_msg)
+            error_data = {
+                "sheet": sheet_name, 
+                "row": 0, 
+                "error": f"Неочікувана помилка: {e}",
+                "client": "Немає",
+                "error_type": "Exception",
+                "traceback": traceback.format_exc()
+            }
+            self.parsing_error.emit(error_data)
+            self._collected_errors.append(error_data)
+        
+        throttled = google_sheets_service.rate_limiter.stats()["throttle_events"] - throttle_events_before
+        if throttled > 0:
+            quota_logger.warning(f"[Аркуш {sheet_name}] Відповідей 429 під час завантаження: {throttled}")
+        return data
+
+    def _prepare_rows(self, sheet_name, data):
+        """
+        Перетворює значення аркуша на рядки для process_orders_sheet_data.
+        Рядки створюються ліниво (генератор), під час потокової обробки аркуша,
+        тож друга повна копія аркуша в пам'яті не будується.
+
+        Returns:
+            generator: рядки без заголовка або None, якщо аркуш треба пропустити
+        """
+        if data is None:
+            return None
+        session_logger = self._session_logger
+        
+        # Якщо в аркуші менше 2 рядків (тільки заголовки або порожній), пропускаємо його
+        if len(data) < 2:
+            info_msg = f"[Аркуш {sheet_name}] Містить менше 2 рядків (порожній або тільки заголовки), пропускаємо"
+            self.logger.info(info_msg)
+            session_logger.info(info_msg)
+            self._count("sheets_skipped")
+            return None
+        
+        # Перетворюємо рядки в OrderRow (лише колонки, що мають заголовок)
+        width = len(data[0])
+        return (OrderRow.from_values(row_data, width) for row_data in itertools.islice(data, 1, None))
+
+    def _process_sheet(self, sheet_name, rows, client_locks=False):
+        """Записує рядки аркуша в БД (виконується в потоці запису в конвеєрному режимі)."""
+        session_logger = self._session_logger
+        
+        # Логуємо початок обробки даних
+        self.logger.info(f"[Аркуш {sheet_name}] Початок потокової обробки даних в режимі {'ПОВНИЙ' if self.force_process else 'СТАНДАРТНИЙ'}")
+        session_logger.info(f"[Аркуш {sheet_name}] Початок потокової обробки даних в режимі {'ПОВНИЙ' if self.force_process else 'СТАНДАРТНИЙ'}")
+        
+        # Викликаємо функцію обробки даних з модуля orders_pars.py
+        self.logger.info(f"Виклик process_orders_sheet_data з force_process={self.force_process}")
+        session_logger.info(f"Виклик process_orders_sheet_data з force_process={self.force_process}")
+        
+        return process_orders_sheet_data(
+            rows, sheet_name, self.force_process, client_locks=client_locks,
+            fingerprint=self._fingerprints.get(sheet_name), prune_stale_rows=True
+        )
+
+    def _handle_sheet_result(self, sheet_name, result, sheet_start_time):
+        """Оновлює статистику і надсилає помилки аркуша в інтерфейс."""
+        session_logger = self._session_logger
+        
+        # Перетворюємо результат до словника, якщо потрібно
+        result = ensure_dict_result(result)
+        
+        # Отримуємо значення зі словника результатів
+        orders_processed = result.get("orders_processed", 0)
+        orders_skipped = result.get("orders_skipped", 0)
+        orders_updated = result.get("orders_updated", 0)
+        products_added = result.get("products_added", 0)
+        errors = result.get("parsing_errors", [])
+        
+        # Оновлюємо загальну статистику
+        with self._stats_lock:
+            self._stats["orders_processed"] += orders_processed
+            self._stats["orders_skipped"] += orders_skipped
+            self._stats["orders_updated"] += orders_updated
+            self._stats["products_added"] += products_added
+            self._stats["rows_processed"] += orders_processed + orders_updated
+            self._stats["rows_skipped"] += orders_skipped
+            self._stats["sheets_processed"] += 1
+        
+        # Логуємо результати обробки
+        result_msg = (f"[Аркуш {sheet_name}] Результати обробки: "
+                    f"оброблено {orders_processed} замовлень, "
+                    f"пропущено {orders_skipped}, "
+                    f"оновлено {orders_updated}, "
+                    f"додано {products_added} продуктів")
+        
+        self.logger.info(result_msg)
+        session_logger.info(result_msg)
+        
+        # Логуємо помилки: кожну - у файл логів, в інтерфейс - одне зведення на аркуш
+        if errors:
+            for err in errors:
+                self._collected_errors.append(err)
+                error_logger.warning(
+                    f"[Аркуш {sheet_name}] Помилка обробки рядка {err.get('row', 'Н/Д')}: " +
+                    f"{err.get('error', 'Невідома помилка')}"
+                )
+            # Рядки, що не змінилися з минулого запуску, повідомляються повторно (repeated)
+            new_errors = sum(1 for err in errors if not err.get("repeated"))
+            summary = (f"[Аркуш {sheet_name}] Знайдено {len(errors)} помилок обробки "
+                       f"(нових: {new_errors}, з попередніх запусків: {len(errors) - new_errors})")
+            self._count("rows_with_errors", len(errors))
+            self.logger.warning(summary)
+            session_logger.warning(summary)
+            self._count("sheets_with_errors")
+            if new_errors:
+                self.parsing_error.emit({
+                    "sheet": sheet_name,
+                    "row": 0,
+                    "error": f"{new_errors} рядків не оброблено, деталі у файлі логів",
+                    "client": "Немає",
+                    "error_type": "row_errors"
+                })
+            else:
+                self.status_update.emit(summary)
+        
+        # Вимірюємо час обробки аркуша
+        sheet_end_time = datetime.datetime.now()
+        sheet_duration = sheet_end_time - sheet_start_time
+        self.logger.info(f"[Аркуш {sheet_name}] Час обробки: {str(sheet_duration).split('.')[0]}")
+        session_logger.info(f"[Аркуш {sheet_name}] Час обробки: {str(sheet_duration).split('.')[0]}")
+
+    def _handle_sheet_exception(self, sheet_name, e):
+        """Обробка помилок, що виникли під час виклику process_orders_sheet_data."""
+        error_type = type(e).__name__
+        error_msg = f"Помилка обробки даних аркуша {sheet_name}: {str(e)}"
+        self.logger.error(error_msg)
+        self._session_logger.error(f"{error_msg}\n{traceback.format_exc()}")
+        error_logger.error(f"{error_msg}\n{traceback.format_exc()}")
+        
+        self.status_update.emit(error_msg)
+        self.parsing_error.emit({
+            "sheet": sheet_name, 
+            "row": 0, 
+            "error": error_msg, 
+            "client": "Немає", 
+            "error_type": error_type
+        })
+        self._count("sheets_with_errors")
+        
     def run(self):
         start_time = datetime.datetime.now()
         self.logger.info(f"===== ПОЧАТОК ПРОЦЕСУ ІМПОРТУ ({start_time.strftime('%Y-%m-%d %H:%M:%S')}) =====")
@@ -531,6 +973,11 @@ class OrderParsingWorker(QObject):
         collected_errors = []
         
         try:
+            # Кеші довідників завантажуються один раз на запуск
+            prepare_import_run()
+            google_sheets_service.rate_limiter.reset_stats()
+            google_sheets_service.snapshots.reset_stats()
+
             # Перевіряємо, чи Google Sheets API доступний
             self.logger.info("Перевірка доступності Google Sheets API")
             session_logger.info("Перевірка доступності Google Sheets API")
@@ -578,257 +1025,52 @@ class OrderParsingWorker(QObject):
             self.logger.info(f"Отримано {total_sheets} аркушів для обробки")
             
             # Ініціалізуємо лічильники для статистики
-            total_sheets_processed = 0
-            total_sheets_with_errors = 0
-            total_sheets_skipped = 0
-            
-            total_rows_processed = 0
-            total_rows_skipped = 0
-            total_rows_with_errors = 0
-            
-            total_orders_processed = 0
-            total_orders_skipped = 0
-            total_orders_updated = 0
-            total_products_added = 0
+            self._session_logger = session_logger
+            self._collected_errors = collected_errors
+            self._stats = {
+                "sheets_processed": 0,
+                "sheets_with_errors": 0,
+                "sheets_skipped": 0,
+                "rows_processed": 0,
+                "rows_skipped": 0,
+                "rows_with_errors": 0,
+                "orders_processed": 0,
+                "orders_skipped": 0,
+                "orders_updated": 0,
+                "products_added": 0,
+                "other_errors": 0,
+            }
             
             # Встановлюємо початковий статус і прогрес
             self.progress.emit(0)
-            self.status_update.emit(f"Початок обробки {total_sheets} аркушів...")
+            self.status_update.emit(f"Перевірка змін у {total_sheets} аркушах...")
             
-            # Додамо лічильники для відстеження API помилок
-            total_api_errors = 0
-            total_quota_exceeded = 0
-            total_other_errors = 0
+            # Аркуші, що не змінилися з попереднього парсингу, не завантажуємо
+            sheets_list = self._skip_unchanged_sheets(sheets_list)
+            self.status_update.emit(f"Початок обробки {len(sheets_list)} аркушів...")
             
-            # Проходимо по всіх аркушах
-            for index, worksheet in enumerate(sheets_list):
-                sheet_name = worksheet.title
-                sheet_start_time = datetime.datetime.now()
-                
-                # Оновлюємо прогрес і статус
-                progress_percent = int((index / total_sheets) * 100)
-                self.progress.emit(progress_percent)
-                self.status_update.emit(f"Обробка аркуша {sheet_name} ({index+1}/{total_sheets})...")
-                
-                # Логуємо початок обробки аркуша
-                self.logger.info(f"===== ПОЧАТОК ОБРОБКИ АРКУША {sheet_name} ({index+1}/{total_sheets}) =====")
-                session_logger.info(f"===== ПОЧАТОК ОБРОБКИ АРКУША {sheet_name} ({index+1}/{total_sheets}) =====")
-                
-                # Отримуємо дані з аркуша з повторними спробами при помилках квоти API
-                retry_count = 0
-                max_retries = 20  # Збільшуємо кількість спроб до 20
-                backoff_time = 1  # Початкова затримка в секундах
-                max_backoff_time = 180  # Збільшуємо максимальну затримку до 3 хвилин (було 60 секунд)
-                
-                data = None
-                while retry_count < max_retries:
-                    try:
-                        session_logger.info(f"Спроба #{retry_count+1} отримання даних з аркуша {sheet_name}")
-                        data = worksheet.get_all_values()
-                        self.logger.info(f"[Аркуш {sheet_name}] Отримано {len(data)} рядків даних")
-                        session_logger.info(f"[Аркуш {sheet_name}] Отримано {len(data)} рядків даних")
-                        break  # Дані отримано успішно, виходимо з циклу
-                    except gspread.exceptions.APIError as api_error:
-                        error_str = str(api_error)
-                        retry_count += 1
-                        
-                        # Виявляємо, чи це помилка перевищення квоти
-                        if "Quota exceeded" in error_str or "Rate Limit Exceeded" in error_str or "RESOURCE_EXHAUSTED" in error_str:
-                            total_quota_exceeded += 1
-                            wait_time = min(backoff_time * 2 ** (retry_count - 1), max_backoff_time)  # Експоненціальне збільшення часу очікування
-                            jitter = random.uniform(0.5, 1.5)  # Рандомізація для уникнення синхронізації запитів
-                            wait_time = wait_time * jitter
-                            
-                            error_msg = f"[Аркуш {sheet_name}] Перевищено квоту API, спроба {retry_count}/{max_retries}, очікування {wait_time:.1f} сек"
-                            self.logger.warning(error_msg)
-                            session_logger.warning(error_msg)
-                            quota_logger.warning(f"[Аркуш {sheet_name}] Quota exceeded: {error_str}")
-                            self.status_update.emit(f"Перевищено квоту API, очікування {wait_time:.1f} сек...")
-                            
-                            # Очікуємо перед наступною спробою
-                            sleep(wait_time)
-                        else:
-                            # Інші помилки API
-                            total_other_errors += 1
-                            error_msg = f"Помилка API при отриманні даних з аркуша {sheet_name}: {api_error}"
-                            
-                            self.logger.error(error_msg)
-                            session_logger.error(f"{error_msg}\n{traceback.format_exc()}")
-                            error_logger.error(f"{error_msg}\n{traceback.format_exc()}")
-                            api_logger.error(f"[Аркуш {sheet_name}] Невідома помилка API: {error_str}")
-                            
-                            self.status_update.emit(error_msg)
-                            error_data = {
-                                "sheet": sheet_name, 
-                                "row": 0, 
-                                "error": f"Помилка API: {api_error}",
-                                "client": "Немає",
-                                "error_type": "APIError",
-                                "traceback": traceback.format_exc()
-                            }
-                            self.parsing_error.emit(error_data)
-                            collected_errors.append(error_data)
-                            retry_count = max_retries  # Завершуємо цикл спроб
-                            break
-                    except Exception as e:
-                        # Інші неочікувані помилки
-                        total_other_errors += 1
-                        error_msg = f"Помилка при отриманні даних з аркуша {sheet_name}: {e}"
-                        self.logger.error(error_msg)
-                        session_logger.error(f"{error_msg}\n{traceback.format_exc()}")
-                        error_logger.error(f"{error_msg}\n{traceback.format_exc()}")
-                        
-                        self.status_update.emit(error_msg)
-                        error_data = {
-                            "sheet": sheet_name, 
-                            "row": 0, 
-                            "error": f"Неочікувана помилка: {e}",
-                            "client": "Немає",
-                            "error_type": "Exception",
-                            "traceback": traceback.format_exc()
-                        }
-                        self.parsing_error.emit(error_data)
-                        collected_errors.append(error_data)
-                        retry_count = max_retries  # Завершуємо цикл спроб
-                        break
-                
-                # Перевіряємо, чи отримали дані аркуша
-                if not data:
-                    error_msg = f"Не вдалося отримати дані з аркуша {sheet_name} після {max_retries} спроб"
-                    self.logger.error(error_msg)
-                    session_logger.error(error_msg)
-                    self.status_update.emit(error_msg)
-                    total_sheets_with_errors += 1
-                    continue  # Перейти до наступного аркуша
-                    
-                # Якщо в аркуші менше 2 рядків (тільки заголовки або порожній), пропускаємо його
-                if len(data) < 2:
-                    info_msg = f"[Аркуш {sheet_name}] Містить менше 2 рядків (порожній або тільки заголовки), пропускаємо"
-                    self.logger.info(info_msg)
-                    session_logger.info(info_msg)
-                    total_sheets_skipped += 1
-                    continue
-                
-                # Логуємо інформацію про отримані дані
-                self.logger.info(f"[Аркуш {sheet_name}] Отримано {len(data)} рядків даних")
-                session_logger.info(f"[Аркуш {sheet_name}] Отримано {len(data)} рядків даних")
-                
-                # Перетворюємо список рядків у словники
-                headers = [h.strip() for h in data[0]]
-                rows = []
-                
-                for row_data in data[1:]:  # Пропускаємо заголовки
-                    row_dict = {}
-                    for j, cell_value in enumerate(row_data):
-                        if j < len(headers):
-                            row_dict[j] = cell_value
-                    rows.append(row_dict)
-                
-                # Обробляємо дані аркуша
-                try:
-                    # Логуємо початок обробки даних
-                    self.logger.info(f"[Аркуш {sheet_name}] Початок обробки {len(rows)} рядків даних в режимі {'ПОВНИЙ' if self.force_process else 'СТАНДАРТНИЙ'}")
-                    session_logger.info(f"[Аркуш {sheet_name}] Початок обробки {len(rows)} рядків даних в режимі {'ПОВНИЙ' if self.force_process else 'СТАНДАРТНИЙ'}")
-                    
-                    # Викликаємо функцію обробки даних з модуля orders_pars.py
-                    self.logger.info(f"Виклик process_orders_sheet_data з force_process={self.force_process}")
-                    session_logger.info(f"Виклик process_orders_sheet_data з force_process={self.force_process}")
-                    
-                    # Обробка даних з функції має бути у форматі словника
-                    result = process_orders_sheet_data(
-                        rows, sheet_name, self.force_process
-                    )
-                    
-                    # Перетворюємо результат до словника, якщо потрібно
-                    result = ensure_dict_result(result)
-                    
-                    # Отримуємо значення зі словника результатів
-                    orders_processed = result.get("orders_processed", 0)
-                    orders_skipped = result.get("orders_skipped", 0)
-                    orders_updated = result.get("orders_updated", 0)
-                    products_added = result.get("products_added", 0)
-                    errors = result.get("parsing_errors", [])
-                    
-                    # Оновлюємо загальну статистику
-                    total_orders_processed += orders_processed
-                    total_orders_skipped += orders_skipped
-                    total_orders_updated += orders_updated
-                    total_products_added += products_added
-                    total_rows_processed += orders_processed + orders_updated
-                    total_rows_skipped += orders_skipped
-                    total_sheets_processed += 1
-                    
-                    # Логуємо результати обробки
-                    result_msg = (f"[Аркуш {sheet_name}] Результати обробки: "
-                                f"оброблено {orders_processed} замовлень, "
-                                f"пропущено {orders_skipped}, "
-                                f"оновлено {orders_updated}, "
-                                f"додано {products_added} продуктів")
-                    
-                    self.logger.info(result_msg)
-                    session_logger.info(result_msg)
-                    
-                    # Логуємо помилки
-                    if errors:
-                        for err in errors:
-                            self.parsing_error.emit(err)
-                            collected_errors.append(err)
-                            error_logger.warning(
-                                f"[Аркуш {sheet_name}] Помилка обробки рядка {err.get('row', 'Н/Д')}: " +
-                                f"{err.get('error', 'Невідома помилка')}"
-                            )
-                            
-                        total_rows_with_errors += len(errors)
-                        self.logger.warning(f"[Аркуш {sheet_name}] Знайдено {len(errors)} помилок обробки")
-                        session_logger.warning(f"[Аркуш {sheet_name}] Знайдено {len(errors)} помилок обробки")
-                        if len(errors) > 0:
-                            total_sheets_with_errors += 1
-                    
-                    # Вимірюємо час обробки аркуша
-                    sheet_end_time = datetime.datetime.now()
-                    sheet_duration = sheet_end_time - sheet_start_time
-                    self.logger.info(f"[Аркуш {sheet_name}] Час обробки: {str(sheet_duration).split('.')[0]}")
-                    session_logger.info(f"[Аркуш {sheet_name}] Час обробки: {str(sheet_duration).split('.')[0]}")
-                    
-                    # Додаємо паузу між аркушами для уникнення послідовних перевищень квоти
-                    if index < total_sheets - 1:  # Якщо це не останній аркуш
-                        pause_time = 5.0  # Стандартна пауза 5 секунд
-                        
-                        # Якщо був хоча б один випадок перевищення квоти під час обробки цього аркуша, збільшуємо паузу
-                        if total_quota_exceeded > 0:
-                            quota_pause = min(30.0, 5.0 * (total_quota_exceeded / 10 + 1))  # Збільшуємо паузу залежно від кількості перевищень квоти, максимум 30 секунд
-                            pause_time = quota_pause
-                            self.logger.info(f"Збільшена пауза між аркушами через {total_quota_exceeded} перевищень квоти: {pause_time:.1f} секунд")
-                            session_logger.info(f"Збільшена пауза між аркушами через {total_quota_exceeded} перевищень квоти: {pause_time:.1f} секунд")
-                        
-                        self.logger.info(f"Пауза {pause_time:.1f} секунд перед обробкою наступного аркуша...")
-                        session_logger.info(f"Пауза {pause_time:.1f} секунд перед обробкою наступного аркуша...")
-                        self.status_update.emit(f"Пауза {pause_time:.1f} секунд перед наступним аркушем...")
-                        
-                        # Використовуємо затримку з обробкою подій Qt
-                        for i in range(int(pause_time * 10)):  # 10 кроків на секунду для плавності
-                            if not self._is_running:  # Перевіряємо, чи не треба зупинитися
-                                break
-                            QCoreApplication.processEvents()  # Обробляємо події Qt
-                            sleep(0.1)  # Чекаємо 100 мс
-                    
-                except Exception as e:
-                    # Обробка помилок, що виникли під час виклику process_orders_sheet_data
-                    error_type = type(e).__name__
-                    error_msg = f"Помилка обробки даних аркуша {sheet_name}: {str(e)}"
-                    self.logger.error(error_msg)
-                    session_logger.error(f"{error_msg}\n{traceback.format_exc()}")
-                    error_logger.error(f"{error_msg}\n{traceback.format_exc()}")
-                    
-                    self.status_update.emit(error_msg)
-                    self.parsing_error.emit({
-                        "sheet": sheet_name, 
-                        "row": 0, 
-                        "error": error_msg, 
-                        "client": "Немає", 
-                        "error_type": error_type
-                    })
-                    total_sheets_with_errors += 1
+            if self.max_workers > 1:
+                self.logger.info(f"Конвеєрний режим: {self.max_workers} аркушів записуються паралельно")
+                session_logger.info(f"Конвеєрний режим: {self.max_workers} аркушів записуються паралельно")
+                self._run_pipelined(sheets_list)
+            else:
+                self._run_sequential(sheets_list)
+            
+            stats = self._stats
+            total_sheets_processed = stats["sheets_processed"]
+            total_sheets_with_errors = stats["sheets_with_errors"]
+            total_sheets_skipped = stats["sheets_skipped"]
+            total_rows_processed = stats["rows_processed"]
+            total_rows_skipped = stats["rows_skipped"]
+            total_rows_with_errors = stats["rows_with_errors"]
+            total_orders_processed = stats["orders_processed"]
+            total_orders_skipped = stats["orders_skipped"]
+            total_orders_updated = stats["orders_updated"]
+            total_products_added = stats["products_added"]
+            limiter_stats = google_sheets_service.rate_limiter.stats()
+            snapshot_stats = google_sheets_service.snapshots.stats()
+            total_quota_exceeded = limiter_stats["throttle_events"]
+            total_other_errors = stats["other_errors"]
                 
             # Видаляємо дублікати замовлень після обробки всіх аркушів
             try:
@@ -871,6 +1113,7 @@ class OrderParsingWorker(QObject):
                 log_sheets_issues(collected_errors)
                 
                 if collected_errors:
+                    error_types = Counter(e.get("error_type", "row") for e in collected_errors)
                     error_stats = ", ".join([f"{type_name}: {count}" for type_name, count in error_types.items()])
                     error_summary = f"Імпорт завершено з {len(collected_errors)} помилками. Типи помилок: {error_stats}. Деталі у файлі логів."
                     
@@ -889,6 +1132,20 @@ class OrderParsingWorker(QObject):
             # Завершальна статистика та час виконання
             end_time = datetime.datetime.now()
             total_duration = end_time - start_time
+            cache_stats = dimension_cache.stats()
+            
+            # Звіт часу етапів по аркушах (JSON поруч із логом сеансу)
+            stages_report_file = os.path.join(log_dir, f"parse_session_{timestamp}_stages.json")
+            stage_timer.write_report(stages_report_file)
+            stage_totals = stage_timer.report()["totals"]
+            stages_summary = "\n".join(
+                f"- {stage}: {stat['total_seconds']:.1f} сек ({stat['count']} разів)"
+                for stage, stat in stage_totals.items()
+            ) or "- немає даних"
+            
+            # Звіт запитів до БД (psycopg2) з найдорожчими запитами
+            queries_report_file = os.path.join(log_dir, f"parse_session_{timestamp}_queries.json")
+            query_stats.write_report(queries_report_file)
             
             # Формуємо підсумковий звіт
             summary = f"""
@@ -914,9 +1171,26 @@ class OrderParsingWorker(QObject):
 - Додано продуктів: {total_products_added}
 
 Статистика API:
+- Запитів до API: {limiter_stats['requests']}
 - Помилок перевищення квоти: {total_quota_exceeded}
+- Час очікування через ліміт API: {limiter_stats['throttled_seconds']:.1f} сек
+- Поточна швидкість: {limiter_stats['current_rate_per_minute']} з {limiter_stats['requests_per_minute']} запитів/хв
+- Аркушів зі знімків (без завантаження): {snapshot_stats['hits']}
 - Інших помилок API: {total_other_errors}
 
+Кеш довідників:
+- Звернень без БД: {cache_stats['hits']}
+- Звернень до БД: {cache_stats['misses']}
+- Додано нових значень: {cache_stats['inserted']}
+
+Час етапів:
+{stages_summary}
+Звіт часу етапів: {stages_report_file}
+
+Запити до БД:
+{query_stats.format_report()}
+Звіт запитів до БД: {queries_report_file}
+
 Загальна кількість помилок: {len(collected_errors)}
 Деталі у файлі: {session_log_file}
 """
@@ -1628,6 +1902,15 @@ def ensure_dict_result(result):
     """
     if isinstance(result, dict):
         return result
+    elif isinstance(result, list):
+        # process_orders_sheet_data повертає список помилок аркуша
+        return {
+            "orders_processed": 0,
+            "orders_skipped": 0,
+            "orders_updated": 0,
+            "products_added": 0,
+            "parsing_errors": result
+        }
     elif isinstance(result, tuple) and len(result) >= 5:
         # Це старий формат - кортеж з 5 значень
         return {